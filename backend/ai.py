@@ -1,176 +1,1065 @@
+import asyncio
+import json
 import logging
-from typing import List, Optional
+import re
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
-import requests
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.utils.html import escape
 
+from zerver.lib import ai_metrics
+from zerver.lib.ai_batch import MicroBatcher
+from zerver.lib.ai_cache import get_result_cache, make_cache_key
+from zerver.lib.ai_backends import get_backend_router, llm_configured
+from zerver.lib.ai_circuit import CircuitOpenError
+from zerver.lib.ai_deadline import Deadline, DeadlineExceeded, check_deadline, llm_timeout
+from zerver.lib.ai_hedge import arun_hedged, hedge_payload, hedging_enabled, run_hedged
+from zerver.lib.ai_http import pool_stats
+from zerver.lib.ai_limiter import LoadShedError, get_llm_limiter, lane_for
+from zerver.lib.ai_prompt import PackedPrompt, get_token_counter, input_token_budget, pack_items
+from zerver.lib.ai_ratelimit import charge_realm, realm_weight
+from zerver.lib.ai_retry import acall_with_retries, call_with_retries
+from zerver.lib.ai_singleflight import get_single_flight
+
 logger = logging.getLogger(__name__)
 
-def generate_message_recap(messages: List[str], message_ids: List[int], max_tokens: int = 800) -> str:
+# Bump whenever a prompt or its post-processing changes, so cached results
+# produced by the old prompt are not served.
+RECAP_PROMPT_VERSION = "recap-v1"
+TOPIC_PROMPT_VERSION = "topic-v2"
+
+# Per-message token caps (roughly the old 3000 / 800 character cuts).
+RECAP_MAX_MESSAGE_TOKENS = 750
+TOPIC_MAX_MESSAGE_TOKENS = 200
+# Tokens for the user-prompt scaffolding around the packed messages.
+PROMPT_SCAFFOLD_TOKENS = 32
+
+RECAP_SYSTEM_PROMPT = (
+    "You are a concise assistant.\n"
+    "Return ONLY valid HTML.\n"
+    "DO NOT use Markdown.\n"
+    "DO NOT wrap output in ``` or ```html.\n"
+    "DO NOT include message IDs like MSG 12.\n"
+    "Use <p>, <ul>, <li>, <strong> only.\n"
+)
+
+RECAP_MAP_SYSTEM_PROMPT = RECAP_SYSTEM_PROMPT + (
+    "You are summarizing ONE conversation (a single stream topic).\n"
+    "Start with <p><strong>the conversation name</strong></p>, then 1-5 <li> bullet points.\n"
+)
+
+RECAP_REDUCE_SYSTEM_PROMPT = RECAP_SYSTEM_PROMPT + (
+    "You are given partial recaps of several conversations.\n"
+    "Merge them into one recap: keep each conversation name in <strong>,\n"
+    "drop repetition, and keep the most important points first.\n"
+)
+
+TOPIC_SUMMARY_SYSTEM_PROMPT = RECAP_SYSTEM_PROMPT + (
+    "You maintain a running summary of ONE conversation (a single stream topic).\n"
+    "You get the previous summary and the messages that arrived since.\n"
+    "Return the updated summary: <p><strong>the conversation name</strong></p>, then at most 8 <li> points,\n"
+    "newest developments last. Drop points that were superseded.\n"
+)
+
+TOPIC_SYSTEM_PROMPT = (
+    "You generate short Zulip topic titles.\n"
+    "Return ONLY the title text (no quotes, no markdown).\n"
+    "Keep it <= 60 characters.\n"
+    "Do NOT reuse boilerplate prefixes from the current topic (e.g., 'Changing focus to', 'Topic shift:', 'New topic:', 'Discussion:').\n"
+    "Write the title as a neutral noun phrase describing the subject.\n"
+    "If the current topic is still accurate, return an empty string."
+)
+
+TOPIC_BATCH_SYSTEM_PROMPT = (
+    "You generate short Zulip topic titles for several numbered conversations at once.\n"
+    "Return ONLY a JSON array of strings, one per conversation, in the same order (no markdown).\n"
+    "Keep each title <= 60 characters.\n"
+    "Do NOT reuse boilerplate prefixes from the current topic (e.g., 'Changing focus to', 'Topic shift:', 'New topic:', 'Discussion:').\n"
+    "Write each title as a neutral noun phrase describing the subject.\n"
+    "Use an empty string for a conversation whose current topic is still accurate."
+)
+
+RECAP_ALLOWED_TAGS = [
+    "div","p","br","strong","em","ul","ol","li","a","code","pre","blockquote",
+    "h1","h2","h3","h4","h5","h6","span"
+]
+RECAP_ALLOWED_ATTRS = {
+    "a": ["href", "title", "target", "rel"],
+    "span": ["class"],
+    "div": ["class"],
+}
+
+
+def _llm_config(model_setting: str, default_model: str) -> Tuple[bool, str]:
+    """
+    (whether any LLM backend is configured, the model this feature asks for).
+    """
+    return llm_configured(), getattr(settings, model_setting, default_model)
+
+
+def _post_chat_completion(payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+    """
+    Send a chat completion to the best healthy backend (failing over to the
+    next one) and return the response in OpenAI shape.
+    """
+    data = get_backend_router().complete(payload, timeout)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("LLM pool stats: %s", pool_stats())
+    return data
+
+
+def _stream_chat_completion(payload: Dict[str, Any], timeout: float) -> Iterator[str]:
+    """
+    Stream a chat completion and yield content deltas as they arrive.
+    `timeout` bounds connect and each gap between chunks, not the whole stream.
+    """
+    return get_backend_router().stream(payload, timeout)
+
+
+async def _apost_chat_completion(payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+    """
+    Async twin of _post_chat_completion, over the shared httpx client (HTTP/2 when available).
+    """
+    return await get_backend_router().acomplete(payload, timeout)
+
+
+def _limited_post(
+    payload: Dict[str, Any], timeout: float, kind: str, realm_id: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    _post_chat_completion once the process-wide limiter admits the call in
+    `kind`'s lane (queued fairly against other realms); time spent queued
+    comes out of `timeout`.
+    """
+    start = time.monotonic()
+    with get_llm_limiter().slot(timeout, lane_for(kind), realm_id, realm_weight(realm_id)):
+        return _post_chat_completion(payload, timeout=timeout - (time.monotonic() - start))
+
+
+async def _alimited_post(
+    payload: Dict[str, Any], timeout: float, kind: str, realm_id: Optional[int] = None
+) -> Dict[str, Any]:
+    start = time.monotonic()
+    async with get_llm_limiter().aslot(timeout, lane_for(kind), realm_id, realm_weight(realm_id)):
+        return await _apost_chat_completion(payload, timeout=timeout - (time.monotonic() - start))
+
+
+def _log_fallback(msg: str, *args: Any) -> None:
+    """
+    logger.exception for the current failure, except that an open circuit
+    breaker or shed load (expected, and possibly thousands per second) is
+    logged at debug.
+    """
+    exc = sys.exc_info()[1]
+    if isinstance(exc, (CircuitOpenError, LoadShedError)):
+        logger.debug(msg + " (%s)", *args, exc)
+    else:
+        logger.exception(msg, *args)
+
+
+def _cache_lookup(key: str) -> Optional[str]:
+    cache = get_result_cache()
+    return cache.get(key) if cache is not None else None
+
+
+def _cache_store(key: str, value: str) -> None:
+    cache = get_result_cache()
+    if cache is not None and value:
+        cache.set(key, value)
+
+
+# The async paths run shared-cache I/O on a thread, not on the event loop.
+_acache_lookup = sync_to_async(_cache_lookup, thread_sensitive=False)
+_acache_store = sync_to_async(_cache_store, thread_sensitive=False)
+_acharge_realm = sync_to_async(charge_realm, thread_sensitive=False)
+
+
+def _complete(
+    kind: str,
+    cache_key: str,
+    payload: Dict[str, Any],
+    timeout: float,
+    parse: Callable[[Dict[str, Any]], str],
+    deadline: Optional[Deadline] = None,
+    realm_id: Optional[int] = None,
+    charged: bool = False,
+) -> str:
+    """
+    Shared LLM path: result cache, then the circuit breaker, then single-flight
+    coalescing, then a concurrency-limiter slot in `kind`'s priority lane and
+    the HTTP call, retried per the `kind` endpoint's retry policy within
+    `timeout` overall (less if `deadline` leaves less). For kinds in
+    AI_HEDGE_KINDS, an attempt slower than the observed p95 is hedged with a
+    second request.
+
+    Each call is charged once (not per retry or hedge) to `realm_id`'s
+    per-minute budgets, unless `charged` says the caller already did, and
+    shares the limiter fairly with other realms.
+
+    Raises on failure (CircuitOpenError while the provider is considered
+    down, DeadlineExceeded when there is no time left to call it,
+    LoadShedError when the limiter cannot admit it in time or the realm is
+    over budget); callers own their fallbacks.
+    """
+    cached = _cache_lookup(cache_key)
+    if cached is not None:
+        return cached
+    if get_backend_router().all_open():
+        raise CircuitOpenError("llm")
+    timeout = llm_timeout(deadline, timeout)
+
+    def attempt(attempt_timeout: float, body: Dict[str, Any] = payload) -> Dict[str, Any]:
+        return _limited_post(body, attempt_timeout, kind, realm_id)
+
+    def hedged_attempt(attempt_timeout: float) -> Dict[str, Any]:
+        hedge_body = hedge_payload(payload)
+        return run_hedged(kind, attempt, lambda t: attempt(t, hedge_body), attempt_timeout)
+
+    def compute() -> str:
+        if not charged:
+            charge_realm(realm_id, payload)
+        data = call_with_retries(kind, hedged_attempt if hedging_enabled(kind) else attempt, timeout)
+        check_deadline(deadline, "sanitize")
+        result = parse(data)
+        _cache_store(cache_key, result)
+        return result
+
+    return get_single_flight().do(cache_key, compute, wait_timeout=timeout)
+
+
+async def _acomplete(
+    kind: str,
+    cache_key: str,
+    payload: Dict[str, Any],
+    timeout: float,
+    parse: Callable[[Dict[str, Any]], str],
+    deadline: Optional[Deadline] = None,
+    realm_id: Optional[int] = None,
+    charged: bool = False,
+) -> str:
+    cached = await _acache_lookup(cache_key)
+    if cached is not None:
+        return cached
+    if get_backend_router().all_open():
+        raise CircuitOpenError("llm")
+    timeout = llm_timeout(deadline, timeout)
+
+    async def attempt(attempt_timeout: float, body: Dict[str, Any] = payload) -> Dict[str, Any]:
+        return await _alimited_post(body, attempt_timeout, kind, realm_id)
+
+    async def hedged_attempt(attempt_timeout: float) -> Dict[str, Any]:
+        hedge_body = hedge_payload(payload)
+        return await arun_hedged(kind, attempt, lambda t: attempt(t, hedge_body), attempt_timeout)
+
+    async def compute() -> str:
+        if not charged:
+            await _acharge_realm(realm_id, payload)
+        data = await acall_with_retries(kind, hedged_attempt if hedging_enabled(kind) else attempt, timeout)
+        check_deadline(deadline, "sanitize")
+        result = parse(data)
+        await _acache_store(cache_key, result)
+        return result
+
+    return await get_single_flight().ado(cache_key, compute, wait_timeout=timeout)
+
+
+def _completion_content(data: Dict[str, Any]) -> str:
+    return data.get("choices", [{}])[0].get("message", {}).get("content", "") or ""
+
+
+# ---- recap helpers ----
+
+def _record_prompt_tokens(kind: str, model: str, packed: PackedPrompt) -> None:
+    ai_metrics.incr(f"ai.prompt.{kind}.input_tokens", packed.used_tokens)
+    if packed.truncated:
+        ai_metrics.incr(f"ai.prompt.{kind}.truncated", packed.truncated)
+    if packed.dropped:
+        ai_metrics.incr(f"ai.prompt.{kind}.dropped", packed.dropped)
+    logger.debug(
+        "%s prompt model=%s used=%s/%s tokens kept=%s truncated=%s dropped=%s",
+        kind,
+        model,
+        packed.used_tokens,
+        packed.budget,
+        len(packed.texts),
+        packed.truncated,
+        packed.dropped,
+    )
+
+
+def _prompt_budget(model: str, system_prompt: str) -> int:
+    count = get_token_counter(model)
+    return input_token_budget(model) - count(system_prompt) - PROMPT_SCAFFOLD_TOKENS
+
+
+def _recap_inputs(messages: List[str], model: str) -> List[str]:
+    # Bound prompt size by the model's token budget, earliest messages first.
+    packed = pack_items(
+        messages,
+        _prompt_budget(model, RECAP_SYSTEM_PROMPT),
+        get_token_counter(model),
+        max_item_tokens=RECAP_MAX_MESSAGE_TOKENS,
+    )
+    _record_prompt_tokens("recap", model, packed)
+    return packed.texts
+
+
+def _recap_fallback(labelled: List[str]) -> str:
+    # fallback: show first N messages
+    joined = "\n\n---\n\n".join(labelled[:10])
+    return "<p><strong>Recap (fallback):</strong></p><pre>{}</pre>".format(escape(joined[:4000]))
+
+
+def _recap_payload(
+    model: str,
+    labelled: List[str],
+    max_tokens: int,
+    system_prompt: str = RECAP_SYSTEM_PROMPT,
+    header: str = "Messages:",
+) -> Dict[str, Any]:
+    prompt_user = header + "\n\n" + "\n\n---\n\n".join(labelled)
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt_user},
+        ],
+        "max_tokens": max_tokens,
+        "temperature": 0.2,
+    }
+
+
+def _strip_code_fence(s: str) -> str:
+    s = s.strip()
+    if s.startswith("```"):
+        s = s.split("\n", 1)[1] if "\n" in s else ""
+        s = s.rsplit("```", 1)[0]
+    return s.strip()
+
+
+def _sanitize_recap_html(content: str) -> str:
+    import bleach
+
+    return bleach.clean(
+        _strip_code_fence(content), tags=RECAP_ALLOWED_TAGS, attributes=RECAP_ALLOWED_ATTRS, strip=True
+    )
+
+
+_BLOCK_TAG_RE = re.compile(r"<(/?)(p|ul|ol|h[1-6]|blockquote|pre)\b[^>]*>", re.IGNORECASE)
+
+
+class _RecapBlockSplitter:
+    """
+    Accumulates streamed recap text and hands back complete top-level HTML
+    blocks (<p>, <ul>, <ol>, <h*>, <blockquote>, <pre>) so each can be
+    sanitized on its own. A leading ``` / ```html fence is dropped.
+    """
+
+    def __init__(self) -> None:
+        self.buf = ""
+        self.depth = 0
+        self.scan_pos = 0
+        self.fence_checked = False
+
+    def _drop_leading_fence(self) -> bool:
+        head = self.buf.lstrip()
+        if not head:
+            return False
+        if head.startswith("`"):
+            if "\n" not in head:
+                if len(head) < 16:
+                    return False  # wait for the rest of the fence line
+            elif head.startswith("```"):
+                self.buf = head.split("\n", 1)[1]
+        self.fence_checked = True
+        return True
+
+    def feed(self, text: str) -> List[str]:
+        self.buf += text
+        if not self.fence_checked and not self._drop_leading_fence():
+            return []
+
+        blocks: List[str] = []
+        while True:
+            m = _BLOCK_TAG_RE.search(self.buf, self.scan_pos)
+            if m is None:
+                break
+            self.scan_pos = m.end()
+            if m.group(1):
+                self.depth = max(self.depth - 1, 0)
+                if self.depth == 0:
+                    blocks.append(self.buf[: m.end()])
+                    self.buf = self.buf[m.end():]
+                    self.scan_pos = 0
+            else:
+                self.depth += 1
+        return blocks
+
+    def flush(self) -> List[str]:
+        rest = _strip_code_fence(self.buf)
+        if rest.endswith("```"):
+            rest = rest[:-3]
+        self.buf = ""
+        return [rest] if rest.strip() else []
+
+
+def _recap_from_response(data: Dict[str, Any]) -> str:
+    content = _completion_content(data)
+    if not content:
+        return "<p>(empty recap)</p>"
+    logger.debug("LLM content len=%s head=%r", len(content), content[:200])
+    return f"<div class='ai-recap'>{_sanitize_recap_html(content)}</div>"
+
+
+def _recap_section_from_response(data: Dict[str, Any]) -> str:
+    content = _completion_content(data)
+    if not content:
+        raise ValueError("empty recap section")
+    return _sanitize_recap_html(content)
+
+
+def _recap_section_fallback(label: str, labelled: List[str]) -> str:
+    items = "".join(f"<li>{escape(text[:200])}</li>" for text in labelled[:3])
+    return f"<p><strong>{escape(label)}</strong></p><ul>{items}</ul>"
+
+
+# ---- topic title helpers ----
+
+def _topic_inputs(messages: List[str], model: str) -> List[str]:
+    # Prefer the most recent messages to detect "drift" quickly
+    packed = pack_items(
+        messages,
+        _prompt_budget(model, TOPIC_SYSTEM_PROMPT),
+        get_token_counter(model),
+        max_item_tokens=TOPIC_MAX_MESSAGE_TOKENS,
+        newest_first=True,
+    )
+    _record_prompt_tokens("topic", model, packed)
+    return packed.texts
+
+
+def build_topic_user_prompt(labelled: List[str], current_title: Optional[str]) -> str:
+    """
+    User prompt for TOPIC_PROMPT_VERSION: each packed message exactly once,
+    oldest first, under a single header.
+    """
+    return "\n".join(
+        [
+            f"Current topic: {current_title or '(none)'}",
+            "",
+            "Recent messages (oldest first):",
+            "\n\n---\n\n".join(labelled),
+            "",
+            "Suggest a better topic title if the discussion focus has changed.",
+        ]
+    )
+
+
+def _topic_payload(model: str, labelled: List[str], current_title: Optional[str], max_tokens: int) -> Dict[str, Any]:
+    prompt_user = build_topic_user_prompt(labelled, current_title)
+    count = get_token_counter(model)
+    ai_metrics.observe("ai.prompt.topic.request_tokens", count(TOPIC_SYSTEM_PROMPT) + count(prompt_user))
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": TOPIC_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt_user},
+        ],
+        "max_tokens": max_tokens,
+        "temperature": 0.0,
+    }
+
+
+def _clean_topic_title(content: str) -> str:
+    content = content.strip()
+    if not content:
+        # The prompt asks for an empty answer when the current topic still fits.
+        return ""
+    suggestion = content.splitlines()[0][:60]
+    # final sanity: remove angle brackets / excessive whitespace
+    return suggestion.replace("\n", " ").strip()
+
+
+def _topic_from_response(data: Dict[str, Any]) -> str:
+    return _clean_topic_title(_completion_content(data))
+
+
+def topic_fallback_title(messages: List[str], current_title: Optional[str]) -> str:
+    """The heuristic title when the LLM does not answer: the latest message's first line."""
+    candidate = (messages[-1].split("\n", 1)[0].strip()[:60]) if messages else ""
+    return candidate or (current_title or "")
+
+
+# ---- topic micro-batching ----
+
+@dataclass
+class _TopicBatchItem:
+    model: str
+    labelled: List[str]
+    current_title: Optional[str]
+    max_tokens: int
+    cache_key: str
+    timeout: float
+
+
+def topic_batching_enabled() -> bool:
+    return getattr(settings, "AI_TOPIC_BATCHING", False)
+
+
+def _parse_topic_batch(content: str, count: int) -> List[str]:
+    titles = json.loads(_strip_code_fence(content))
+    if isinstance(titles, dict):
+        titles = titles.get("titles")
+    if not isinstance(titles, list) or len(titles) != count or not all(isinstance(t, str) for t in titles):
+        raise ValueError(f"expected a JSON array of {count} titles")
+    return [_clean_topic_title(t) for t in titles]
+
+
+def _run_topic_batch(items: List[_TopicBatchItem]) -> List[Optional[str]]:
+    """
+    Suggest titles for a batch of requests with one LLM call. None for an
+    item means "make the individual call": a batch with a single distinct
+    request, items past AI_TOPIC_BATCH_MAX_TOKENS, and every item when the
+    batched call fails or its answer cannot be split back up.
+    """
+    results: List[Optional[str]] = [None] * len(items)
+    model = items[0].model
+    count = get_token_counter(model)
+    budget: int = getattr(settings, "AI_TOPIC_BATCH_MAX_TOKENS", 6000)
+    used = 0
+    # Identical requests share one conversation in the prompt.
+    slots: Dict[str, List[int]] = {}
+    for i, item in enumerate(items):
+        if item.cache_key not in slots:
+            cost = sum(count(text) for text in item.labelled) + PROMPT_SCAFFOLD_TOKENS
+            if item.model != model or (slots and used + cost > budget):
+                continue
+            used += cost
+            slots[item.cache_key] = []
+        slots[item.cache_key].append(i)
+    if len(slots) < 2:
+        return results
+
+    batch = [items[indexes[0]] for indexes in slots.values()]
+    prompt_user = "\n\n".join(
+        f"## Conversation {n}\n{build_topic_user_prompt(item.labelled, item.current_title)}"
+        for n, item in enumerate(batch, 1)
+    )
+    # Room for the JSON punctuation around each title.
+    max_tokens = sum(item.max_tokens for item in batch) + 8 * len(batch)
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": TOPIC_BATCH_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt_user},
+        ],
+        "max_tokens": max_tokens,
+        "temperature": 0.0,
+    }
+    cache_key = make_cache_key(
+        "topic_batch", model, TOPIC_PROMPT_VERSION, max_tokens, [item.cache_key for item in batch]
+    )
+    usage: Dict[str, Any] = {}
+
+    def parse(data: Dict[str, Any]) -> str:
+        usage.update(data.get("usage") or {})
+        return _completion_content(data)
+
+    try:
+        content = _complete("topic_batch", cache_key, payload, min(item.timeout for item in batch), parse)
+    except Exception:
+        _log_fallback("Batched topic suggestion failed for %d requests; calling individually", len(batch))
+        ai_metrics.incr("ai.topic_batch.failed")
+        return results
+    try:
+        titles = _parse_topic_batch(content, len(batch))
+    except ValueError:
+        logger.warning("Could not split a batch of %d topic suggestions; calling individually", len(batch))
+        ai_metrics.incr("ai.topic_batch.parse_failed")
+        return results
+
+    for title, (key, indexes) in zip(titles, slots.items()):
+        _cache_store(key, title)
+        for i in indexes:
+            results[i] = title
+    ai_metrics.incr("ai.topic_batch.calls_saved", len(batch) - 1)
+    if usage.get("total_tokens"):
+        ai_metrics.observe("ai.topic_batch.tokens_per_item", usage["total_tokens"] / len(batch))
+    return results
+
+
+_topic_batcher: Optional[MicroBatcher[_TopicBatchItem, Optional[str]]] = None
+_topic_batcher_lock = threading.Lock()
+
+
+def _get_topic_batcher() -> MicroBatcher[_TopicBatchItem, Optional[str]]:
+    """
+    AI_TOPIC_BATCH_WINDOW_MS: how long to collect requests;
+    AI_TOPIC_BATCH_MAX_SIZE: a full batch is sent at once;
+    AI_TOPIC_BATCH_THREADS: batched LLM calls in flight at once.
+    """
+    global _topic_batcher
+    if _topic_batcher is None:
+        with _topic_batcher_lock:
+            if _topic_batcher is None:
+                _topic_batcher = MicroBatcher(
+                    "topic",
+                    _run_topic_batch,
+                    window=getattr(settings, "AI_TOPIC_BATCH_WINDOW_MS", 10) / 1000,
+                    max_size=getattr(settings, "AI_TOPIC_BATCH_MAX_SIZE", 8),
+                    threads=getattr(settings, "AI_TOPIC_BATCH_THREADS", 4),
+                )
+    return _topic_batcher
+
+
+def _topic_batch_timeout(deadline: Optional[Deadline]) -> float:
+    """
+    How long a request waits for its batch: AI_TOPIC_BATCH_WAIT_SHARE of its
+    LLM timeout, leaving the rest for the individual call if the batch is
+    late.
+    """
+    return llm_timeout(deadline, 10) * getattr(settings, "AI_TOPIC_BATCH_WAIT_SHARE", 0.5)
+
+
+def _batch_timed_out(future: "Future[Optional[str]]") -> None:
+    # Cancelled, the item is left out of its batch if that has not started.
+    future.cancel()
+    ai_metrics.incr("ai.topic_batch.timed_out")
+
+
+def _batched_topic_title(
+    item: _TopicBatchItem, payload: Dict[str, Any], realm_id: Optional[int]
+) -> Optional[str]:
+    """
+    The item's title from a micro-batch, or None to make the individual call
+    (already charged to the realm: pass charged=True), also when the batch
+    has not answered within item.timeout.
+    """
+    cached = _cache_lookup(item.cache_key)
+    if cached is not None:
+        return cached
+    charge_realm(realm_id, payload)
+    start = time.monotonic()
+    future = _get_topic_batcher().submit(item)
+    try:
+        title = future.result(timeout=item.timeout)
+    except FutureTimeoutError:
+        _batch_timed_out(future)
+        return None
+    ai_metrics.timing("ai.topic_batch.request_ms", (time.monotonic() - start) * 1000)
+    return title
+
+
+async def _abatched_topic_title(
+    item: _TopicBatchItem, payload: Dict[str, Any], realm_id: Optional[int]
+) -> Optional[str]:
+    cached = await _acache_lookup(item.cache_key)
+    if cached is not None:
+        return cached
+    await _acharge_realm(realm_id, payload)
+    start = time.monotonic()
+    future = _get_topic_batcher().submit(item)
+    try:
+        title = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), item.timeout)
+    except asyncio.TimeoutError:
+        _batch_timed_out(future)
+        return None
+    ai_metrics.timing("ai.topic_batch.request_ms", (time.monotonic() - start) * 1000)
+    return title
+
+
+def generate_message_recap(
+    messages: List[str],
+    message_ids: List[int],
+    max_tokens: int = 800,
+    deadline: Optional[Deadline] = None,
+    realm_id: Optional[int] = None,
+) -> str:
     """
     Generate a concise HTML recap for the provided message texts, in the order of message_ids.
-    Returns a (mostly) safe HTML string.
+    Returns a (mostly) safe HTML string. With a `deadline`, the LLM timeout is
+    what the deadline leaves, and the fallback is returned once it runs out.
     """
     if not messages:
         return "<p>(no messages)</p>"
 
-    # Config
-    api_key: Optional[str] = getattr(settings, "LLM_API_KEY", None)
-    provider: str = getattr(settings, "LLM_PROVIDER", "openai")
-    model: str = getattr(settings, "LLM_MODEL", "gpt-4o-mini")
-
-    # Bound prompt size (avoid huge prompts)
-    labelled: List[str] = []
-    for mid, text in zip(message_ids, messages):
-        labelled.append(text[:3000])
-    labelled = labelled[:200]
-
-    if not api_key:
-        logger.warning("LLM_API_KEY not configured; returning fallback recap")
-        joined = "\n\n---\n\n".join(labelled[:10])
-        # fallback: show first N messages
-        return "<p><strong>Recap (fallback):</strong></p><pre>{}</pre>".format(escape(joined[:4000]))
-
-    prompt_system = (
-        "You are a concise assistant.\n"
-        "Return ONLY valid HTML.\n"
-        "DO NOT use Markdown.\n"
-        "DO NOT wrap output in ``` or ```html.\n"
-        "DO NOT include message IDs like MSG 12.\n"
-        "Use <p>, <ul>, <li>, <strong> only.\n"
-    )
-    prompt_user = "Messages:\n\n" + "\n\n---\n\n".join(labelled)
+    configured, model = _llm_config("LLM_MODEL", "gpt-4o-mini")
+    try:
+        check_deadline(deadline, "prompt")
+    except DeadlineExceeded:
+        return _recap_fallback(messages)
+    labelled = _recap_inputs(messages, model)
+
+    if not configured:
+        logger.warning("No LLM backend configured; returning fallback recap")
+        return _recap_fallback(labelled)
+
+    cache_key = make_cache_key("recap", model, RECAP_PROMPT_VERSION, max_tokens, labelled)
+    payload = _recap_payload(model, labelled, max_tokens)
+    try:
+        return _complete(
+            "recap", cache_key, payload, 20, _recap_from_response, deadline=deadline, realm_id=realm_id
+        )
+    except Exception:
+        _log_fallback("LLM request failed; returning fallback recap")
+        return _recap_fallback(labelled)
+
+
+async def agenerate_message_recap(
+    messages: List[str],
+    message_ids: List[int],
+    max_tokens: int = 800,
+    deadline: Optional[Deadline] = None,
+    realm_id: Optional[int] = None,
+) -> str:
+    """
+    Async version of generate_message_recap; the worker is not held during the LLM round trip.
+    """
+    if not messages:
+        return "<p>(no messages)</p>"
 
+    configured, model = _llm_config("LLM_MODEL", "gpt-4o-mini")
     try:
-        if provider != "openai":
-            raise RuntimeError(f"Unsupported LLM_PROVIDER: {provider}")
-
-        url = "https://api.openai.com/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-        }
-        payload = {
-            "model": model,
-            "messages": [
-                {"role": "system", "content": prompt_system},
-                {"role": "user", "content": prompt_user},
-            ],
-            "max_tokens": max_tokens,
-            "temperature": 0.2,
-        }
-
-        resp = requests.post(url, headers=headers, json=payload, timeout=20)
-        resp.raise_for_status()
-        logger.warning("LLM status=%s", resp.status_code)
-        data = resp.json()
-        content = data.get("choices", [{}])[0].get("message", {}).get("content", "")
-        if not content:
-            return "<p>(empty recap)</p>"
-        logger.warning("LLM content len=%s head=%r", len(content), content[:200])
+        check_deadline(deadline, "prompt")
+    except DeadlineExceeded:
+        return _recap_fallback(messages)
+    labelled = _recap_inputs(messages, model)
 
+    if not configured:
+        logger.warning("No LLM backend configured; returning fallback recap")
+        return _recap_fallback(labelled)
+
+    cache_key = make_cache_key("recap", model, RECAP_PROMPT_VERSION, max_tokens, labelled)
+    payload = _recap_payload(model, labelled, max_tokens)
+    try:
+        return await _acomplete(
+            "recap", cache_key, payload, 20, _recap_from_response, deadline=deadline, realm_id=realm_id
+        )
     except Exception:
-        logger.exception("LLM request failed; returning fallback recap")
-        joined = "\n\n---\n\n".join(labelled[:10])
-        return "<p><strong>Recap (fallback):</strong></p><pre>{}</pre>".format(escape(joined[:4000]))
+        _log_fallback("LLM request failed; returning fallback recap")
+        return _recap_fallback(labelled)
 
-    import bleach
 
-    ALLOWED_TAGS = [
-        "div","p","br","strong","em","ul","ol","li","a","code","pre","blockquote",
-        "h1","h2","h3","h4","h5","h6","span"
-    ]
-    ALLOWED_ATTRS = {
-        "a": ["href", "title", "target", "rel"],
-        "span": ["class"],
-        "div": ["class"],
-    }
-    
-    clean = bleach.clean(content, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRS, strip=True)
-    def strip_code_fence(s: str) -> str:
-        s = s.strip()
-        if s.startswith("```"):
-            s = s.split("\n", 1)[1]
-            s = s.rsplit("```", 1)[0]
-        return s.strip()
-    
-    content = strip_code_fence(content)
-    return f"<div class='ai-recap'>{clean}</div>"
+def stream_message_recap(
+    messages: List[str],
+    message_ids: List[int],
+    max_tokens: int = 800,
+    deadline: Optional[Deadline] = None,
+    realm_id: Optional[int] = None,
+) -> Iterator[str]:
+    """
+    Streaming variant of generate_message_recap. Yields sanitized HTML blocks
+    as soon as each one is complete; the concatenation wrapped in
+    <div class='ai-recap'> equals the cached recap.
+    """
+    if not messages:
+        yield "<p>(no messages)</p>"
+        return
+
+    configured, model = _llm_config("LLM_MODEL", "gpt-4o-mini")
+    try:
+        check_deadline(deadline, "prompt")
+    except DeadlineExceeded:
+        yield _recap_fallback(messages)
+        return
+    labelled = _recap_inputs(messages, model)
+
+    if not configured:
+        logger.warning("No LLM backend configured; returning fallback recap")
+        yield _recap_fallback(labelled)
+        return
+
+    cache_key = make_cache_key("recap", model, RECAP_PROMPT_VERSION, max_tokens, labelled)
+    cached = _cache_lookup(cache_key)
+    if cached is not None:
+        yield cached
+        return
+
+    start = time.monotonic()
+    splitter = _RecapBlockSplitter()
+    emitted: List[str] = []
+    try:
+        payload = _recap_payload(model, labelled, max_tokens)
+        timeout = llm_timeout(deadline, 20)
+        charge_realm(realm_id, payload)
+        with get_llm_limiter().slot(timeout, lane_for("recap"), realm_id, realm_weight(realm_id)):
+            for delta in _stream_chat_completion(payload, timeout=timeout):
+                for block in splitter.feed(delta):
+                    check_deadline(deadline, "sanitize")
+                    clean = _sanitize_recap_html(block)
+                    if not emitted:
+                        ai_metrics.timing("ai.recap.stream.ttfc_ms", (time.monotonic() - start) * 1000)
+                    emitted.append(clean)
+                    yield clean
+        for block in splitter.flush():
+            clean = _sanitize_recap_html(block)
+            emitted.append(clean)
+            yield clean
+    except Exception:
+        _log_fallback("LLM stream failed; returning fallback recap")
+        if emitted:
+            yield "<p><em>(recap interrupted)</em></p>"
+        else:
+            yield _recap_fallback(labelled)
+        return
+
+    if not emitted:
+        yield "<p>(empty recap)</p>"
+        return
+    _cache_store(cache_key, "<div class='ai-recap'>{}</div>".format("".join(emitted)))
+
+
+def summarize_recap_chunk(
+    label: str,
+    messages: List[str],
+    max_tokens: int = 300,
+    deadline: Optional[Deadline] = None,
+    realm_id: Optional[int] = None,
+) -> str:
+    """
+    Map step of the hierarchical recap: summarize one chunk of a single
+    conversation into a sanitized HTML section (not wrapped in ai-recap).
+    """
+    configured, model = _llm_config("LLM_MODEL", "gpt-4o-mini")
+    labelled = _recap_inputs(messages, model)
+    if not configured or not labelled:
+        return _recap_section_fallback(label, labelled)
+
+    cache_key = make_cache_key("recap_map", model, RECAP_PROMPT_VERSION, max_tokens, labelled, extra=label)
+    payload = _recap_payload(
+        model, labelled, max_tokens, system_prompt=RECAP_MAP_SYSTEM_PROMPT, header=f"Conversation: {label}"
+    )
+    try:
+        return _complete(
+            "recap_map",
+            cache_key,
+            payload,
+            20,
+            _recap_section_from_response,
+            deadline=deadline,
+            realm_id=realm_id,
+        )
+    except Exception:
+        _log_fallback("Recap map step failed for %r; using fallback section", label)
+        return _recap_section_fallback(label, labelled)
+
+
+def reduce_recap_sections(
+    sections: List[str],
+    max_tokens: int = 800,
+    deadline: Optional[Deadline] = None,
+    realm_id: Optional[int] = None,
+) -> str:
+    """
+    Reduce step: merge partial recap sections into one sanitized HTML
+    fragment. Falls back to concatenating the sections.
+    """
+    if len(sections) <= 1:
+        return "".join(sections)
+    configured, model = _llm_config("LLM_MODEL", "gpt-4o-mini")
+    if not configured:
+        return "".join(sections)
+
+    packed = pack_items(
+        sections, _prompt_budget(model, RECAP_REDUCE_SYSTEM_PROMPT), get_token_counter(model)
+    )
+    _record_prompt_tokens("recap_reduce", model, packed)
+    cache_key = make_cache_key("recap_reduce", model, RECAP_PROMPT_VERSION, max_tokens, packed.texts)
+    payload = _recap_payload(
+        model, packed.texts, max_tokens, system_prompt=RECAP_REDUCE_SYSTEM_PROMPT, header="Partial recaps:"
+    )
+    try:
+        return _complete(
+            "recap_reduce",
+            cache_key,
+            payload,
+            20,
+            _recap_section_from_response,
+            deadline=deadline,
+            realm_id=realm_id,
+        )
+    except Exception:
+        _log_fallback("Recap reduce step failed; concatenating sections")
+        return "".join(sections)
+
+
+def roll_topic_summary(
+    label: str,
+    previous_html: str,
+    messages: List[str],
+    max_tokens: int = 400,
+    realm_id: Optional[int] = None,
+    deadline: Optional[Deadline] = None,
+) -> str:
+    """
+    Fold `messages` into a topic's running summary and return the new
+    sanitized HTML section. On failure (or once `deadline` is spent) the
+    previous summary is extended with a fallback section, so the summary
+    never loses coverage.
+    """
+    configured, model = _llm_config("LLM_MODEL", "gpt-4o-mini")
+    count = get_token_counter(model)
+    budget = _prompt_budget(model, TOPIC_SUMMARY_SYSTEM_PROMPT) - count(previous_html)
+    packed = pack_items(messages, budget, count, max_item_tokens=RECAP_MAX_MESSAGE_TOKENS)
+    _record_prompt_tokens("topic_summary", model, packed)
+    if not configured or not packed.texts:
+        return previous_html + _recap_section_fallback(label, packed.texts)
+
+    header = f"Conversation: {label}\n\nPrevious summary:\n{previous_html or '(none)'}\n\nNew messages:"
+    cache_key = make_cache_key(
+        "topic_summary", model, RECAP_PROMPT_VERSION, max_tokens, packed.texts, extra=label + previous_html
+    )
+    payload = _recap_payload(
+        model, packed.texts, max_tokens, system_prompt=TOPIC_SUMMARY_SYSTEM_PROMPT, header=header
+    )
+    try:
+        return _complete(
+            "topic_summary",
+            cache_key,
+            payload,
+            20,
+            _recap_section_from_response,
+            deadline=deadline,
+            realm_id=realm_id,
+        )
+    except Exception:
+        _log_fallback("Rolling topic summary failed for %r", label)
+        return previous_html + _recap_section_fallback(label, packed.texts)
+
 
 # New: low-cost topic title suggestion optimized for scale
-def suggest_topic_title(messages: List[str], current_title: Optional[str] = None, max_tokens: int = 64) -> str:
+def llm_topic_title(
+    messages: List[str],
+    current_title: Optional[str] = None,
+    max_tokens: int = 64,
+    deadline: Optional[Deadline] = None,
+    realm_id: Optional[int] = None,
+    background: bool = False,
+) -> Optional[str]:
     """
-    Suggest a concise single-line topic/title for the conversation represented by `messages`.
+    The LLM's concise single-line topic/title for the conversation represented by `messages`,
+    or None when the LLM did not answer (not configured, failed, or out of time); callers
+    that share or store suggestions must not store a heuristic in its place.
     Uses a cheaper model and tight token limits to be cost/latency conscious.
-    Returns a plain string (no HTML). Always returns a short, cleaned fallback if the LLM call fails.
+    With AI_TOPIC_BATCHING, concurrent requests share one LLM call.
+    `background` (precomputation) runs as "topic_background" in the bulk lane,
+    unbatched; it shares the cache with interactive requests.
+    """
+    configured, model = _llm_config("LLM_TOPIC_MODEL", "gpt-3.5-turbo")  # default cheaper model
+    if not messages or not configured:
+        return None
+    try:
+        # Defensive truncation: keep recent context, but bound input size
+        check_deadline(deadline, "prompt")
+        labelled = _topic_inputs(messages, model)
+        cache_key = make_cache_key(
+            "topic", model, TOPIC_PROMPT_VERSION, max_tokens, labelled, extra=current_title
+        )
+        payload = _topic_payload(model, labelled, current_title, max_tokens)
+        charged = False
+        if topic_batching_enabled() and not background:
+            item = _TopicBatchItem(
+                model, labelled, current_title, max_tokens, cache_key, _topic_batch_timeout(deadline)
+            )
+            batched = _batched_topic_title(item, payload, realm_id)
+            if batched is not None:
+                return batched
+            charged = True
+        return _complete(
+            "topic_background" if background else "topic",
+            cache_key,
+            payload,
+            10,
+            _topic_from_response,
+            deadline=deadline,
+            realm_id=realm_id,
+            charged=charged,
+        )
+    except Exception:
+        _log_fallback("Topic suggestion LLM failed")
+        return None
+
+
+def suggest_topic_title(
+    messages: List[str],
+    current_title: Optional[str] = None,
+    max_tokens: int = 64,
+    deadline: Optional[Deadline] = None,
+    realm_id: Optional[int] = None,
+    background: bool = False,
+) -> str:
+    """
+    llm_topic_title, or a short heuristic title (the latest message's first line)
+    when the LLM did not answer. Returns a plain string (no HTML).
     """
-    # Defensive truncation: keep recent context, but bound input size
     if not messages:
         return ""
+    title = llm_topic_title(messages, current_title, max_tokens, deadline, realm_id, background)
+    return title if title is not None else topic_fallback_title(messages, current_title)
 
-    api_key: Optional[str] = getattr(settings, "LLM_API_KEY", None)
-    provider: str = getattr(settings, "LLM_PROVIDER", "openai")
-    model: str = getattr(settings, "LLM_TOPIC_MODEL", "gpt-3.5-turbo")  # default cheaper model
+
+async def allm_topic_title(
+    messages: List[str],
+    current_title: Optional[str] = None,
+    max_tokens: int = 64,
+    deadline: Optional[Deadline] = None,
+    realm_id: Optional[int] = None,
+) -> Optional[str]:
+    """
+    Async version of llm_topic_title.
+    """
+    configured, model = _llm_config("LLM_TOPIC_MODEL", "gpt-3.5-turbo")
+    if not messages or not configured:
+        return None
     try:
-        labelled = []
-        # Prefer the most recent messages to detect "drift" quickly
-        recent = messages[-30:]  # cap number of messages to include
-        for text in recent:
-            labelled.append(text[:800])  # cap per-message length
-        prompt_system = (
-            "You generate short Zulip topic titles.\n"
-            "Return ONLY the title text (no quotes, no markdown).\n"
-            "Keep it <= 60 characters.\n"
-            "Do NOT reuse boilerplate prefixes from the current topic (e.g., 'Changing focus to', 'Topic shift:', 'New topic:', 'Discussion:').\n"
-            "Write the title as a neutral noun phrase describing the subject.\n"
-            "If the current topic is still accurate, return an empty string."
+        check_deadline(deadline, "prompt")
+        labelled = _topic_inputs(messages, model)
+        cache_key = make_cache_key(
+            "topic", model, TOPIC_PROMPT_VERSION, max_tokens, labelled, extra=current_title
+        )
+        payload = _topic_payload(model, labelled, current_title, max_tokens)
+        charged = False
+        if topic_batching_enabled():
+            item = _TopicBatchItem(
+                model, labelled, current_title, max_tokens, cache_key, _topic_batch_timeout(deadline)
+            )
+            batched = await _abatched_topic_title(item, payload, realm_id)
+            if batched is not None:
+                return batched
+            charged = True
+        return await _acomplete(
+            "topic",
+            cache_key,
+            payload,
+            10,
+            _topic_from_response,
+            deadline=deadline,
+            realm_id=realm_id,
+            charged=charged,
         )
-
-        user_parts = [
-            f"Current topic: {current_title}",
-            "",
-            "Recent messages:",
-            *messages,
-            "",
-            "Suggest a better topic title if the discussion focus has changed."
-        ]
-        if current_title:
-            user_parts.append(f"Current title: {current_title}\n")
-        user_parts.append("Recent messages:\n")
-        user_parts.append("\n\n---\n\n".join(labelled))
-        prompt_user = "\n".join(user_parts)
-
-        if not api_key:
-            # Fallback: try to heuristically craft a title from first sentence of the latest message(s)
-            candidate = labelled[-1].split("\n", 1)[0].strip()[:60]
-            return candidate or (current_title or "")
-
-        if provider != "openai":
-            raise RuntimeError(f"Unsupported LLM_PROVIDER: {provider}")
-
-        url = "https://api.openai.com/v1/chat/completions"
-        headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
-        payload = {
-            "model": model,
-            "messages": [
-                {"role": "system", "content": prompt_system},
-                {"role": "user", "content": prompt_user},
-            ],
-            "max_tokens": max_tokens,
-            "temperature": 0.0,
-        }
-
-        resp = requests.post(url, headers=headers, json=payload, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-        content = data.get("choices", [{}])[0].get("message", {}).get("content", "") or ""
-        suggestion = content.strip().splitlines()[0][:60]
-        # final sanity: remove angle brackets / excessive whitespace
-        suggestion = suggestion.replace("\n", " ").strip()
-        return suggestion
     except Exception:
-        logger.exception("Topic suggestion LLM failed; using fallback heuristic")
-        candidate = (messages[-1].split("\n", 1)[0].strip()[:60]) if messages else ""
-        return candidate or (current_title or "")
+        _log_fallback("Topic suggestion LLM failed")
+        return None
 
+
+async def asuggest_topic_title(
+    messages: List[str],
+    current_title: Optional[str] = None,
+    max_tokens: int = 64,
+    deadline: Optional[Deadline] = None,
+    realm_id: Optional[int] = None,
+) -> str:
+    """
+    Async version of suggest_topic_title.
+    """
+    if not messages:
+        return ""
+    title = await allm_topic_title(messages, current_title, max_tokens, deadline, realm_id)
+    return title if title is not None else topic_fallback_title(messages, current_title)
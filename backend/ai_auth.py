@@ -0,0 +1,53 @@
+from asgiref.sync import sync_to_async
+from django.http import HttpRequest
+from django.middleware.csrf import CsrfViewMiddleware
+from django.utils.translation import gettext as _
+
+from zerver.decorator import (
+    get_basic_credentials,
+    process_client,
+    validate_account_and_subdomain,
+    validate_api_key,
+)
+from zerver.lib.exceptions import CsrfFailureError, JsonableError, UnauthorizedError
+from zerver.models import UserProfile
+
+
+def _check_csrf(request: HttpRequest) -> None:
+    # Session clients get the CSRF check rest_dispatch applies to them.
+    rejected = CsrfViewMiddleware(lambda request: None).process_view(request, None, (), {})  # type: ignore[arg-type]
+    if rejected is not None:
+        raise CsrfFailureError(_("CSRF token missing or incorrect."))
+
+
+def _authenticate(request: HttpRequest) -> UserProfile:
+    """
+    The two ways rest_dispatch accepts a request: a logged-in session (with
+    its CSRF check) or HTTP basic auth with an API key.
+    """
+    if request.user.is_authenticated:
+        _check_csrf(request)
+        user = request.user
+        assert isinstance(user, UserProfile)
+        validate_account_and_subdomain(request, user)
+        process_client(request, user, is_browser_view=True)
+        return user
+    if "Authorization" in request.headers:
+        role, api_key = get_basic_credentials(request)
+        user_or_server = validate_api_key(request, role, api_key)
+        if isinstance(user_or_server, UserProfile):
+            return user_or_server
+    raise UnauthorizedError
+
+
+async def async_view_user(request: HttpRequest, humans_only: bool = False) -> UserProfile:
+    """
+    Authenticate a request for an async AI view, as rest_dispatch does for
+    the sync views (it cannot dispatch to a coroutine). The session and
+    cache lookups run on a thread. Unauthenticated requests get Zulip's
+    401. With `humans_only`, bots are rejected as human_users_only does.
+    """
+    user = await sync_to_async(_authenticate)(request)
+    if humans_only and user.is_bot:
+        raise JsonableError(_("This endpoint does not accept bot requests."))
+    return user
@@ -0,0 +1,461 @@
+import abc
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from zerver.lib import ai_metrics
+from zerver.lib.ai_circuit import (
+    CircuitOpenError,
+    circuit_breaker_enabled,
+    counts_as_failure,
+    get_circuit_breaker,
+    llm_circuit,
+)
+from zerver.lib.ai_http import get_async_llm_client, get_llm_session
+from zerver.lib.ai_ratelimit import ProviderPacer
+
+logger = logging.getLogger(__name__)
+
+OPENAI_BASE_URL = "https://api.openai.com/v1"
+ANTHROPIC_BASE_URL = "https://api.anthropic.com"
+ANTHROPIC_VERSION = "2023-06-01"
+
+
+class LLMBackend(abc.ABC):
+    """
+    One chat-completion provider. Requests and responses use the OpenAI chat
+    completion shape ({"model", "messages", "max_tokens", ...} in,
+    {"choices": [{"message": {"content"}}], "usage"} out); backends for other
+    APIs translate both ways, so callers never see provider differences.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        base_url: str,
+        api_key: Optional[str] = None,
+        model_map: Optional[Dict[str, str]] = None,
+        default_model: Optional[str] = None,
+        rpm: Optional[int] = None,
+        tpm: Optional[int] = None,
+    ) -> None:
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.model_map = model_map or {}
+        self.default_model = default_model
+        # The provider's requests / tokens per minute for our account.
+        self.rpm = rpm
+        self.tpm = tpm
+
+    def model_for(self, model: str) -> str:
+        return self.model_map.get(model, self.default_model or model)
+
+    @abc.abstractmethod
+    def complete(self, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]: ...
+
+    @abc.abstractmethod
+    async def acomplete(self, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]: ...
+
+    @abc.abstractmethod
+    def stream(self, payload: Dict[str, Any], timeout: float) -> Iterator[str]:
+        """
+        Yield content deltas. `timeout` bounds connect and each gap between
+        chunks, not the whole stream.
+        """
+
+
+def _sse_data(lines: Iterator[str]) -> Iterator[str]:
+    for line in lines:
+        if line and line.startswith("data:"):
+            yield line[len("data:"):].strip()
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    """
+    OpenAI's /chat/completions API, or anything that speaks it (vLLM,
+    llama.cpp server, Ollama, a local stand-in for tests) at `base_url`.
+    """
+
+    def _url(self) -> str:
+        return f"{self.base_url}/chat/completions"
+
+    def _headers(self) -> Dict[str, str]:
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def _body(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return dict(payload, model=self.model_for(payload["model"]))
+
+    def complete(self, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        resp = get_llm_session().post(self._url(), headers=self._headers(), json=self._body(payload), timeout=timeout)
+        resp.raise_for_status()
+        return resp.json()
+
+    async def acomplete(self, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        resp = await get_async_llm_client().post(
+            self._url(), headers=self._headers(), json=self._body(payload), timeout=timeout
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    def stream(self, payload: Dict[str, Any], timeout: float) -> Iterator[str]:
+        body = dict(self._body(payload), stream=True)
+        with get_llm_session().post(
+            self._url(), headers=self._headers(), json=body, timeout=timeout, stream=True
+        ) as resp:
+            resp.raise_for_status()
+            # text/event-stream has no charset; requests would otherwise assume latin-1.
+            resp.encoding = "utf-8"
+            for data in _sse_data(resp.iter_lines(decode_unicode=True)):
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                delta = chunk.get("choices", [{}])[0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+
+
+class AnthropicBackend(LLMBackend):
+    """
+    Anthropic's Messages API: the system prompt is a top-level field and the
+    reply is a list of content blocks.
+    """
+
+    def _url(self) -> str:
+        return f"{self.base_url}/v1/messages"
+
+    def _headers(self) -> Dict[str, str]:
+        return {
+            "x-api-key": self.api_key or "",
+            "anthropic-version": ANTHROPIC_VERSION,
+            "Content-Type": "application/json",
+        }
+
+    def _body(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        system = "\n".join(m["content"] for m in payload["messages"] if m["role"] == "system")
+        body: Dict[str, Any] = {
+            "model": self.model_for(payload["model"]),
+            "max_tokens": payload.get("max_tokens", 1024),
+            "messages": [m for m in payload["messages"] if m["role"] != "system"],
+        }
+        if system:
+            body["system"] = system
+        if "temperature" in payload:
+            body["temperature"] = payload["temperature"]
+        return body
+
+    @staticmethod
+    def _to_openai(data: Dict[str, Any]) -> Dict[str, Any]:
+        text = "".join(block.get("text", "") for block in data.get("content", []) if block.get("type") == "text")
+        usage = data.get("usage", {})
+        prompt_tokens = usage.get("input_tokens", 0)
+        completion_tokens = usage.get("output_tokens", 0)
+        return {
+            "choices": [{"message": {"role": "assistant", "content": text}, "finish_reason": data.get("stop_reason")}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+            "model": data.get("model"),
+        }
+
+    def complete(self, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        resp = get_llm_session().post(self._url(), headers=self._headers(), json=self._body(payload), timeout=timeout)
+        resp.raise_for_status()
+        return self._to_openai(resp.json())
+
+    async def acomplete(self, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        resp = await get_async_llm_client().post(
+            self._url(), headers=self._headers(), json=self._body(payload), timeout=timeout
+        )
+        resp.raise_for_status()
+        return self._to_openai(resp.json())
+
+    def stream(self, payload: Dict[str, Any], timeout: float) -> Iterator[str]:
+        body = dict(self._body(payload), stream=True)
+        with get_llm_session().post(
+            self._url(), headers=self._headers(), json=body, timeout=timeout, stream=True
+        ) as resp:
+            resp.raise_for_status()
+            resp.encoding = "utf-8"
+            for data in _sse_data(resp.iter_lines(decode_unicode=True)):
+                event = json.loads(data)
+                if event.get("type") == "message_stop":
+                    break
+                if event.get("type") == "content_block_delta":
+                    text = event.get("delta", {}).get("text")
+                    if text:
+                        yield text
+
+
+BACKEND_TYPES = {
+    "openai": (OpenAICompatibleBackend, OPENAI_BASE_URL),
+    "openai_compatible": (OpenAICompatibleBackend, OPENAI_BASE_URL),
+    "anthropic": (AnthropicBackend, ANTHROPIC_BASE_URL),
+}
+
+
+def build_backend(config: Dict[str, Any]) -> LLMBackend:
+    backend_type = config.get("type", "openai")
+    if backend_type not in BACKEND_TYPES:
+        raise RuntimeError(f"Unsupported LLM backend type: {backend_type}")
+    cls, default_base_url = BACKEND_TYPES[backend_type]
+    return cls(
+        name=config.get("name", backend_type),
+        base_url=config.get("base_url") or default_base_url,
+        api_key=config.get("api_key"),
+        model_map=config.get("model_map"),
+        default_model=config.get("default_model"),
+        rpm=config.get("rpm"),
+        tpm=config.get("tpm"),
+    )
+
+
+def _backend_configs() -> List[Dict[str, Any]]:
+    """
+    LLM_BACKENDS, in priority order, e.g.
+        [{"name": "openai", "type": "openai", "api_key": "..."},
+         {"name": "local", "type": "openai_compatible", "base_url": "http://127.0.0.1:8080/v1"},
+         {"name": "anthropic", "type": "anthropic", "api_key": "...",
+          "default_model": "claude-3-5-haiku-latest"}]
+    "rpm" / "tpm" give the provider's per-minute limits for the account;
+    calls from every process are paced to stay under them.
+    Without it, one backend is built from LLM_PROVIDER, LLM_API_KEY,
+    LLM_BASE_URL, LLM_RPM and LLM_TPM; with no API key and no base URL,
+    nothing is configured.
+    """
+    configs: Optional[List[Dict[str, Any]]] = getattr(settings, "LLM_BACKENDS", None)
+    if configs is not None:
+        return configs
+    api_key: Optional[str] = getattr(settings, "LLM_API_KEY", None)
+    base_url: Optional[str] = getattr(settings, "LLM_BASE_URL", None)
+    if not api_key and not base_url:
+        return []
+    provider: str = getattr(settings, "LLM_PROVIDER", "openai")
+    return [
+        {
+            "name": provider,
+            "type": provider,
+            "api_key": api_key,
+            "base_url": base_url,
+            "rpm": getattr(settings, "LLM_RPM", None),
+            "tpm": getattr(settings, "LLM_TPM", None),
+        }
+    ]
+
+
+class BackendRouter:
+    """
+    Sends each call to the best healthy backend and fails over to the next
+    on provider errors. Health is the backend's circuit breaker; order is
+    configuration order (LLM_ROUTING="priority") or lowest smoothed latency
+    first (LLM_ROUTING="latency"; unmeasured backends are tried early so
+    they get measured). A backend with "rpm" / "tpm" limits is paced
+    cluster-wide; one that cannot take the call within its timeout is
+    skipped for the next.
+    """
+
+    def __init__(self, backends: List[LLMBackend], routing: str = "priority", alpha: float = 0.2) -> None:
+        self.backends = backends
+        self.routing = routing
+        self.alpha = alpha
+        self._latency: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._pacers: Dict[str, ProviderPacer] = {
+            b.name: ProviderPacer(b.name, b.rpm, b.tpm) for b in backends if b.rpm or b.tpm
+        }
+
+    def _healthy(self, backend: LLMBackend) -> bool:
+        return not (circuit_breaker_enabled() and get_circuit_breaker(backend.name).is_open())
+
+    def candidates(self) -> List[LLMBackend]:
+        healthy = [b for b in self.backends if self._healthy(b)]
+        if not healthy:
+            ai_metrics.incr("ai.backend.all_unavailable")
+        if self.routing == "latency":
+            order = {b.name: i for i, b in enumerate(self.backends)}
+            healthy.sort(key=lambda b: (self._latency.get(b.name, 0.0), order[b.name]))
+        return healthy
+
+    def all_open(self) -> bool:
+        return not self.candidates()
+
+    def record_latency(self, backend: LLMBackend, seconds: float) -> None:
+        with self._lock:
+            previous = self._latency.get(backend.name)
+            self._latency[backend.name] = (
+                seconds if previous is None else previous + self.alpha * (seconds - previous)
+            )
+        ai_metrics.timing(f"ai.backend.{backend.name}.latency_ms", seconds * 1000)
+
+    def latencies(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._latency)
+
+    def _reserve(self, backend: LLMBackend, payload: Dict[str, Any], time_left: float) -> Tuple[float, int]:
+        pacer = self._pacers.get(backend.name)
+        return pacer.reserve(payload, time_left) if pacer is not None else (0.0, 0)
+
+    def _settle(self, backend: LLMBackend, charged: int, data: Dict[str, Any]) -> None:
+        pacer = self._pacers.get(backend.name)
+        if pacer is not None:
+            pacer.settle(charged, data)
+
+    def _refund(self, backend: LLMBackend, charged: int) -> None:
+        pacer = self._pacers.get(backend.name)
+        if pacer is not None:
+            pacer.refund(charged)
+
+    # The pacer's shared-cache I/O (and lock polling) runs on a thread in
+    # the async path, not on the event loop.
+    async def _areserve(
+        self, backend: LLMBackend, payload: Dict[str, Any], time_left: float
+    ) -> Tuple[float, int]:
+        return await sync_to_async(self._reserve, thread_sensitive=False)(backend, payload, time_left)
+
+    async def _asettle(self, backend: LLMBackend, charged: int, data: Dict[str, Any]) -> None:
+        await sync_to_async(self._settle, thread_sensitive=False)(backend, charged, data)
+
+    async def _arefund(self, backend: LLMBackend, charged: int) -> None:
+        if charged:
+            await sync_to_async(self._refund, thread_sensitive=False)(backend, charged)
+
+    def _give_up(self, backend: LLMBackend, exc: Exception, remaining: List[LLMBackend]) -> bool:
+        # Our own errors (4xx) would fail everywhere; do not fail over on them.
+        if not remaining or not counts_as_failure(exc):
+            return True
+        ai_metrics.incr(f"ai.backend.{backend.name}.failover")
+        logger.warning("LLM backend %s failed (%s); failing over to %s", backend.name, exc, remaining[0].name)
+        return False
+
+    def complete(self, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        deadline = time.monotonic() + timeout
+        candidates = self.candidates()
+        if not candidates:
+            raise CircuitOpenError("llm")
+        for i, backend in enumerate(candidates):
+            charged = 0
+            try:
+                wait, charged = self._reserve(backend, payload, deadline - time.monotonic())
+                if wait:
+                    time.sleep(wait)
+                start = time.monotonic()
+                with llm_circuit(backend.name):
+                    data = backend.complete(payload, deadline - start)
+            except Exception as e:
+                self._refund(backend, charged)
+                if self._give_up(backend, e, candidates[i + 1 :]):
+                    raise
+                continue
+            self.record_latency(backend, time.monotonic() - start)
+            self._settle(backend, charged, data)
+            ai_metrics.incr(f"ai.backend.{backend.name}.requests")
+            return data
+        raise AssertionError("unreachable")
+
+    async def acomplete(self, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        deadline = time.monotonic() + timeout
+        candidates = self.candidates()
+        if not candidates:
+            raise CircuitOpenError("llm")
+        for i, backend in enumerate(candidates):
+            charged = 0
+            try:
+                wait, charged = await self._areserve(backend, payload, deadline - time.monotonic())
+                if wait:
+                    await asyncio.sleep(wait)
+                start = time.monotonic()
+                with llm_circuit(backend.name):
+                    data = await backend.acomplete(payload, deadline - start)
+            except Exception as e:
+                await self._arefund(backend, charged)
+                if self._give_up(backend, e, candidates[i + 1 :]):
+                    raise
+                continue
+            self.record_latency(backend, time.monotonic() - start)
+            await self._asettle(backend, charged, data)
+            ai_metrics.incr(f"ai.backend.{backend.name}.requests")
+            return data
+        raise AssertionError("unreachable")
+
+    def stream(self, payload: Dict[str, Any], timeout: float) -> Iterator[str]:
+        """
+        Stream from the first backend that produces a first chunk. Failover
+        only happens before that; once content has been yielded, errors
+        propagate. Breakers judge time to first chunk. Streamed responses
+        carry no usage, so once one starts its estimated token charge stands.
+        """
+        candidates = self.candidates()
+        if not candidates:
+            raise CircuitOpenError("llm")
+        for i, backend in enumerate(candidates):
+            try:
+                wait, charged = self._reserve(backend, payload, timeout)
+            except Exception as e:
+                if self._give_up(backend, e, candidates[i + 1 :]):
+                    raise
+                continue
+            if wait:
+                time.sleep(wait)
+            start = time.monotonic()
+            deltas = backend.stream(payload, timeout)
+            try:
+                with llm_circuit(backend.name):
+                    first = next(deltas, None)
+            except Exception as e:
+                self._refund(backend, charged)
+                if self._give_up(backend, e, candidates[i + 1 :]):
+                    raise
+                continue
+            self.record_latency(backend, time.monotonic() - start)
+            ai_metrics.incr(f"ai.backend.{backend.name}.requests")
+            yield from itertools.chain([first] if first is not None else [], deltas)
+            return
+
+
+_router: Optional[BackendRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_backend_router() -> BackendRouter:
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = BackendRouter(
+                    [build_backend(config) for config in _backend_configs()],
+                    routing=getattr(settings, "LLM_ROUTING", "priority"),
+                )
+    return _router
+
+
+def llm_configured() -> bool:
+    return bool(get_backend_router().backends)
+
+
+def reset_backend_router() -> None:
+    global _router
+    with _router_lock:
+        _router = None
+
+
+def backend_status() -> List[Tuple[str, str, Optional[float]]]:
+    """
+    (name, breaker state, smoothed latency in seconds) per backend.
+    """
+    router = get_backend_router()
+    latencies = router.latencies()
+    return [
+        (b.name, get_circuit_breaker(b.name).state, latencies.get(b.name)) for b in router.backends
+    ]
@@ -0,0 +1,103 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Generic, List, Optional, Tuple, TypeVar
+
+from zerver.lib import ai_metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class _Batch(Generic[T, R]):
+    def __init__(self) -> None:
+        self.items: List[Tuple[T, "Future[R]"]] = []
+        self.dispatched = False
+        self.timer: Optional[threading.Timer] = None
+
+
+class MicroBatcher(Generic[T, R]):
+    """
+    Collects items submitted from any thread for up to `window` seconds (or
+    until `max_size` are waiting) and hands them to `run_batch` in one call,
+    which returns one result per item, in order. Each submitter gets a
+    Future for its own result; if `run_batch` raises, every item in the
+    batch gets the exception.
+
+    The window is timed by a timer thread per open batch; the `threads`
+    workers only run batches, so a slow `run_batch` does not hold up the
+    collection of the next ones. Sync callers block on Future.result() and
+    async callers await asyncio.wrap_future(). A caller that gives up should
+    cancel its Future: items cancelled before their batch starts are left
+    out of it.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        run_batch: Callable[[List[T]], List[R]],
+        window: float,
+        max_size: int,
+        threads: int = 4,
+    ) -> None:
+        self.name = name
+        self.run_batch = run_batch
+        self.window = window
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._open: Optional[_Batch[T, R]] = None
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=f"ai-batch-{name}")
+
+    def submit(self, item: T) -> "Future[R]":
+        future: "Future[R]" = Future()
+        with self._lock:
+            batch = self._open
+            if batch is None:
+                batch = self._open = _Batch()
+                batch.timer = threading.Timer(self.window, self._dispatch, [batch])
+                batch.timer.daemon = True
+                batch.timer.start()
+            batch.items.append((item, future))
+            full = len(batch.items) >= self.max_size
+        if full:
+            self._dispatch(batch)
+        return future
+
+    def _dispatch(self, batch: _Batch[T, R]) -> None:
+        with self._lock:
+            if batch.dispatched:
+                return
+            batch.dispatched = True
+            if self._open is batch:
+                self._open = None
+        # Closed: nothing is appended to `batch` from here on.
+        if batch.timer is not None:
+            batch.timer.cancel()
+        self._executor.submit(self._run, batch)
+
+    def _run(self, batch: _Batch[T, R]) -> None:
+        # Leave out items whose callers gave up while the batch was queued.
+        live = [(item, future) for item, future in batch.items if future.set_running_or_notify_cancel()]
+        if len(live) < len(batch.items):
+            ai_metrics.incr(f"ai.{self.name}_batch.abandoned", len(batch.items) - len(live))
+        if not live:
+            return
+        ai_metrics.observe(f"ai.{self.name}_batch.size", len(live))
+        try:
+            results = self.run_batch([item for item, _ in live])
+        except BaseException as e:
+            for _, future in live:
+                _deliver(future.set_exception, e)
+            return
+        for (_, future), result in zip(live, results):
+            _deliver(future.set_result, result)
+
+
+def _deliver(setter: Callable[[Any], None], value: Any) -> None:
+    # One future that cannot take its result must not keep it from the rest.
+    try:
+        setter(value)
+    except Exception:
+        logger.warning("could not deliver a batch result", exc_info=True)
@@ -0,0 +1,163 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional, Protocol, Tuple
+
+from django.conf import settings
+
+from zerver.lib import ai_metrics
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY_PREFIX = "ai_result:"
+
+
+def make_cache_key(
+    kind: str,
+    model: str,
+    prompt_version: str,
+    max_tokens: int,
+    messages: Iterable[str],
+    extra: Optional[str] = None,
+) -> str:
+    """
+    Stable content hash for an LLM request. Fields are length-prefixed so
+    ("ab", "c") and ("a", "bc") never collide; message order matters.
+    """
+    h = hashlib.sha256()
+
+    def feed(value: str) -> None:
+        data = value.encode("utf-8")
+        h.update(str(len(data)).encode())
+        h.update(b":")
+        h.update(data)
+
+    for field in (kind, model, prompt_version, str(max_tokens), extra or ""):
+        feed(field)
+    for text in messages:
+        feed(text)
+    return f"{CACHE_KEY_PREFIX}{kind}:{h.hexdigest()}"
+
+
+class ResultCacheBackend(Protocol):
+    def get(self, key: str) -> Optional[str]: ...
+
+    def set(self, key: str, value: str, ttl: int) -> None: ...
+
+
+class LocalLRUBackend:
+    """
+    In-process LRU with per-entry TTL and a hard entry bound.
+    """
+
+    def __init__(self, max_entries: int = 1024) -> None:
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= now:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                ai_metrics.incr("ai.cache.evictions")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class DjangoCacheBackend:
+    """
+    Backed by a configured Django cache alias (memcached in production Zulip).
+    Size-bounded eviction is the cache server's own LRU.
+    """
+
+    def __init__(self, alias: str = "default") -> None:
+        from django.core.cache import caches
+
+        self.cache = caches[alias]
+
+    def get(self, key: str) -> Optional[str]:
+        return self.cache.get(key)
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        self.cache.set(key, value, timeout=ttl)
+
+
+class ResultCache:
+    def __init__(self, backend: ResultCacheBackend, ttl: int) -> None:
+        self.backend = backend
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[str]:
+        kind = key[len(CACHE_KEY_PREFIX):].split(":", 1)[0]
+        try:
+            value = self.backend.get(key)
+        except Exception:
+            logger.exception("AI result cache get failed")
+            value = None
+        if value is None:
+            ai_metrics.incr(f"ai.cache.{kind}.miss")
+        else:
+            ai_metrics.incr(f"ai.cache.{kind}.hit")
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        try:
+            self.backend.set(key, value, self.ttl)
+        except Exception:
+            logger.exception("AI result cache set failed")
+
+
+_result_cache: Optional[ResultCache] = None
+_result_cache_built = False
+_result_cache_lock = threading.Lock()
+
+
+def _build_result_cache() -> Optional[ResultCache]:
+    backend_name: Optional[str] = getattr(settings, "AI_RESULT_CACHE_BACKEND", "local")
+    ttl: int = getattr(settings, "AI_RESULT_CACHE_TTL", 3600)
+    if not backend_name:
+        return None
+    if backend_name == "local":
+        backend: ResultCacheBackend = LocalLRUBackend(getattr(settings, "AI_RESULT_CACHE_MAX_ENTRIES", 1024))
+    elif backend_name in ("django", "memcached"):
+        backend = DjangoCacheBackend(getattr(settings, "AI_RESULT_CACHE_ALIAS", "default"))
+    else:
+        raise RuntimeError(f"Unsupported AI_RESULT_CACHE_BACKEND: {backend_name}")
+    return ResultCache(backend, ttl)
+
+
+def get_result_cache() -> Optional[ResultCache]:
+    """
+    Process-wide result cache, or None when AI_RESULT_CACHE_BACKEND is falsy.
+    """
+    global _result_cache, _result_cache_built
+    if not _result_cache_built:
+        with _result_cache_lock:
+            if not _result_cache_built:
+                _result_cache = _build_result_cache()
+                _result_cache_built = True
+    return _result_cache
+
+
+def cache_stats() -> dict:
+    counters = ai_metrics.snapshot()["counters"]
+    return {k: v for k, v in counters.items() if k.startswith("ai.cache.")}
@@ -0,0 +1,243 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, Tuple
+
+from django.conf import settings
+
+from zerver.lib import ai_metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Exported as the ai.circuit.<name>.state gauge.
+STATE_GAUGE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling the provider while the breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Closed -> open when, over the last `window` seconds and at least
+    `min_calls` calls, the failure rate or the slow-call rate reaches its
+    threshold. Open -> half-open after `open_seconds`; half-open lets up to
+    `half_open_calls` probes through, closes once they all succeed and
+    re-opens on the first probe failure or slow probe.
+
+    allow() only takes a lock and reads the clock, so a rejected call costs
+    microseconds.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        window: float = 30.0,
+        min_calls: int = 10,
+        failure_rate: float = 0.5,
+        slow_call_seconds: float = 5.0,
+        slow_call_rate: float = 0.8,
+        open_seconds: float = 15.0,
+        half_open_calls: int = 2,
+    ) -> None:
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        # (finished_at, failed, slow), oldest first.
+        self._outcomes: Deque[Tuple[float, bool, bool]] = deque()
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            return self._state
+
+    def _transition(self, state: str, now: float) -> None:
+        # Caller holds the lock.
+        previous, self._state = self._state, state
+        if state == OPEN:
+            self._opened_at = now
+        if state != HALF_OPEN:
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+        if state == CLOSED:
+            self._outcomes.clear()
+        ai_metrics.incr(f"ai.circuit.{self.name}.{state}")
+        ai_metrics.set_gauge(f"ai.circuit.{self.name}.state", STATE_GAUGE_VALUES[state])
+        logger.warning("LLM circuit %r: %s -> %s", self.name, previous, state)
+
+    def _maybe_half_open(self, now: float) -> None:
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._transition(HALF_OPEN, now)
+
+    def allow(self) -> bool:
+        """
+        Whether a call may go to the provider now. A True from a half-open
+        breaker reserves a probe slot, which record_success/record_failure
+        releases.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._maybe_half_open(now)
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and self._probes_in_flight < self.half_open_calls:
+                self._probes_in_flight += 1
+                return True
+        ai_metrics.incr(f"ai.circuit.{self.name}.rejected")
+        return False
+
+    def is_open(self) -> bool:
+        """
+        Cheap pre-check that reserves nothing: True only while fully open.
+        """
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            return self._state == OPEN
+
+    def check(self) -> None:
+        if not self.allow():
+            raise CircuitOpenError(self.name)
+
+    @contextmanager
+    def guard(self) -> Iterator[None]:
+        """
+        Wrap one provider call: raise CircuitOpenError if it may not go out,
+        otherwise record its outcome and latency.
+        """
+        self.check()
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            if counts_as_failure(e):
+                self.record_failure()
+            else:
+                self.record_success(time.monotonic() - start)
+            raise
+        except BaseException:
+            # Cancelled (client went away, task cancelled): no verdict on the provider.
+            self.release()
+            raise
+        self.record_success(time.monotonic() - start)
+
+    def release(self) -> None:
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def record_success(self, elapsed: float) -> None:
+        self._record(failed=False, slow=elapsed >= self.slow_call_seconds)
+
+    def record_failure(self) -> None:
+        self._record(failed=True, slow=False)
+
+    def _record(self, failed: bool, slow: bool) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if failed or slow:
+                    self._transition(OPEN, now)
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_calls:
+                    self._transition(CLOSED, now)
+                return
+            if self._state == OPEN:
+                # A call admitted before the breaker opened.
+                return
+
+            self._outcomes.append((now, failed, slow))
+            while self._outcomes and self._outcomes[0][0] < now - self.window:
+                self._outcomes.popleft()
+            calls = len(self._outcomes)
+            if calls < self.min_calls:
+                return
+            failures = sum(1 for _, f, _ in self._outcomes if f)
+            slow_calls = sum(1 for _, _, s in self._outcomes if s)
+            if failures / calls >= self.failure_rate or slow_calls / calls >= self.slow_call_rate:
+                self._transition(OPEN, now)
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name: str = "llm") -> CircuitBreaker:
+    """
+    Process-wide breaker shared by every caller of the provider `name`.
+    Tuned with AI_CIRCUIT_* settings; AI_CIRCUIT_BREAKER=False disables it.
+    """
+    breaker = _breakers.get(name)
+    if breaker is not None:
+        return breaker
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(
+                name,
+                window=getattr(settings, "AI_CIRCUIT_WINDOW_SECONDS", 30.0),
+                min_calls=getattr(settings, "AI_CIRCUIT_MIN_CALLS", 10),
+                failure_rate=getattr(settings, "AI_CIRCUIT_FAILURE_RATE", 0.5),
+                slow_call_seconds=getattr(settings, "AI_CIRCUIT_SLOW_CALL_SECONDS", 5.0),
+                slow_call_rate=getattr(settings, "AI_CIRCUIT_SLOW_CALL_RATE", 0.8),
+                open_seconds=getattr(settings, "AI_CIRCUIT_OPEN_SECONDS", 15.0),
+                half_open_calls=getattr(settings, "AI_CIRCUIT_HALF_OPEN_CALLS", 2),
+            )
+        return _breakers[name]
+
+
+def circuit_breaker_enabled() -> bool:
+    return getattr(settings, "AI_CIRCUIT_BREAKER", True)
+
+
+@contextmanager
+def llm_circuit(name: str = "llm") -> Iterator[None]:
+    """
+    get_circuit_breaker(name).guard(), or a no-op when the breaker is disabled.
+    """
+    if not circuit_breaker_enabled():
+        yield
+        return
+    with get_circuit_breaker(name).guard():
+        yield
+
+
+def circuit_states() -> Dict[str, str]:
+    return {name: breaker.state for name, breaker in list(_breakers.items())}
+
+
+def reset_circuit_breakers() -> None:
+    with _breakers_lock:
+        _breakers.clear()
+
+
+def counts_as_failure(exc: BaseException) -> bool:
+    """
+    Whether an exception from the provider call says the provider is
+    unhealthy. Client errors (4xx other than 408/429) are our fault, not the
+    provider's, and do not trip the breaker.
+    """
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is not None and 400 <= status < 500 and status not in (408, 429):
+        return False
+    return True
@@ -0,0 +1,116 @@
+import logging
+import time
+from typing import Optional
+
+from django.conf import settings
+from django.http import HttpRequest
+
+from zerver.lib import ai_metrics
+
+logger = logging.getLogger(__name__)
+
+# Header in which the client says how long it will wait for the response.
+CLIENT_TIMEOUT_HEADER = "X-AI-Timeout-Ms"
+
+DEFAULT_DEADLINE_SECONDS = {
+    "recap": 25.0,
+    "topic": 12.0,
+}
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage: str) -> None:
+        super().__init__(f"deadline exceeded before {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    """
+    Absolute time budget for one request, created in the view and passed down
+    through DB fetch, prompt build, LLM call and sanitize. Each stage calls
+    check() first, so no stage starts once the budget is gone, and the LLM
+    timeout is whatever is left rather than a fixed number.
+    """
+
+    def __init__(self, seconds: float, kind: str = "ai") -> None:
+        self.kind = kind
+        self.budget = seconds
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + seconds
+        # Set once any stage was cut short, so callers know results may be fallbacks.
+        self.exceeded = False
+
+    @classmethod
+    def for_request(cls, request: HttpRequest, kind: str) -> "Deadline":
+        """
+        AI_DEADLINE_SECONDS[kind], shortened to the client's own timeout
+        (X-AI-Timeout-Ms) minus AI_DEADLINE_MARGIN_SECONDS for the response
+        to get back.
+        """
+        budgets = {**DEFAULT_DEADLINE_SECONDS, **getattr(settings, "AI_DEADLINE_SECONDS", {})}
+        seconds = budgets.get(kind, 10.0)
+        raw = request.headers.get(CLIENT_TIMEOUT_HEADER)
+        if raw:
+            try:
+                client_seconds = int(raw) / 1000
+            except ValueError:
+                client_seconds = None
+            if client_seconds is not None and client_seconds > 0:
+                margin: float = getattr(settings, "AI_DEADLINE_MARGIN_SECONDS", 0.5)
+                seconds = min(seconds, max(client_seconds - margin, 0.0))
+        return cls(seconds, kind)
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def cut_short(self) -> bool:
+        """
+        True if some stage was skipped or the budget ran out, i.e. results
+        produced under this deadline may be fallbacks.
+        """
+        return self.exceeded or self.expired()
+
+    def check(self, stage: str, need: float = 0.0) -> None:
+        """
+        Raise DeadlineExceeded unless at least `need` seconds are left for `stage`.
+        """
+        if self.remaining() > need:
+            return
+        self.exceeded = True
+        ai_metrics.incr(f"ai.deadline.{self.kind}.exceeded.{stage}")
+        logger.info(
+            "%s deadline exceeded before %s (%.2fs of %.2fs used)", self.kind, stage, self.elapsed(), self.budget
+        )
+        raise DeadlineExceeded(stage)
+
+    def timeout(self, stage: str, cap: float) -> float:
+        """
+        Timeout for a blocking call in `stage`: what is left of the budget
+        (keeping AI_DEADLINE_RESERVE_SECONDS for the stages after it), at
+        most `cap`. Raises DeadlineExceeded if less than
+        AI_DEADLINE_MIN_CALL_SECONDS would be left for the call.
+        """
+        reserve: float = getattr(settings, "AI_DEADLINE_RESERVE_SECONDS", 0.2)
+        min_call: float = getattr(settings, "AI_DEADLINE_MIN_CALL_SECONDS", 0.5)
+        self.check(stage, need=reserve + min_call)
+        return min(cap, self.remaining() - reserve)
+
+
+def llm_timeout(deadline: Optional[Deadline], default: float) -> float:
+    """
+    The LLM call timeout: `default` without a deadline, else what the deadline leaves.
+    """
+    if deadline is None:
+        return default
+    return deadline.timeout("llm", default)
+
+
+def check_deadline(deadline: Optional[Deadline], stage: str) -> None:
+    if deadline is not None:
+        deadline.check(stage)
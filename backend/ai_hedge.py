@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set, TypeVar
+
+from django.conf import settings
+
+from zerver.lib import ai_metrics
+from zerver.lib.ai_retry import RetryBudget
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class LatencyTracker:
+    """
+    Latencies of the most recent `size` calls, for percentile estimates.
+    """
+
+    def __init__(self, size: int = 512, min_samples: int = 20) -> None:
+        self.min_samples = min_samples
+        self._samples: Deque[float] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+_trackers: Dict[str, LatencyTracker] = {}
+_budgets: Dict[str, RetryBudget] = {}
+_registry_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def hedging_enabled(kind: str) -> bool:
+    """
+    AI_HEDGE_KINDS lists the request kinds (e.g. "topic") that may be hedged.
+    """
+    return kind in getattr(settings, "AI_HEDGE_KINDS", ())
+
+
+def hedge_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    The hedged request: the same payload, or the same prompt on AI_HEDGE_MODEL.
+    """
+    model: Optional[str] = getattr(settings, "AI_HEDGE_MODEL", None)
+    return dict(payload, model=model) if model else payload
+
+
+def _tracker(kind: str) -> LatencyTracker:
+    tracker = _trackers.get(kind)
+    if tracker is None:
+        with _registry_lock:
+            tracker = _trackers.setdefault(kind, LatencyTracker())
+    return tracker
+
+
+def _budget(kind: str) -> RetryBudget:
+    # Same sliding-window accounting as retries, without the floor: at most
+    # AI_HEDGE_MAX_FRACTION of recent requests may be hedged.
+    budget = _budgets.get(kind)
+    if budget is None:
+        with _registry_lock:
+            budget = _budgets.setdefault(
+                kind,
+                RetryBudget(
+                    ratio=getattr(settings, "AI_HEDGE_MAX_FRACTION", 0.05),
+                    min_per_second=0.0,
+                    window=getattr(settings, "AI_HEDGE_WINDOW_SECONDS", 60.0),
+                ),
+            )
+    return budget
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _registry_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, "AI_HEDGE_THREADS", 16), thread_name_prefix="ai-hedge"
+                )
+    return _executor
+
+
+def hedge_delay(kind: str) -> Optional[float]:
+    """
+    How long to wait for the primary before hedging: the observed
+    AI_HEDGE_PERCENTILE latency, or None until enough calls were seen.
+    """
+    p = _tracker(kind).percentile(getattr(settings, "AI_HEDGE_PERCENTILE", 0.95))
+    if p is None:
+        return None
+    delay = max(p, getattr(settings, "AI_HEDGE_MIN_DELAY", 0.05))
+    ai_metrics.set_gauge(f"ai.hedge.{kind}.delay_ms", delay * 1000)
+    return delay
+
+
+def _timed(tracker: LatencyTracker, fn: Callable[[float], T], timeout: float) -> T:
+    start = time.monotonic()
+    result = fn(timeout)
+    tracker.record(time.monotonic() - start)
+    return result
+
+
+def _record_winner(kind: str, hedge_won: bool) -> None:
+    ai_metrics.incr(f"ai.hedge.{kind}.hedge_won" if hedge_won else f"ai.hedge.{kind}.primary_won")
+
+
+class _PoolSlots:
+    """
+    Counts the hedge pool's threads in use, so that a call only goes to the
+    pool when a thread is free: a busy pool means running unhedged, not
+    queueing behind other calls.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._used = 0
+
+    def claim(self) -> bool:
+        with self._lock:
+            if self._used >= getattr(settings, "AI_HEDGE_THREADS", 16):
+                return False
+            self._used += 1
+            return True
+
+    def release(self, _: object = None) -> None:
+        with self._lock:
+            self._used -= 1
+
+
+_slots = _PoolSlots()
+
+
+def _submit(fn: Callable[..., T], *args: Any) -> "Optional[Future[T]]":
+    """Run fn on the hedge pool, or None when no thread is free."""
+    if not _slots.claim():
+        return None
+    future = _get_executor().submit(fn, *args)
+    future.add_done_callback(_slots.release)
+    return future
+
+
+def run_hedged(
+    kind: str, primary: Callable[[float], T], hedge: Callable[[float], T], timeout: float
+) -> T:
+    """
+    Call primary(timeout); if it has not answered after hedge_delay(kind)
+    and the hedge budget allows, also call hedge(remaining) and return
+    whichever succeeds first. To be abandoned, the attempts run on the
+    hedge pool; a call that could not be hedged right now (no latency
+    data, no hedge budget left, or no free pool thread) runs its primary
+    inline instead. A blocking HTTP call cannot be interrupted, so the
+    losing thread is abandoned (its result dropped) rather than cancelled;
+    see arun_hedged for the cancelling version.
+    """
+    tracker = _tracker(kind)
+    delay = hedge_delay(kind)
+    if delay is None or delay >= timeout:
+        return _timed(tracker, primary, timeout)
+
+    start = time.monotonic()
+    budget = _budget(kind)
+    budget.record_request()
+    first = _submit(_timed, tracker, primary, timeout) if budget.has_room() else None
+    if first is None:
+        return _timed(tracker, primary, timeout)
+    done, _ = wait([first], timeout=delay)
+    if done:
+        return first.result()
+    if not budget.try_spend():
+        ai_metrics.incr(f"ai.hedge.{kind}.budget_denied")
+        return first.result()
+    second = _submit(hedge, timeout - (time.monotonic() - start))
+    if second is None:
+        ai_metrics.incr(f"ai.hedge.{kind}.pool_full")
+        return first.result()
+
+    ai_metrics.incr(f"ai.hedge.{kind}.fired")
+    pending: Set["Future[T]"] = {first, second}
+    error: Optional[BaseException] = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            exc = fut.exception()
+            if exc is None:
+                _record_winner(kind, fut is second)
+                return fut.result()
+            error = exc
+    assert error is not None
+    raise error
+
+
+async def arun_hedged(
+    kind: str,
+    primary: Callable[[float], Awaitable[Any]],
+    hedge: Callable[[float], Awaitable[Any]],
+    timeout: float,
+) -> Any:
+    """
+    Async run_hedged: the loser is cancelled, which aborts its HTTP request.
+    """
+    tracker = _tracker(kind)
+    delay = hedge_delay(kind)
+    start = time.monotonic()
+
+    async def timed_primary() -> Any:
+        result = await primary(timeout)
+        tracker.record(time.monotonic() - start)
+        return result
+
+    if delay is None or delay >= timeout:
+        return await timed_primary()
+
+    budget = _budget(kind)
+    budget.record_request()
+    first = asyncio.ensure_future(timed_primary())
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+        return first.result()
+    if not budget.try_spend():
+        ai_metrics.incr(f"ai.hedge.{kind}.budget_denied")
+        return await first
+
+    ai_metrics.incr(f"ai.hedge.{kind}.fired")
+    second = asyncio.ensure_future(hedge(timeout - (time.monotonic() - start)))
+    pending = {first, second}
+    error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                exc = task.exception()
+                if exc is None:
+                    _record_winner(kind, task is second)
+                    return task.result()
+                error = exc
+    finally:
+        for task in pending:
+            task.cancel()
+        if first in pending:
+            # The primary was slower than this; record the lower bound so the
+            # percentile does not forget the slow tail.
+            tracker.record(time.monotonic() - start)
+    assert error is not None
+    raise error
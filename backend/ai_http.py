@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import os
+import threading
+import weakref
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+if TYPE_CHECKING:
+    import httpx
+
+logger = logging.getLogger(__name__)
+
+# One Session per process. Sessions must not be shared across fork(), so we
+# remember which pid built it and rebuild lazily in forked workers.
+_session_lock = threading.Lock()
+_session: Optional[requests.Session] = None
+_session_pid: Optional[int] = None
+_adapter: Optional[HTTPAdapter] = None
+
+# httpx.AsyncClient is bound to the event loop it first runs on, so async
+# clients are kept per loop. Under ASGI that is one long-lived client per process.
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _build_session() -> requests.Session:
+    """
+    Build a keep-alive Session whose adapter pools connections per host.
+    pool_connections: how many distinct hosts keep a pool.
+    pool_maxsize: max open connections per host (per-host limit when pool_block is on).
+    """
+    global _adapter
+    pool_connections: int = getattr(settings, "LLM_HTTP_POOL_CONNECTIONS", 4)
+    pool_maxsize: int = getattr(settings, "LLM_HTTP_POOL_MAXSIZE", 16)
+    pool_block: bool = getattr(settings, "LLM_HTTP_POOL_BLOCK", True)
+
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block,
+        max_retries=0,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Connection"] = "keep-alive"
+    _adapter = adapter
+    logger.info(
+        "LLM HTTP pool created pid=%s pool_connections=%s pool_maxsize=%s pool_block=%s",
+        os.getpid(),
+        pool_connections,
+        pool_maxsize,
+        pool_block,
+    )
+    return session
+
+
+def get_llm_session() -> requests.Session:
+    """
+    Return the shared, per-process Session used for all LLM calls.
+    Safe to call from any thread; the underlying urllib3 pools are thread-safe.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    session = _session
+    if session is not None and _session_pid == pid:
+        return session
+    with _session_lock:
+        if _session is None or _session_pid != pid:
+            _session = _build_session()
+            _session_pid = pid
+        return _session
+
+
+def pool_stats() -> Dict[str, Any]:
+    """
+    Connection pool statistics for the current process.
+    `created` counts new TCP/TLS connections; `reused` counts requests served
+    over an already-open keep-alive connection.
+    """
+    stats: Dict[str, Any] = {"created": 0, "requests": 0, "reused": 0, "hosts": {}}
+    adapter = _adapter
+    if adapter is None or _session_pid != os.getpid():
+        return stats
+
+    pools = adapter.poolmanager.pools
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        created = getattr(pool, "num_connections", 0)
+        served = getattr(pool, "num_requests", 0)
+        host = f"{pool.scheme}://{pool.host}:{pool.port}"
+        stats["hosts"][host] = {
+            "created": created,
+            "requests": served,
+            "reused": max(served - created, 0),
+        }
+        stats["created"] += created
+        stats["requests"] += served
+    stats["reused"] = max(stats["requests"] - stats["created"], 0)
+    return stats
+
+
+def reset_llm_session() -> None:
+    """
+    Close and drop the shared Session (e.g. after settings change in tests).
+    """
+    global _session, _session_pid, _adapter
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _session_pid = None
+        _adapter = None
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _build_async_client() -> "httpx.AsyncClient":
+    import httpx
+
+    pool_maxsize: int = getattr(settings, "LLM_HTTP_POOL_MAXSIZE", 16)
+    max_connections: int = getattr(settings, "LLM_HTTP_ASYNC_MAX_CONNECTIONS", 100)
+    http2: bool = getattr(settings, "LLM_HTTP2", True)
+    if http2 and not _http2_available():
+        logger.warning("LLM_HTTP2 is enabled but the h2 package is missing; using HTTP/1.1")
+        http2 = False
+
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=pool_maxsize,
+    )
+    logger.info(
+        "LLM async HTTP client created pid=%s http2=%s max_connections=%s",
+        os.getpid(),
+        http2,
+        max_connections,
+    )
+    return httpx.AsyncClient(http2=http2, limits=limits)
+
+
+def get_async_llm_client() -> "httpx.AsyncClient":
+    """
+    Return the shared httpx.AsyncClient for the running event loop.
+    With HTTP/2, concurrent requests to the provider are multiplexed over a
+    handful of connections instead of one connection per in-flight call.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is not None and not client.is_closed:
+        return client
+    with _session_lock:
+        client = _async_clients.get(loop)
+        if client is None or client.is_closed:
+            client = _build_async_client()
+            _async_clients[loop] = client
+        return client
@@ -0,0 +1,366 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+
+from zerver.lib import ai_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class LoadShedError(Exception):
+    """
+    Raised instead of queueing an LLM call that could not start in time;
+    callers return their fallback.
+    """
+
+    def __init__(self, reason: str) -> None:
+        super().__init__(f"LLM call shed: {reason}")
+        self.reason = reason
+
+
+class _Waiter:
+    """
+    A queued caller. Sync callers block on an Event; async callers await a
+    future on their own loop. A slot is handed over by setting `granted`
+    under the limiter lock, so a release never races a timeout.
+    """
+
+    def __init__(
+        self,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+        realm_id: Optional[int] = None,
+        weight: float = 1.0,
+    ) -> None:
+        self.granted = False
+        self.realm_id = realm_id
+        self.weight = weight
+        self.loop = loop
+        self.event = threading.Event()
+        self.future: Optional["asyncio.Future[None]"] = loop.create_future() if loop is not None else None
+
+    def wake(self) -> None:
+        if self.loop is None:
+            self.event.set()
+            return
+        future = self.future
+        assert future is not None
+
+        def set_result() -> None:
+            if not future.done():
+                future.set_result(None)
+
+        self.loop.call_soon_threadsafe(set_result)
+
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+
+def lane_for(kind: str) -> str:
+    """
+    AI_LLM_INTERACTIVE_KINDS (default: topic suggestions, single or
+    batched) run in the interactive lane; everything else (recaps and their
+    map/reduce steps) is bulk.
+    """
+    interactive = getattr(settings, "AI_LLM_INTERACTIVE_KINDS", ("topic", "topic_batch"))
+    return INTERACTIVE if kind in interactive else BULK
+
+
+class _Pacer:
+    """
+    Token bucket that hands out start times: reserve() takes a token now or
+    books one in the future and returns how long to wait for it.
+    """
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def reserve(self, max_wait: float) -> Optional[float]:
+        # Caller holds the limiter lock.
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+        if wait > max_wait:
+            return None
+        self._tokens -= 1
+        return wait
+
+
+class _FairQueue:
+    """
+    Weighted fair queue of waiters across realms. Each waiter gets a virtual
+    finish tag, max(virtual time, its realm's last tag) + 1 / weight, and the
+    smallest tag goes first: a realm with weight 2 gets twice the dispatches
+    of a weight-1 realm while both have calls queued, and a realm that just
+    queued does not wait behind another realm's whole backlog. Waiters of
+    one realm stay FIFO.
+    """
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[float, int, _Waiter]] = []
+        self._seq = itertools.count()
+        self._finish: Dict[Optional[int], float] = {}
+        self._virtual = 0.0
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def append(self, waiter: _Waiter) -> None:
+        tag = max(self._virtual, self._finish.get(waiter.realm_id, 0.0)) + 1.0 / waiter.weight
+        self._finish[waiter.realm_id] = tag
+        heapq.heappush(self._heap, (tag, next(self._seq), waiter))
+
+    def popleft(self) -> _Waiter:
+        tag, _, waiter = heapq.heappop(self._heap)
+        self._virtual = tag
+        self._reset_if_idle()
+        return waiter
+
+    def remove(self, waiter: _Waiter) -> None:
+        self._heap = [entry for entry in self._heap if entry[2] is not waiter]
+        heapq.heapify(self._heap)
+        self._reset_if_idle()
+
+    def _reset_if_idle(self) -> None:
+        # With nothing queued no realm is owed anything; this also keeps
+        # _finish from growing with every realm ever seen.
+        if not self._heap:
+            self._finish.clear()
+            self._virtual = 0.0
+
+
+class _Lane:
+    def __init__(self, name: str, limit: int, max_queue: int, pacer: Optional[_Pacer] = None) -> None:
+        self.name = name
+        # Most slots this lane may hold at once.
+        self.limit = limit
+        self.max_queue = max_queue
+        self.pacer = pacer
+        self.in_flight = 0
+        self.waiters = _FairQueue()
+        # Smoothed seconds a slot is held; 0 until the first call finishes.
+        self.service_time = 0.0
+
+
+class ConcurrencyLimiter:
+    """
+    At most `max_concurrent` LLM calls in flight per process, split into two
+    lanes. Interactive calls may use every slot; bulk calls may not use the
+    `reserved` slots kept for interactive ones, and are paced to
+    `bulk_rate` starts per second when set. Freed slots go to queued
+    interactive calls first, so a flood of recaps cannot delay a title
+    suggestion by more than one interactive call's duration.
+
+    Each lane queues up to its `max_queue` callers, shared between realms by
+    weighted fair queuing (see _FairQueue). A call is
+    shed (LoadShedError) when its queue is full, when the expected wait
+    (queue position times the lane's smoothed call duration, divided by its
+    slots) or the pacing delay is longer than its timeout, or when its
+    timeout runs out while queued.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = 16,
+        max_queue: int = 64,
+        reserved: int = 4,
+        interactive_queue: int = 32,
+        bulk_rate: Optional[float] = None,
+        bulk_burst: float = 10.0,
+        alpha: float = 0.1,
+    ) -> None:
+        self.max_concurrent = max_concurrent
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.lanes = {
+            INTERACTIVE: _Lane(INTERACTIVE, max_concurrent, interactive_queue),
+            BULK: _Lane(
+                BULK,
+                max(max_concurrent - reserved, 1),
+                max_queue,
+                _Pacer(bulk_rate, bulk_burst) if bulk_rate else None,
+            ),
+        }
+
+    def _export(self, lane: _Lane) -> None:
+        ai_metrics.set_gauge("ai.limiter.in_flight", self._in_flight)
+        ai_metrics.set_gauge(f"ai.limiter.{lane.name}.in_flight", lane.in_flight)
+        ai_metrics.set_gauge(f"ai.limiter.{lane.name}.queue_depth", len(lane.waiters))
+
+    def _shed(self, lane: _Lane, reason: str) -> LoadShedError:
+        ai_metrics.incr(f"ai.limiter.{lane.name}.shed.{reason}")
+        return LoadShedError(reason)
+
+    def _can_start(self, lane: _Lane) -> bool:
+        return self._in_flight < self.max_concurrent and lane.in_flight < lane.limit
+
+    def _start(self, lane: _Lane) -> None:
+        self._in_flight += 1
+        lane.in_flight += 1
+
+    def expected_wait(self, lane_name: str) -> float:
+        lane = self.lanes[lane_name]
+        return (len(lane.waiters) + 1) * lane.service_time / lane.limit
+
+    def _try_enter(self, lane: _Lane, timeout: float, waiter: _Waiter) -> bool:
+        """
+        Take a slot (True) or enqueue `waiter` (False); raise LoadShedError
+        if neither is allowed. Caller holds the lock.
+        """
+        if self._can_start(lane) and not lane.waiters:
+            self._start(lane)
+            self._export(lane)
+            return True
+        if len(lane.waiters) >= lane.max_queue:
+            raise self._shed(lane, "queue_full")
+        if self.expected_wait(lane.name) > timeout:
+            raise self._shed(lane, "expected_wait")
+        lane.waiters.append(waiter)
+        self._export(lane)
+        return False
+
+    def _abandon(self, lane: _Lane, waiter: _Waiter) -> bool:
+        """
+        Give up waiting; returns True if a slot was granted meanwhile (the
+        caller then owns it). Caller holds the lock.
+        """
+        if waiter.granted:
+            return True
+        lane.waiters.remove(waiter)
+        self._export(lane)
+        return False
+
+    def _pace(self, lane: _Lane, timeout: float) -> float:
+        if lane.pacer is None:
+            return 0.0
+        with self._lock:
+            wait = lane.pacer.reserve(timeout)
+        if wait is None:
+            raise self._shed(lane, "rate")
+        if wait:
+            ai_metrics.timing(f"ai.limiter.{lane.name}.paced_ms", wait * 1000)
+        return wait
+
+    def release(self, lane_name: str, held: float) -> None:
+        lane = self.lanes[lane_name]
+        with self._lock:
+            lane.service_time += self.alpha * (held - lane.service_time)
+            self._in_flight -= 1
+            lane.in_flight -= 1
+            # Interactive first: that is the reserved capacity's point.
+            for candidate in (self.lanes[INTERACTIVE], self.lanes[BULK]):
+                while candidate.waiters and self._can_start(candidate):
+                    waiter = candidate.waiters.popleft()
+                    waiter.granted = True
+                    self._start(candidate)
+                    waiter.wake()
+                self._export(candidate)
+
+    def acquire(
+        self, timeout: float, lane_name: str = BULK, realm_id: Optional[int] = None, weight: float = 1.0
+    ) -> None:
+        lane = self.lanes[lane_name]
+        start = time.monotonic()
+        paced = self._pace(lane, timeout)
+        if paced:
+            time.sleep(paced)
+        waiter = _Waiter(realm_id=realm_id, weight=weight)
+        remaining = timeout - (time.monotonic() - start)
+        with self._lock:
+            if self._try_enter(lane, remaining, waiter):
+                return
+        waiter.event.wait(remaining)
+        with self._lock:
+            if not self._abandon(lane, waiter):
+                raise self._shed(lane, "timeout")
+        ai_metrics.timing(f"ai.limiter.{lane.name}.wait_ms", (time.monotonic() - start) * 1000)
+
+    async def aacquire(
+        self, timeout: float, lane_name: str = BULK, realm_id: Optional[int] = None, weight: float = 1.0
+    ) -> None:
+        lane = self.lanes[lane_name]
+        start = time.monotonic()
+        paced = self._pace(lane, timeout)
+        if paced:
+            await asyncio.sleep(paced)
+        waiter = _Waiter(asyncio.get_running_loop(), realm_id, weight)
+        remaining = timeout - (time.monotonic() - start)
+        with self._lock:
+            if self._try_enter(lane, remaining, waiter):
+                return
+        assert waiter.future is not None
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), remaining)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = self._abandon(lane, waiter)
+            if granted:
+                self.release(lane.name, time.monotonic() - start)
+            raise
+        with self._lock:
+            if not self._abandon(lane, waiter):
+                raise self._shed(lane, "timeout")
+        ai_metrics.timing(f"ai.limiter.{lane.name}.wait_ms", (time.monotonic() - start) * 1000)
+
+    @contextmanager
+    def slot(
+        self, timeout: float, lane_name: str = BULK, realm_id: Optional[int] = None, weight: float = 1.0
+    ) -> Iterator[None]:
+        self.acquire(timeout, lane_name, realm_id, weight)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(lane_name, time.monotonic() - start)
+
+    @asynccontextmanager
+    async def aslot(
+        self, timeout: float, lane_name: str = BULK, realm_id: Optional[int] = None, weight: float = 1.0
+    ) -> AsyncIterator[None]:
+        await self.aacquire(timeout, lane_name, realm_id, weight)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(lane_name, time.monotonic() - start)
+
+
+_limiter: Optional[ConcurrencyLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_llm_limiter() -> ConcurrencyLimiter:
+    """
+    Process-wide limiter: AI_LLM_MAX_CONCURRENCY calls in flight, of which
+    AI_LLM_INTERACTIVE_RESERVED are kept for interactive calls;
+    AI_LLM_MAX_QUEUE bulk and AI_LLM_INTERACTIVE_MAX_QUEUE interactive calls
+    may wait; bulk starts are paced to AI_LLM_BULK_RATE per second
+    (AI_LLM_BULK_BURST at once) when set.
+    """
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = ConcurrencyLimiter(
+                    max_concurrent=getattr(settings, "AI_LLM_MAX_CONCURRENCY", 16),
+                    max_queue=getattr(settings, "AI_LLM_MAX_QUEUE", 64),
+                    reserved=getattr(settings, "AI_LLM_INTERACTIVE_RESERVED", 4),
+                    interactive_queue=getattr(settings, "AI_LLM_INTERACTIVE_MAX_QUEUE", 32),
+                    bulk_rate=getattr(settings, "AI_LLM_BULK_RATE", 5.0),
+                    bulk_burst=getattr(settings, "AI_LLM_BULK_BURST", 10.0),
+                )
+    return _limiter
@@ -0,0 +1,65 @@
+import threading
+from collections import defaultdict
+from typing import Dict
+
+from zerver.lib.utils import statsd
+
+# In-process mirror of what we send to statsd, so counters can be inspected
+# from a shell or a test without a statsd server.
+_lock = threading.Lock()
+_counters: Dict[str, float] = defaultdict(float)
+_gauges: Dict[str, float] = {}
+_distributions: Dict[str, Dict[str, float]] = {}
+
+
+def incr(name: str, value: float = 1) -> None:
+    with _lock:
+        _counters[name] += value
+    statsd.incr(name, value)
+
+
+def set_gauge(name: str, value: float) -> None:
+    with _lock:
+        _gauges[name] = value
+    statsd.gauge(name, value)
+
+
+def _record_sample(name: str, value: float) -> None:
+    with _lock:
+        t = _distributions.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+        t["count"] += 1
+        t["total"] += value
+        t["max"] = max(t["max"], value)
+    statsd.timing(name, value)
+
+
+def timing(name: str, ms: float) -> None:
+    _record_sample(name, ms)
+
+
+def observe(name: str, value: float) -> None:
+    """
+    Record a sample of a non-time distribution (e.g. tokens per request).
+    """
+    _record_sample(name, value)
+
+
+def get_counter(name: str) -> float:
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot() -> Dict[str, Dict]:
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "distributions": {k: dict(v) for k, v in _distributions.items()},
+        }
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _distributions.clear()
@@ -0,0 +1,303 @@
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from django.conf import settings
+
+from zerver.lib import ai_metrics
+from zerver.lib.ai_limiter import LoadShedError
+from zerver.lib.ai_prompt import estimate_tokens
+from zerver.lib.ai_singleflight import SharedStore, build_shared_store
+
+logger = logging.getLogger(__name__)
+
+REALM_KEY_PREFIX = "ai_realm_budget:"
+PACER_KEY_PREFIX = "ai_provider_pacer:"
+WINDOW_SECONDS = 60
+
+
+class RealmRateLimited(LoadShedError):
+    """
+    The realm has used its AI_REALM_RPM / AI_REALM_TPM budget for now.
+    """
+
+
+class ProviderRateLimited(LoadShedError):
+    """
+    Staying under a backend's LLM_BACKENDS "rpm" / "tpm" limit would mean
+    waiting longer than the call has left.
+    """
+
+
+def realm_weight(realm_id: Optional[int]) -> float:
+    """
+    The realm's share of LLM capacity relative to other realms with queued
+    calls: AI_REALM_WEIGHTS[realm_id], else AI_REALM_DEFAULT_WEIGHT.
+    """
+    weights: Dict[int, float] = getattr(settings, "AI_REALM_WEIGHTS", {})
+    default: float = getattr(settings, "AI_REALM_DEFAULT_WEIGHT", 1.0)
+    if realm_id is None:
+        return default
+    return weights.get(realm_id, default)
+
+
+def realm_limits(realm_id: int) -> Tuple[Optional[int], Optional[int]]:
+    """
+    (requests, tokens) per minute for the realm: AI_REALM_LIMITS[realm_id]
+    ({"rpm": ..., "tpm": ...}) over AI_REALM_RPM / AI_REALM_TPM. None is
+    unlimited.
+    """
+    overrides: Dict[str, Optional[int]] = getattr(settings, "AI_REALM_LIMITS", {}).get(realm_id, {})
+    rpm = overrides.get("rpm", getattr(settings, "AI_REALM_RPM", None))
+    tpm = overrides.get("tpm", getattr(settings, "AI_REALM_TPM", None))
+    return rpm, tpm
+
+
+def estimate_payload_tokens(payload: Dict[str, Any]) -> int:
+    """
+    Upper-bound cost of a chat request: its prompt plus max_tokens of output.
+    """
+    prompt = sum(estimate_tokens(str(m.get("content") or "")) for m in payload.get("messages", []))
+    return prompt + int(payload.get("max_tokens") or 0)
+
+
+_store: Optional[SharedStore] = None
+_store_lock = threading.Lock()
+
+
+def _get_store() -> SharedStore:
+    """
+    Store for realm budgets and provider pacing. AI_RATELIMIT_BACKEND:
+    "django" (AI_RATELIMIT_CACHE_ALIAS, shared by every app server) or
+    "local" for tests and single-node setups.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = build_shared_store(
+                    getattr(settings, "AI_RATELIMIT_BACKEND", "django"),
+                    getattr(settings, "AI_RATELIMIT_CACHE_ALIAS", "default"),
+                    "AI_RATELIMIT_BACKEND",
+                )
+    return _store
+
+
+def _incr(store: SharedStore, key: str, delta: int) -> int:
+    try:
+        return store.incr(key, delta)
+    except ValueError:
+        # First charge in this window; two windows' TTL so the next window
+        # can still read it.
+        if store.add(key, delta, 2 * WINDOW_SECONDS):
+            return delta
+        return store.incr(key, delta)
+
+
+def _read(store: SharedStore, key: str) -> int:
+    value = store.get(key)
+    return int(value) if value is not None else 0
+
+
+class SlidingWindowCounter:
+    """
+    Approximate per-minute usage in a shared store: this window's count
+    plus the previous window's, weighted by how much of it still overlaps
+    the last 60 seconds. One incr and one get per charge.
+    """
+
+    def __init__(self, store: SharedStore, name: str) -> None:
+        self.store = store
+        self.name = name
+
+    def _key(self, window: int) -> str:
+        return f"{REALM_KEY_PREFIX}{self.name}:{window}"
+
+    def try_charge(self, amount: int, limit: int) -> bool:
+        now = time.time()
+        window = int(now // WINDOW_SECONDS)
+        overlap = 1 - (now % WINDOW_SECONDS) / WINDOW_SECONDS
+        current = _incr(self.store, self._key(window), amount)
+        used = current + _read(self.store, self._key(window - 1)) * overlap
+        if used > limit:
+            _incr(self.store, self._key(window), -amount)
+            return False
+        return True
+
+    def refund(self, amount: int) -> None:
+        _incr(self.store, self._key(int(time.time() // WINDOW_SECONDS)), -amount)
+
+
+def charge_realm(realm_id: Optional[int], payload: Dict[str, Any]) -> None:
+    """
+    Charge one request and its estimated tokens to the realm's per-minute
+    budgets before calling the provider; RealmRateLimited if either is used
+    up. A store outage lets the call through rather than failing it.
+    """
+    if realm_id is None:
+        return
+    rpm, tpm = realm_limits(realm_id)
+    if rpm is None and tpm is None:
+        return
+    try:
+        store = _get_store()
+        request_budget = SlidingWindowCounter(store, f"{realm_id}:rpm")
+        if rpm is not None and not request_budget.try_charge(1, rpm):
+            ai_metrics.incr("ai.realm.limited.rpm")
+            raise RealmRateLimited("realm_rpm")
+        token_budget = SlidingWindowCounter(store, f"{realm_id}:tpm")
+        if tpm is not None and not token_budget.try_charge(estimate_payload_tokens(payload), tpm):
+            if rpm is not None:
+                request_budget.refund(1)
+            ai_metrics.incr("ai.realm.limited.tpm")
+            raise RealmRateLimited("realm_tpm")
+    except RealmRateLimited:
+        raise
+    except Exception:
+        logger.warning("realm budget store unavailable; not limiting realm %s", realm_id, exc_info=True)
+
+
+class _LockBusy(Exception):
+    pass
+
+
+class SharedTokenBucket:
+    """
+    A token bucket shared by every process through the shared store, kept
+    as one timestamp (GCRA's theoretical arrival time, TAT): the bucket is
+    full when TAT <= now, and taking n tokens moves TAT forward by n / rate.
+    A caller may start once TAT - burst / rate <= now, so reserve() returns
+    how long to wait instead of refusing: callers are paced to the limit
+    rather than bouncing off it. Updates run under a short cache.add() lock,
+    since the Django cache has no compare-and-set.
+    """
+
+    def __init__(self, store: SharedStore, name: str, per_minute: float, burst_seconds: float) -> None:
+        self.store = store
+        self.name = name
+        self.rate = per_minute / WINDOW_SECONDS
+        self.burst = max(self.rate * burst_seconds, 1.0)
+        self._key = f"{PACER_KEY_PREFIX}{name}"
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        lock_key = self._key + ":lock"
+        token = uuid.uuid4().hex
+        give_up = time.monotonic() + getattr(settings, "AI_PROVIDER_PACER_LOCK_WAIT", 0.05)
+        while not self.store.add(lock_key, token, 1):
+            if time.monotonic() > give_up:
+                raise _LockBusy()
+            time.sleep(0.002)
+        try:
+            yield
+        finally:
+            if self.store.get(lock_key) == token:
+                self.store.delete(lock_key)
+
+    def _tat(self, now: float) -> float:
+        value = self.store.get(self._key)
+        return max(float(value), now) if value is not None else now
+
+    def _save(self, tat: float, now: float) -> None:
+        self.store.set(self._key, repr(tat), int(tat - now) + WINDOW_SECONDS)
+
+    def reserve(self, amount: float, max_wait: float) -> Optional[float]:
+        """
+        Take `amount` tokens; seconds to wait before using them, or None
+        (nothing taken) if that is longer than `max_wait`.
+        """
+        with self._locked():
+            now = time.time()
+            tat = self._tat(now)
+            # Checked before adding `amount`, so a request larger than the
+            # burst is not refused forever; the debt delays whoever is next.
+            wait = max(tat - self.burst / self.rate - now, 0.0)
+            if wait > max_wait:
+                return None
+            self._save(tat + amount / self.rate, now)
+            return wait
+
+    def adjust(self, amount: float) -> None:
+        """
+        Take (or, if negative, give back) `amount` tokens after the fact.
+        """
+        with self._locked():
+            now = time.time()
+            self._save(max(self._tat(now) + amount / self.rate, now), now)
+
+
+class ProviderPacer:
+    """
+    Keeps the whole cluster under one backend's requests- and
+    tokens-per-minute limits (times AI_PROVIDER_LIMIT_FRACTION, for
+    headroom). Each call reserves one request and its estimated tokens
+    (prompt plus max_tokens) before it is sent; settle() corrects the
+    token charge with the response's `usage`, and refund() gives it back
+    if the call fails.
+    """
+
+    def __init__(self, name: str, rpm: Optional[int], tpm: Optional[int]) -> None:
+        self.name = name
+        store = _get_store()
+        fraction: float = getattr(settings, "AI_PROVIDER_LIMIT_FRACTION", 0.9)
+        burst: float = getattr(settings, "AI_PROVIDER_BURST_SECONDS", 1.0)
+        self.requests = SharedTokenBucket(store, f"{name}:rpm", rpm * fraction, burst) if rpm else None
+        self.tokens = SharedTokenBucket(store, f"{name}:tpm", tpm * fraction, burst) if tpm else None
+
+    def reserve(self, payload: Dict[str, Any], max_wait: float) -> Tuple[float, int]:
+        """
+        (seconds to wait before sending, tokens charged). Raises
+        ProviderRateLimited if the wait would be longer than `max_wait`. If
+        the shared store is busy or down, the call keeps whatever wait was
+        already reserved and goes out otherwise unpaced.
+        """
+        estimate = estimate_payload_tokens(payload) if self.tokens is not None else 0
+        wait = 0.0
+        try:
+            if self.requests is not None:
+                request_wait = self.requests.reserve(1, max_wait)
+                if request_wait is None:
+                    raise ProviderRateLimited("provider_rpm")
+                wait = request_wait
+            if self.tokens is not None:
+                token_wait = self.tokens.reserve(estimate, max_wait)
+                if token_wait is None:
+                    if self.requests is not None:
+                        self.requests.adjust(-1)
+                    raise ProviderRateLimited("provider_tpm")
+                wait = max(wait, token_wait)
+        except ProviderRateLimited as e:
+            ai_metrics.incr(f"ai.pacer.{self.name}.rejected.{e.reason}")
+            raise
+        except _LockBusy:
+            ai_metrics.incr(f"ai.pacer.{self.name}.lock_busy")
+            return wait, 0
+        except Exception:
+            logger.warning("provider pacer store unavailable; not pacing %s", self.name, exc_info=True)
+            return wait, 0
+        if wait:
+            ai_metrics.timing(f"ai.pacer.{self.name}.paced_ms", wait * 1000)
+        return wait, estimate
+
+    def refund(self, charged: int) -> None:
+        """Give back the token charge of a call the provider did not answer."""
+        if self.tokens is None or not charged:
+            return
+        try:
+            self.tokens.adjust(-charged)
+        except Exception:
+            logger.debug("could not refund token charge for %s", self.name, exc_info=True)
+
+    def settle(self, charged: int, data: Dict[str, Any]) -> None:
+        usage = data.get("usage") or {}
+        actual = usage.get("total_tokens")
+        if self.tokens is None or not charged or actual is None:
+            return
+        ai_metrics.observe(f"ai.pacer.{self.name}.estimate_error_tokens", charged - actual)
+        try:
+            self.tokens.adjust(actual - charged)
+        except Exception:
+            logger.debug("could not correct token charge for %s", self.name, exc_info=True)
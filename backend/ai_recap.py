@@ -0,0 +1,486 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from django.conf import settings
+
+from zerver.lib import ai_metrics
+from zerver.lib.ai import reduce_recap_sections, summarize_recap_chunk
+from zerver.lib.ai_deadline import Deadline, check_deadline
+from zerver.lib.ai_prompt import estimate_tokens
+from zerver.lib.ai_recap_state import (
+    RecapSection,
+    UserRecapState,
+    delta_recaps_enabled,
+    get_user_recap_state,
+    save_user_recap_state,
+)
+from zerver.lib.ai_topic_summary import (
+    TopicSummary,
+    advance_topic_summary,
+    fetch_topic_messages,
+    get_topic_summary,
+    roll_messages,
+    save_topic_summary,
+    topic_range_is_contiguous,
+    topic_summaries_enabled,
+)
+from zerver.lib.streams import can_access_stream_history
+from zerver.models import Message, Stream, UserProfile
+
+logger = logging.getLogger(__name__)
+
+# Up to this many messages the single-call recap is used; above it, map-reduce.
+RECAP_SINGLE_PASS_MAX = 200
+
+GroupKey = Tuple[int, str]  # (recipient_id, topic)
+
+
+@dataclass
+class RecapGroup:
+    key: GroupKey
+    label: str
+    first_message_id: int
+    last_message_id: int
+    message_count: int = 0
+    # Whether a shared per-topic summary may be used for / seeded from this group.
+    shareable: bool = False
+    summary: Optional[TopicSummary] = None
+    # This user's section for the group from their previous recap, if any.
+    previous: Optional[RecapSection] = None
+    message_ids: List[int] = field(default_factory=list)
+    # Section futures, in message order.
+    sections: List["Future[str]"] = field(default_factory=list)
+    pending: List[str] = field(default_factory=list)
+    pending_tokens: int = 0
+    # (id, text) of the user's messages in a group with a shared summary, in
+    # case the summary's tail is too long to roll within this recap.
+    own: List[Tuple[int, str]] = field(default_factory=list)
+
+
+@dataclass
+class MapReduceRecap:
+    html: str
+    message_refs: List[Dict[str, Any]]
+    summarized_messages: int
+    skipped_messages: int
+
+
+def map_reduce_enabled() -> bool:
+    return getattr(settings, "AI_RECAP_MAP_REDUCE", True)
+
+
+def max_recap_messages() -> int:
+    if not map_reduce_enabled():
+        return RECAP_SINGLE_PASS_MAX
+    return getattr(settings, "AI_RECAP_MAX_MESSAGES", 5000)
+
+
+def use_grouped_recap(message_count: int) -> bool:
+    """
+    Whether a request goes through generate_map_reduce_recap rather than the
+    single-call recap: always when shared topic summaries or delta recaps are
+    on, otherwise only above the single-pass size.
+    """
+    return topic_summaries_enabled() or delta_recaps_enabled() or message_count > RECAP_SINGLE_PASS_MAX
+
+
+def _stream_info(user: UserProfile, message_ids: List[int]) -> Dict[int, Tuple[str, bool]]:
+    """
+    recipient_id -> (stream name, whether the stream's shared summaries may
+    be used for `user`). Only streams whose history every subscriber can
+    read may share a summary, otherwise it could reveal pre-subscription
+    messages; and only while `user` can read that history now, since having
+    received some of the messages does not mean they may still read the
+    topic (they may have left the stream, or be an unsubscribed guest).
+    """
+    recipient_ids = set(
+        Message.objects.filter(id__in=message_ids).values_list("recipient_id", flat=True).distinct()
+    )
+    return {
+        stream.recipient_id: (
+            stream.name,
+            stream.history_public_to_subscribers and can_access_stream_history(user, stream),
+        )
+        for stream in Stream.objects.filter(recipient_id__in=recipient_ids)
+    }
+
+
+def iter_recap_messages(user: UserProfile, message_ids: List[int], chunk_size: int = 500) -> Iterator[Message]:
+    """
+    Stream the user's messages among `message_ids` from the database in id
+    order, without materializing the whole result set.
+    """
+    return (
+        Message.objects.filter(id__in=message_ids, usermessage__user_profile=user)
+        .only("id", "content", "recipient_id", "subject")
+        .order_by("id")
+        .iterator(chunk_size=chunk_size)
+    )
+
+
+class _BoundedPool:
+    """
+    ThreadPoolExecutor whose submit() blocks once `max_pending` tasks are
+    queued or running, so DB streaming cannot outrun the LLM calls.
+    """
+
+    def __init__(self, workers: int, max_pending: int) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ai-recap")
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, fn: Any, *args: Any) -> "Future[Any]":
+        self.slots.acquire()
+        try:
+            fut = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        fut.add_done_callback(lambda _: self.slots.release())
+        return fut
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
+
+
+def _done(value: str) -> "Future[str]":
+    fut: "Future[str]" = Future()
+    fut.set_result(value)
+    return fut
+
+
+def _shared_section(
+    pool: _BoundedPool, realm_id: int, group: RecapGroup, token_budget: int, deadline: Optional[Deadline]
+) -> Optional[Tuple["Future[str]", int]]:
+    """
+    The group's section from its shared summary, and the tokens spent
+    rolling the summary forward. Returns None if the topic's tail after the
+    watermark is longer than AI_TOPIC_SUMMARY_MAX_TAIL messages or
+    `token_budget` tokens. In that case the caller summarizes the user's own
+    messages instead.
+    """
+    summary = group.summary
+    assert summary is not None
+    if group.last_message_id <= summary.up_to_message_id:
+        ai_metrics.incr("ai.topic_summary.reused")
+        return _done(summary.html), 0
+    # Roll the topic forward with everything after the watermark, read or not,
+    # so the stored summary stays valid for every participant.
+    recipient_id, topic = group.key
+    max_tail: int = getattr(settings, "AI_TOPIC_SUMMARY_MAX_TAIL", 500)
+    tail = fetch_topic_messages(
+        recipient_id, topic, summary.up_to_message_id, group.last_message_id, limit=max_tail + 1
+    )
+    tokens = sum(estimate_tokens(text or "") for _, text in tail)
+    if len(tail) > max_tail or tokens > token_budget:
+        ai_metrics.incr("ai.topic_summary.tail_too_long")
+        return None
+    future = pool.submit(lambda: advance_topic_summary(realm_id, summary, group.label, tail, deadline).html)
+    return future, tokens
+
+
+def _seed_summary(realm_id: int, group: RecapGroup, html: str) -> None:
+    recipient_id, topic = group.key
+    if not topic_range_is_contiguous(
+        recipient_id, topic, group.first_message_id, group.last_message_id, group.message_count
+    ):
+        return
+    save_topic_summary(
+        realm_id,
+        TopicSummary(
+            recipient_id=recipient_id,
+            topic=topic,
+            start_message_id=group.first_message_id,
+            up_to_message_id=group.last_message_id,
+            html=html,
+            message_count=group.message_count,
+        ),
+    )
+    ai_metrics.incr("ai.topic_summary.seeded")
+
+
+def _reduce_hierarchically(
+    pool: _BoundedPool,
+    sections: List[str],
+    fan_in: int,
+    max_tokens: int,
+    deadline: Optional[Deadline],
+    realm_id: int,
+) -> str:
+    level = sections
+    while len(level) > fan_in:
+        batches = [level[i : i + fan_in] for i in range(0, len(level), fan_in)]
+        futures = [
+            pool.submit(reduce_recap_sections, batch, max_tokens, deadline, realm_id) for batch in batches
+        ]
+        level = [f.result() for f in futures]
+    return reduce_recap_sections(level, max_tokens, deadline, realm_id)
+
+
+def _kept_sections(state: UserRecapState, requested: Set[int]) -> Dict[GroupKey, RecapSection]:
+    """
+    Sections of the user's previous recap that are still fully unread. A
+    section some of whose messages have since been read is dropped, and its
+    remaining messages are summarized afresh.
+    """
+    return {
+        (section.recipient_id, section.topic): section
+        for section in state.sections
+        if requested.issuperset(section.message_ids)
+    }
+
+
+def generate_map_reduce_recap(
+    user: UserProfile, message_ids: List[int], max_tokens: int = 800, deadline: Optional[Deadline] = None
+) -> MapReduceRecap:
+    """
+    Recap for large unread sets: messages are grouped by (stream, topic),
+    each group is split into token-bounded chunks that are summarized in
+    parallel on a bounded pool (map), and the partial summaries are merged
+    level by level (reduce).
+
+    With AI_TOPIC_SUMMARIES, a topic that already has a shared rolling
+    summary is not re-summarized: the summary is reused as-is, or rolled
+    forward over just the messages after its watermark.
+
+    With AI_DELTA_RECAPS, the user's previous recap is remembered: sections
+    that are still unread are returned from storage, only messages the
+    previous recap did not cover are summarized, and a request covering
+    exactly the same messages returns the stored recap without any LLM call.
+
+    With a `deadline`, map and reduce calls get what is left of it and fall
+    back (section text, concatenation) once it is spent. Rolling a shared
+    topic summary forward counts against the deadline and
+    AI_RECAP_MAX_TOTAL_TOKENS like any other input, and is only stored for
+    everyone if it finished in time.
+    """
+    concurrency: int = getattr(settings, "AI_RECAP_MAP_CONCURRENCY", 4)
+    chunk_tokens: int = getattr(settings, "AI_RECAP_MAP_CHUNK_TOKENS", 3000)
+    total_token_limit: int = getattr(settings, "AI_RECAP_MAX_TOTAL_TOKENS", 200_000)
+    fan_in: int = getattr(settings, "AI_RECAP_REDUCE_FAN_IN", 8)
+
+    use_delta = delta_recaps_enabled()
+    requested = set(message_ids)
+    kept: Dict[GroupKey, RecapSection] = {}
+    if use_delta:
+        state = get_user_recap_state(user.id)
+        if state is not None:
+            kept = _kept_sections(state, requested)
+            if requested == set(state.covered_ids) and len(kept) == len(state.sections):
+                ai_metrics.incr("ai.recap.delta.unchanged")
+                return MapReduceRecap(
+                    html=state.html,
+                    message_refs=state.message_refs,
+                    summarized_messages=len(requested),
+                    skipped_messages=0,
+                )
+    kept_ids = {message_id for section in kept.values() for message_id in section.message_ids}
+    fetch_ids = [message_id for message_id in message_ids if message_id not in kept_ids]
+    if use_delta:
+        ai_metrics.incr("ai.recap.delta.reused_messages", len(kept_ids))
+        ai_metrics.incr("ai.recap.delta.new_messages", len(fetch_ids))
+
+    streams = _stream_info(user, message_ids)
+    use_shared = topic_summaries_enabled()
+    groups: Dict[GroupKey, RecapGroup] = {}
+    admitted_tokens = 0
+    summarized = 0
+    skipped_ids: List[int] = []
+
+    pool = _BoundedPool(concurrency, max_pending=concurrency * 2)
+
+    def flush(group: RecapGroup) -> None:
+        if not group.pending:
+            return
+        group.sections.append(
+            pool.submit(summarize_recap_chunk, group.label, group.pending, 300, deadline, user.realm_id)
+        )
+        group.pending = []
+        group.pending_tokens = 0
+
+    def new_group(m: Message) -> RecapGroup:
+        stream = streams.get(m.recipient_id)
+        label = f"#{stream[0]} > {m.subject}" if stream else "Direct messages"
+        group = RecapGroup(
+            key=(m.recipient_id, m.subject),
+            label=label,
+            first_message_id=m.id,
+            last_message_id=m.id,
+            shareable=use_shared and stream is not None and stream[1],
+        )
+        previous = kept.get(group.key)
+        if previous is not None:
+            group.first_message_id = min(m.id, previous.message_ids[0])
+            group.message_ids = list(previous.message_ids)
+            group.message_count = len(previous.message_ids)
+        if group.shareable:
+            summary = get_topic_summary(user.realm_id, m.recipient_id, m.subject)
+            if summary is not None and summary.start_message_id <= group.first_message_id:
+                group.summary = summary
+        # A shared summary, when there is one, takes precedence.
+        if group.summary is None:
+            group.previous = previous
+        return group
+
+    def kept_group(section: RecapSection) -> RecapGroup:
+        ai_metrics.incr("ai.recap.delta.sections_reused")
+        return RecapGroup(
+            key=(section.recipient_id, section.topic),
+            label=section.label,
+            first_message_id=section.message_ids[0],
+            last_message_id=section.message_ids[-1],
+            message_count=len(section.message_ids),
+            previous=section,
+            message_ids=list(section.message_ids),
+            sections=[_done(section.html)],
+        )
+
+    def admit(group: RecapGroup, message_id: int, text: str) -> bool:
+        nonlocal admitted_tokens
+        tokens = estimate_tokens(text)
+        if admitted_tokens + tokens > total_token_limit:
+            skipped_ids.append(message_id)
+            return False
+        admitted_tokens += tokens
+        # Delta groups are rolled in one go by roll_messages, which
+        # does its own chunking.
+        if group.previous is None and group.pending and group.pending_tokens + tokens > chunk_tokens:
+            flush(group)
+        group.pending.append(text)
+        group.pending_tokens += tokens
+        return True
+
+    def summarize_own(group: RecapGroup) -> None:
+        # The shared summary's tail is too long: treat the group as unshared.
+        nonlocal summarized
+        group.summary = None
+        group.shareable = False
+        own_ids = {message_id for message_id, _ in group.own}
+        admitted = {message_id for message_id, text in group.own if admit(group, message_id, text)}
+        summarized -= len(own_ids) - len(admitted)
+        group.message_ids = [i for i in group.message_ids if i not in own_ids or i in admitted]
+        group.message_count = len(group.message_ids)
+        group.own = []
+        flush(group)
+
+    try:
+        check_deadline(deadline, "fetch")
+        for m in iter_recap_messages(user, fetch_ids):
+            key = (m.recipient_id, m.subject)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = new_group(m)
+
+            if group.summary is None:
+                if not admit(group, m.id, m.content or ""):
+                    continue
+            else:
+                group.own.append((m.id, m.content or ""))
+
+            group.last_message_id = m.id
+            group.message_count += 1
+            group.message_ids.append(m.id)
+            summarized += 1
+
+        for group in groups.values():
+            if group.summary is not None:
+                shared = _shared_section(
+                    pool, user.realm_id, group, total_token_limit - admitted_tokens, deadline
+                )
+                if shared is None:
+                    summarize_own(group)
+                else:
+                    admitted_tokens += shared[1]
+                    group.sections.append(shared[0])
+            elif group.previous is not None and group.pending:
+                ai_metrics.incr("ai.recap.delta.sections_rolled")
+                group.sections.append(
+                    pool.submit(
+                        roll_messages,
+                        group.label,
+                        group.previous.html,
+                        group.pending,
+                        user.realm_id,
+                        deadline,
+                    )
+                )
+                group.pending = []
+            else:
+                flush(group)
+
+        for key, section in kept.items():
+            if key not in groups:
+                groups[key] = kept_group(section)
+                summarized += len(section.message_ids)
+
+        # Groups in first-unread order; sections within a group in message order.
+        ordered = sorted(groups.values(), key=lambda group: group.first_message_id)
+        group_html: Dict[GroupKey, str] = {}
+        sections: List[str] = []
+        for group in ordered:
+            group_sections = [f.result() for f in group.sections]
+            if (
+                group.shareable
+                and group.summary is None
+                and group.previous is None
+                and len(group_sections) == 1
+                and not (deadline is not None and deadline.cut_short())
+            ):
+                _seed_summary(user.realm_id, group, group_sections[0])
+            group_html[group.key] = "".join(group_sections)
+            sections.extend(group_sections)
+        ai_metrics.observe("ai.recap.map_reduce.sections", len(sections))
+        ai_metrics.observe("ai.recap.map_reduce.input_tokens", admitted_tokens)
+        html = _reduce_hierarchically(pool, sections, fan_in, max_tokens, deadline, user.realm_id) if sections else ""
+    finally:
+        pool.shutdown()
+
+    skipped = len(skipped_ids)
+    if skipped:
+        logger.info("map-reduce recap skipped %s messages over AI_RECAP_MAX_TOTAL_TOKENS", skipped)
+        html += f"<p><em>{skipped} more unread messages were not included.</em></p>"
+
+    # One reference per conversation (its first unread message) keeps the
+    # response small even for thousands of messages.
+    refs = [
+        {
+            "message_id": group.first_message_id,
+            "anchor": f"/#narrow/near/{group.first_message_id}",
+            "snippet": f"{group.label} ({group.message_count} messages)",
+        }
+        for group in ordered
+    ]
+    recap = MapReduceRecap(
+        html=f"<div class='ai-recap'>{html or '<p>(no messages)</p>'}</div>",
+        message_refs=refs,
+        summarized_messages=summarized,
+        skipped_messages=skipped,
+    )
+
+    # Sections cut short by the deadline are fallbacks; do not remember them.
+    if use_delta and not (deadline is not None and deadline.cut_short()):
+        # Ids we were asked for but did not summarize because the user cannot
+        # see them count as covered; skipped ones do not, so they are retried.
+        covered = requested.difference(skipped_ids)
+        save_user_recap_state(
+            user.id,
+            UserRecapState(
+                covered_ids=sorted(covered),
+                sections=[
+                    RecapSection(
+                        recipient_id=group.key[0],
+                        topic=group.key[1],
+                        label=group.label,
+                        html=group_html[group.key],
+                        message_ids=group.message_ids,
+                    )
+                    for group in ordered
+                    if group.message_ids
+                ],
+                html=recap.html,
+                message_refs=refs,
+            ),
+        )
+    return recap
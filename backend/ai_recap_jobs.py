@@ -0,0 +1,111 @@
+import logging
+import time
+import uuid
+from typing import Any, Dict, List, Mapping
+
+from django.conf import settings
+
+from zerver.lib import ai_metrics
+from zerver.lib.ai import generate_message_recap
+from zerver.lib.ai_deadline import Deadline
+from zerver.lib.ai_recap import generate_map_reduce_recap, use_grouped_recap
+from zerver.lib.queue import queue_json_publish
+from zerver.models import Message, UserProfile
+from zerver.tornado.django_api import send_event
+
+logger = logging.getLogger(__name__)
+
+RECAP_QUEUE = "ai_recaps"
+RECAP_EVENT_TYPE = "ai_recap"
+
+
+def background_recaps_enabled() -> bool:
+    """
+    AI_RECAP_BACKGROUND: message_recap enqueues the recap on the ai_recaps
+    queue and returns a job id; the result arrives as an ai_recap event.
+    """
+    return getattr(settings, "AI_RECAP_BACKGROUND", False)
+
+
+def fetch_ordered_messages(message_ids: List[int]) -> List[Message]:
+    msgs_map = {
+        m.id: m
+        for m in Message.objects.filter(id__in=message_ids).only("id", "content")
+    }
+    return [msgs_map[mid] for mid in message_ids if mid in msgs_map]
+
+
+def message_refs(ordered_msgs: List[Message]) -> List[Dict[str, Any]]:
+    return [
+        {
+            "message_id": m.id,
+            "anchor": f"/#narrow/near/{m.id}",
+            "snippet": (m.content or "")[:300].replace("\n", " "),
+        }
+        for m in ordered_msgs
+    ]
+
+
+def enqueue_recap_job(user: UserProfile, message_ids: List[int]) -> str:
+    job_id = uuid.uuid4().hex
+    queue_json_publish(
+        RECAP_QUEUE,
+        {
+            "job_id": job_id,
+            "user_id": user.id,
+            "message_ids": message_ids,
+            "enqueued_at": time.time(),
+        },
+    )
+    ai_metrics.incr("ai.recap_job.enqueued")
+    return job_id
+
+
+def _build_recap(user: UserProfile, message_ids: List[int], deadline: Deadline) -> Dict[str, Any]:
+    if use_grouped_recap(len(message_ids)):
+        result = generate_map_reduce_recap(user, message_ids, max_tokens=800, deadline=deadline)
+        return {"recap_html": result.html, "message_refs": result.message_refs}
+    ordered_msgs = fetch_ordered_messages(message_ids)
+    recap_html = generate_message_recap(
+        [m.content or "" for m in ordered_msgs],
+        [m.id for m in ordered_msgs],
+        max_tokens=800,
+        deadline=deadline,
+        realm_id=user.realm_id,
+    )
+    return {"recap_html": recap_html, "message_refs": message_refs(ordered_msgs)}
+
+
+def run_recap_job(event: Mapping[str, Any]) -> None:
+    """
+    Generate the recap for one queued job and push it to the user's clients
+    as an ai_recap event. Jobs that waited longer than
+    AI_RECAP_JOB_MAX_AGE_SECONDS are answered with an error instead (the
+    user has likely given up); the recap itself gets
+    AI_RECAP_JOB_SECONDS, more than a web request could. Jobs of users
+    deleted since they were queued are dropped.
+    """
+    try:
+        user = UserProfile.objects.select_related("realm").get(id=event["user_id"])
+    except UserProfile.DoesNotExist:
+        logger.info("dropping recap %s: user %s no longer exists", event["job_id"], event["user_id"])
+        ai_metrics.incr("ai.recap_job.dropped")
+        return
+    waited = time.time() - event["enqueued_at"]
+    ai_metrics.timing("ai.recap_job.queue_ms", waited * 1000)
+
+    if waited > getattr(settings, "AI_RECAP_JOB_MAX_AGE_SECONDS", 600):
+        ai_metrics.incr("ai.recap_job.expired")
+        payload: Dict[str, Any] = {"error": "The recap request expired; please try again."}
+    else:
+        start = time.monotonic()
+        deadline = Deadline(getattr(settings, "AI_RECAP_JOB_SECONDS", 120.0), "recap")
+        try:
+            payload = _build_recap(user, event["message_ids"], deadline)
+            ai_metrics.timing("ai.recap_job.run_ms", (time.monotonic() - start) * 1000)
+        except Exception:
+            logger.exception("background recap %s failed", event["job_id"])
+            ai_metrics.incr("ai.recap_job.failed")
+            payload = {"error": "Recap generation failed; check server logs"}
+
+    send_event(user.realm, {"type": RECAP_EVENT_TYPE, "job_id": event["job_id"], **payload}, [user.id])
@@ -0,0 +1,84 @@
+import json
+import logging
+import threading
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+
+from zerver.lib.ai_singleflight import SharedStore, build_shared_store
+
+logger = logging.getLogger(__name__)
+
+STATE_KEY_PREFIX = "ai_recap_state:v2:"
+
+
+@dataclass
+class RecapSection:
+    recipient_id: int
+    topic: str
+    label: str
+    html: str
+    # Message ids this section summarizes, ascending.
+    message_ids: List[int]
+
+
+@dataclass
+class UserRecapState:
+    """
+    What the user's last recap covered, so the next one only has to
+    summarize messages that arrived since. The covered ids, not a single
+    watermark, decide what is new: messages of a section that was partly
+    read since are summarized again even if older than the last recap.
+    """
+
+    covered_ids: List[int]
+    sections: List[RecapSection]
+    html: str
+    message_refs: List[Dict[str, Any]] = field(default_factory=list)
+
+
+def delta_recaps_enabled() -> bool:
+    return getattr(settings, "AI_DELTA_RECAPS", False)
+
+
+_store: Optional[SharedStore] = None
+_store_lock = threading.Lock()
+
+
+def _get_store() -> SharedStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = build_shared_store(
+                    getattr(settings, "AI_RECAP_STATE_BACKEND", "django"),
+                    getattr(settings, "AI_RECAP_STATE_CACHE_ALIAS", "default"),
+                    "AI_RECAP_STATE_BACKEND",
+                )
+    return _store
+
+
+def _state_key(user_id: int) -> str:
+    return f"{STATE_KEY_PREFIX}{user_id}"
+
+
+def get_user_recap_state(user_id: int) -> Optional[UserRecapState]:
+    try:
+        raw = _get_store().get(_state_key(user_id))
+    except Exception:
+        logger.exception("recap state lookup failed")
+        return None
+    if raw is None:
+        return None
+    data = json.loads(raw)
+    data["sections"] = [RecapSection(**section) for section in data["sections"]]
+    return UserRecapState(**data)
+
+
+def save_user_recap_state(user_id: int, state: UserRecapState) -> None:
+    ttl: int = getattr(settings, "AI_RECAP_STATE_TTL", 7 * 24 * 3600)
+    try:
+        _get_store().set(_state_key(user_id), json.dumps(asdict(state)), ttl)
+    except Exception:
+        logger.exception("recap state save failed")
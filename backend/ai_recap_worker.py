@@ -0,0 +1,24 @@
+# zerver/worker/ai_recaps.py
+import logging
+from typing import Any, Mapping
+
+from typing_extensions import override
+
+from zerver.lib.ai_recap_jobs import RECAP_QUEUE, run_recap_job
+from zerver.worker.base import QueueProcessingWorker, assign_queue
+
+logger = logging.getLogger(__name__)
+
+
+@assign_queue(RECAP_QUEUE)
+class AIRecapWorker(QueueProcessingWorker):
+    """
+    Generates queued unread recaps off the web tier. Each worker process
+    handles one recap at a time (its map-reduce steps still run in
+    parallel), so capacity is scaled by running more ai_recaps processes,
+    independently of the number of web workers.
+    """
+
+    @override
+    def consume(self, event: Mapping[str, Any]) -> None:
+        run_recap_job(event)
@@ -0,0 +1,254 @@
+import asyncio
+import email.utils
+import logging
+import random
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Mapping, Optional, TypeVar
+
+import requests
+from django.conf import settings
+
+from zerver.lib import ai_metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Statuses for which the provider did not (or could not) do the work, so
+# sending the same request again is safe.
+RETRYABLE_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+def _status(exc: BaseException) -> Optional[int]:
+    return getattr(getattr(exc, "response", None), "status_code", None)
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """
+    Only failures where the request was not processed: retryable HTTP
+    statuses and connection failures. A read timeout is not retried; the
+    provider may still be working on (and billing) the first attempt.
+    """
+    status = _status(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    if isinstance(exc, requests.exceptions.ReadTimeout):
+        return False
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        return True
+    try:
+        import httpx
+    except ImportError:
+        return False
+    return isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """
+    Seconds in an OpenAI-style rate-limit reset value ("20ms", "1s", "6m0s").
+    """
+    parts = _DURATION_PART.findall(value.strip())
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+
+def retry_after_seconds(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """
+    How long the provider asked us to wait: Retry-After (seconds or an HTTP
+    date), retry-after-ms, or the reset time of an exhausted
+    x-ratelimit-* window.
+    """
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("Retry-After")
+    if value:
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            try:
+                when = email.utils.parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                when = None
+            if when is not None:
+                return max(when.timestamp() - time.time(), 0.0)
+    waits = []
+    for window in ("requests", "tokens"):
+        if headers.get(f"x-ratelimit-remaining-{window}") == "0":
+            reset = parse_duration(headers.get(f"x-ratelimit-reset-{window}") or "")
+            if reset is not None:
+                waits.append(reset)
+    return max(waits) if waits else None
+
+
+class RetryBudget:
+    """
+    Caps retries for one endpoint at `ratio` of its recent requests (plus a
+    small floor), over a sliding `window` in seconds, so retries cannot
+    multiply load during a rate-limit storm.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 0.5, window: float = 10.0) -> None:
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.window = window
+        self._lock = threading.Lock()
+        self._requests: Deque[float] = deque()
+        self._retries: Deque[float] = deque()
+
+    def _trim(self, now: float) -> None:
+        for events in (self._requests, self._retries):
+            while events and events[0] < now - self.window:
+                events.popleft()
+
+    def record_request(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            self._requests.append(now)
+
+    def has_room(self) -> bool:
+        """Whether try_spend() would succeed now, without spending."""
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            return len(self._retries) < self.min_per_second * self.window + self.ratio * len(self._requests)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            allowed = self.min_per_second * self.window + self.ratio * len(self._requests)
+            if len(self._retries) >= allowed:
+                return False
+            self._retries.append(now)
+            return True
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, overridden by the provider's own
+    wait hint, bounded by the caller's deadline and a per-endpoint budget.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        base_delay: float = 0.25,
+        max_delay: float = 4.0,
+        min_attempt_seconds: float = 1.0,
+        budget_ratio: float = 0.2,
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.min_attempt_seconds = min_attempt_seconds
+        self.budget_ratio = budget_ratio
+        self._budgets: Dict[str, RetryBudget] = {}
+        self._budgets_lock = threading.Lock()
+
+    def budget(self, endpoint: str) -> RetryBudget:
+        budget = self._budgets.get(endpoint)
+        if budget is None:
+            with self._budgets_lock:
+                budget = self._budgets.setdefault(endpoint, RetryBudget(ratio=self.budget_ratio))
+        return budget
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def next_delay(self, endpoint: str, exc: BaseException, attempt: int, remaining: float) -> Optional[float]:
+        """
+        Seconds to sleep before attempt `attempt + 1`, or None to give up and
+        re-raise `exc`.
+        """
+        if attempt >= self.max_attempts or not is_retryable(exc):
+            return None
+        hint = retry_after_seconds(getattr(getattr(exc, "response", None), "headers", None))
+        if hint is not None:
+            # A little jitter so callers told the same Retry-After do not return in lockstep.
+            delay = hint + random.uniform(0, self.base_delay)
+        else:
+            delay = self.backoff(attempt)
+        if delay + self.min_attempt_seconds > remaining:
+            ai_metrics.incr(f"ai.retry.{endpoint}.deadline_exceeded")
+            return None
+        if not self.budget(endpoint).try_spend():
+            ai_metrics.incr(f"ai.retry.{endpoint}.budget_exhausted")
+            return None
+        ai_metrics.incr(f"ai.retry.{endpoint}.retries")
+        ai_metrics.timing(f"ai.retry.{endpoint}.delay_ms", delay * 1000)
+        logger.info(
+            "LLM %s attempt %s failed (%s); retrying in %.2fs", endpoint, attempt, _status(exc) or exc, delay
+        )
+        return delay
+
+
+_policy: Optional[RetryPolicy] = None
+_policy_lock = threading.Lock()
+
+
+def get_retry_policy() -> RetryPolicy:
+    """
+    Process-wide policy; AI_RETRY_MAX_ATTEMPTS=1 disables retries.
+    """
+    global _policy
+    if _policy is None:
+        with _policy_lock:
+            if _policy is None:
+                _policy = RetryPolicy(
+                    max_attempts=getattr(settings, "AI_RETRY_MAX_ATTEMPTS", 3),
+                    base_delay=getattr(settings, "AI_RETRY_BASE_DELAY", 0.25),
+                    max_delay=getattr(settings, "AI_RETRY_MAX_DELAY", 4.0),
+                    min_attempt_seconds=getattr(settings, "AI_RETRY_MIN_ATTEMPT_SECONDS", 1.0),
+                    budget_ratio=getattr(settings, "AI_RETRY_BUDGET_RATIO", 0.2),
+                )
+    return _policy
+
+
+def call_with_retries(endpoint: str, fn: Callable[[float], T], timeout: float) -> T:
+    """
+    Call fn(attempt_timeout) until it succeeds or the policy gives up. All
+    attempts and sleeps share one `timeout`; each attempt gets what is left.
+    """
+    policy = get_retry_policy()
+    policy.budget(endpoint).record_request()
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return fn(deadline - time.monotonic())
+        except Exception as e:
+            delay = policy.next_delay(endpoint, e, attempt, deadline - time.monotonic())
+            if delay is None:
+                raise
+        time.sleep(delay)
+
+
+async def acall_with_retries(endpoint: str, fn: Callable[[float], Awaitable[Any]], timeout: float) -> Any:
+    policy = get_retry_policy()
+    policy.budget(endpoint).record_request()
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return await fn(deadline - time.monotonic())
+        except Exception as e:
+            delay = policy.next_delay(endpoint, e, attempt, deadline - time.monotonic())
+            if delay is None:
+                raise
+        await asyncio.sleep(delay)
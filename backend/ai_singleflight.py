@@ -0,0 +1,328 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional, Protocol, Tuple, Union
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from zerver.lib import ai_metrics
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY_PREFIX = "ai_flight_lock:"
+RESULT_KEY_PREFIX = "ai_flight_result:"
+
+
+class SingleFlightError(Exception):
+    pass
+
+
+class SingleFlightTimeout(SingleFlightError):
+    pass
+
+
+class SingleFlightLeaderFailed(SingleFlightError):
+    pass
+
+
+class SharedStore(Protocol):
+    """
+    The subset of the Django cache API we need. cache.add() and cache.incr()
+    are atomic on memcached and Redis, which is what makes them usable as a
+    lock and as shared counters. Counters are stored as ints (Redis only
+    increments unpickled ints), everything else as str.
+    """
+
+    def add(self, key: str, value: Union[str, int], timeout: int) -> bool: ...
+
+    def get(self, key: str) -> Optional[str]: ...
+
+    def set(self, key: str, value: str, timeout: int) -> None: ...
+
+    def delete(self, key: str) -> None: ...
+
+    def incr(self, key: str, delta: int = 1) -> int: ...
+
+
+class LocalSharedStore:
+    """
+    In-process stand-in for memcached/Redis, for tests and single-node setups.
+    """
+
+    def __init__(self) -> None:
+        self._data: Dict[str, Tuple[float, Union[str, int]]] = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key: str) -> Optional[Union[str, int]]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[0] <= time.monotonic():
+            del self._data[key]
+            return None
+        return item[1]
+
+    def add(self, key: str, value: Union[str, int], timeout: int) -> bool:
+        with self._lock:
+            if self._live(key) is not None:
+                return False
+            self._data[key] = (time.monotonic() + timeout, value)
+            return True
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._live(key)
+        return None if value is None else str(value)
+
+    def set(self, key: str, value: str, timeout: int) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + timeout, value)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key: str, delta: int = 1) -> int:
+        # Like Django's cache.incr: ValueError for a missing key, TTL kept.
+        with self._lock:
+            value = self._live(key)
+            if value is None:
+                raise ValueError(f"Key '{key}' not found")
+            result = int(value) + delta
+            self._data[key] = (self._data[key][0], result)
+            return result
+
+
+class _Call:
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.result: Optional[str] = None
+        self.failed = False
+
+
+class SingleFlight:
+    """
+    Deduplicate concurrent identical calls. Inside a process, duplicates wait
+    for the leader thread (or task). Across processes, the leader holds a lock
+    key in the shared store and publishes its result under a result key that
+    the other nodes poll.
+    """
+
+    def __init__(
+        self,
+        store: Optional[SharedStore],
+        lock_ttl: int = 30,
+        result_ttl: int = 10,
+        poll_interval: float = 0.05,
+    ) -> None:
+        self.store = store
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._async_calls: Dict[Tuple[int, str], "asyncio.Future[str]"] = {}
+
+    # ---- shared-store helpers ----
+
+    def _try_lead(self, key: str) -> Optional[str]:
+        assert self.store is not None
+        token = uuid.uuid4().hex
+        if not self.store.add(LOCK_KEY_PREFIX + key, token, self.lock_ttl):
+            return None
+        # Drop any result left over from an earlier flight for this key.
+        self.store.delete(RESULT_KEY_PREFIX + key)
+        return token
+
+    def _publish(self, key: str, token: str, value: Optional[str]) -> None:
+        assert self.store is not None
+        payload = {"ok": value is not None, "value": value}
+        try:
+            self.store.set(RESULT_KEY_PREFIX + key, json.dumps(payload), self.result_ttl)
+            if self.store.get(LOCK_KEY_PREFIX + key) == token:
+                self.store.delete(LOCK_KEY_PREFIX + key)
+        except Exception:
+            logger.exception("single-flight: failed to publish result")
+
+    def _poll_remote(self, key: str) -> Tuple[bool, Optional[str]]:
+        """
+        (done, value): done=False means keep waiting; done=True with value=None
+        means the remote leader went away and we should try to lead.
+        """
+        assert self.store is not None
+        raw = self.store.get(RESULT_KEY_PREFIX + key)
+        if raw is not None:
+            payload = json.loads(raw)
+            if not payload.get("ok"):
+                raise SingleFlightLeaderFailed(key)
+            return True, payload["value"]
+        if self.store.get(LOCK_KEY_PREFIX + key) is None:
+            return True, None
+        return False, None
+
+    # ---- sync ----
+
+    def _run_distributed(self, key: str, fn: Callable[[], str], wait_timeout: float) -> str:
+        if self.store is None:
+            return fn()
+        deadline = time.monotonic() + wait_timeout
+        while True:
+            token = self._try_lead(key)
+            if token is not None:
+                value: Optional[str] = None
+                try:
+                    value = fn()
+                    return value
+                finally:
+                    self._publish(key, token, value)
+
+            ai_metrics.incr("ai.singleflight.coalesced_remote")
+            while True:
+                if time.monotonic() >= deadline:
+                    ai_metrics.incr("ai.singleflight.timeouts")
+                    raise SingleFlightTimeout(key)
+                done, remote_value = self._poll_remote(key)
+                if done and remote_value is not None:
+                    return remote_value
+                if done:
+                    break
+                time.sleep(self.poll_interval)
+
+    def do(self, key: str, fn: Callable[[], str], wait_timeout: float) -> str:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            ai_metrics.incr("ai.singleflight.coalesced_local")
+            if not call.event.wait(wait_timeout):
+                ai_metrics.incr("ai.singleflight.timeouts")
+                raise SingleFlightTimeout(key)
+            if call.failed or call.result is None:
+                raise SingleFlightLeaderFailed(key)
+            return call.result
+
+        ai_metrics.incr("ai.singleflight.leaders")
+        try:
+            call.result = self._run_distributed(key, fn, wait_timeout)
+            return call.result
+        except BaseException:
+            call.failed = True
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    # ---- async ----
+
+    async def _arun_distributed(self, key: str, fn: Callable[[], Awaitable[str]], wait_timeout: float) -> str:
+        if self.store is None:
+            return await fn()
+        # Shared-store calls run on a thread, not on the event loop.
+        deadline = time.monotonic() + wait_timeout
+        while True:
+            token = await sync_to_async(self._try_lead, thread_sensitive=False)(key)
+            if token is not None:
+                value: Optional[str] = None
+                try:
+                    value = await fn()
+                    return value
+                finally:
+                    await sync_to_async(self._publish, thread_sensitive=False)(key, token, value)
+
+            ai_metrics.incr("ai.singleflight.coalesced_remote")
+            while True:
+                if time.monotonic() >= deadline:
+                    ai_metrics.incr("ai.singleflight.timeouts")
+                    raise SingleFlightTimeout(key)
+                done, remote_value = await sync_to_async(self._poll_remote, thread_sensitive=False)(key)
+                if done and remote_value is not None:
+                    return remote_value
+                if done:
+                    break
+                await asyncio.sleep(self.poll_interval)
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[str]], wait_timeout: float) -> str:
+        loop = asyncio.get_running_loop()
+        local_key = (id(loop), key)
+        fut = self._async_calls.get(local_key)
+        if fut is not None:
+            ai_metrics.incr("ai.singleflight.coalesced_local")
+            try:
+                return await asyncio.wait_for(asyncio.shield(fut), wait_timeout)
+            except asyncio.TimeoutError:
+                ai_metrics.incr("ai.singleflight.timeouts")
+                raise SingleFlightTimeout(key)
+            except SingleFlightError:
+                raise
+            except Exception:
+                raise SingleFlightLeaderFailed(key)
+
+        fut = loop.create_future()
+        self._async_calls[local_key] = fut
+        ai_metrics.incr("ai.singleflight.leaders")
+        try:
+            value = await self._arun_distributed(key, fn, wait_timeout)
+            fut.set_result(value)
+            return value
+        except BaseException as e:
+            fut.set_exception(SingleFlightLeaderFailed(key) if not isinstance(e, Exception) else e)
+            # Nobody may be waiting; mark the exception as retrieved.
+            fut.exception()
+            raise
+        finally:
+            self._async_calls.pop(local_key, None)
+
+
+_single_flight: Optional[SingleFlight] = None
+_single_flight_lock = threading.Lock()
+
+
+def build_shared_store(backend: str, alias: str, setting_name: str) -> SharedStore:
+    """
+    "local" -> in-process LocalSharedStore; "django"/"memcached"/"redis" ->
+    the Django cache alias `alias`.
+    """
+    if backend == "local":
+        return LocalSharedStore()
+    if backend in ("django", "memcached", "redis"):
+        from django.core.cache import caches
+
+        return caches[alias]
+    raise RuntimeError(f"Unsupported {setting_name}: {backend}")
+
+
+def _build_store() -> Optional[SharedStore]:
+    backend: Optional[str] = getattr(settings, "AI_SINGLE_FLIGHT_BACKEND", "django")
+    if not backend:
+        return None
+    return build_shared_store(
+        backend, getattr(settings, "AI_SINGLE_FLIGHT_CACHE_ALIAS", "default"), "AI_SINGLE_FLIGHT_BACKEND"
+    )
+
+
+def get_single_flight() -> SingleFlight:
+    """
+    Process-wide SingleFlight. AI_SINGLE_FLIGHT_BACKEND: "django" (default),
+    "memcached" or "redis" (AI_SINGLE_FLIGHT_CACHE_ALIAS, shared across nodes),
+    "local" (in-process stand-in, for tests), or falsy for in-process
+    coalescing only.
+    """
+    global _single_flight
+    if _single_flight is None:
+        with _single_flight_lock:
+            if _single_flight is None:
+                _single_flight = SingleFlight(
+                    _build_store(),
+                    lock_ttl=getattr(settings, "AI_SINGLE_FLIGHT_LOCK_TTL", 30),
+                    result_ttl=getattr(settings, "AI_SINGLE_FLIGHT_RESULT_TTL", 10),
+                )
+    return _single_flight
@@ -0,0 +1,298 @@
+import heapq
+import json
+import logging
+import math
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+from django.conf import settings
+
+from zerver.lib import ai_metrics
+from zerver.lib.ai_singleflight import SharedStore, build_shared_store
+
+logger = logging.getLogger(__name__)
+
+IDF_KEY_PREFIX = "ai_topic_idf:"
+SAMPLES_KEY = "ai_topic_drift:samples"
+
+_TERM_RE = re.compile(r"\w{3,}")
+STOPWORDS = frozenset(
+    """
+    the and for with this that from into about your you are was were will just like have has had
+    been but not can could should would what when where why how our out all any its they them
+    then than there here also some more very only yes get got one now
+    """.split()
+)
+
+
+def message_terms(text: str) -> Dict[str, int]:
+    """Term counts of `text`: lowercased words of 3+ characters, minus stopwords."""
+    counts = Counter(t for t in _TERM_RE.findall(text.lower()) if t not in STOPWORDS)
+    return dict(counts)
+
+
+@dataclass
+class StreamIdf:
+    """
+    Document frequencies of terms across a stream's messages. Only the
+    AI_TOPIC_IDF_MAX_TERMS most frequent terms are kept; a pruned term is
+    rare and gets the maximum IDF, which is what it would have anyway.
+    """
+
+    doc_count: int = 0
+    df: Dict[str, int] = field(default_factory=dict)
+
+    def idf(self, term: str) -> float:
+        # Smoothed, so unseen terms and tiny streams stay finite.
+        return math.log((1 + self.doc_count) / (1 + self.df.get(term, 0))) + 1.0
+
+    def add(self, docs: int, df: Mapping[str, int]) -> None:
+        self.doc_count += docs
+        for term, n in df.items():
+            self.df[term] = self.df.get(term, 0) + n
+        max_terms: int = getattr(settings, "AI_TOPIC_IDF_MAX_TERMS", 5000)
+        # Prune with slack, so the sort runs once per many additions.
+        if len(self.df) > max_terms * 1.25:
+            self.df = dict(heapq.nlargest(max_terms, self.df.items(), key=lambda item: item[1]))
+
+
+class _IdfEntry:
+    def __init__(self, idf: StreamIdf) -> None:
+        self.idf = idf
+        self.loaded_at = time.monotonic()
+        # Observed here but not yet written to the shared store.
+        self.pending_docs = 0
+        self.pending_df: Counter[str] = Counter()
+
+
+_store: Optional[SharedStore] = None
+_store_lock = threading.Lock()
+_idf_cache: Dict[int, _IdfEntry] = {}
+_idf_lock = threading.Lock()
+
+
+def _get_store() -> SharedStore:
+    """
+    AI_TOPIC_DRIFT_BACKEND: "django" (AI_TOPIC_DRIFT_CACHE_ALIAS, shared by
+    all app servers and workers) or "local" for tests.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = build_shared_store(
+                    getattr(settings, "AI_TOPIC_DRIFT_BACKEND", "django"),
+                    getattr(settings, "AI_TOPIC_DRIFT_CACHE_ALIAS", "default"),
+                    "AI_TOPIC_DRIFT_BACKEND",
+                )
+    return _store
+
+
+def _load_shared_idf(recipient_id: int) -> StreamIdf:
+    try:
+        raw = _get_store().get(f"{IDF_KEY_PREFIX}{recipient_id}")
+    except Exception:
+        logger.warning("topic drift store unavailable", exc_info=True)
+        raw = None
+    return StreamIdf(**json.loads(raw)) if raw is not None else StreamIdf()
+
+
+def _flush(recipient_id: int, docs: int, df: Mapping[str, int]) -> StreamIdf:
+    """
+    Merge locally observed counts into the shared statistics. Last writer
+    wins, so two processes flushing at once may drop one's counts; the
+    statistics only need to be roughly right.
+    """
+    shared = _load_shared_idf(recipient_id)
+    shared.add(docs, df)
+    try:
+        _get_store().set(
+            f"{IDF_KEY_PREFIX}{recipient_id}",
+            json.dumps(asdict(shared)),
+            getattr(settings, "AI_TOPIC_IDF_TTL", 30 * 24 * 3600),
+        )
+    except Exception:
+        logger.warning("could not save stream IDF", exc_info=True)
+    return shared
+
+
+def _cache_entry(recipient_id: int, entry: _IdfEntry) -> None:
+    # Caller holds _idf_lock. Evicting drops the oldest stream's unflushed counts.
+    _idf_cache[recipient_id] = entry
+    while len(_idf_cache) > getattr(settings, "AI_TOPIC_IDF_CACHE_STREAMS", 1000):
+        del _idf_cache[next(iter(_idf_cache))]
+
+
+def get_stream_idf(recipient_id: int) -> StreamIdf:
+    """
+    The stream's IDF statistics from the per-process copy, reloaded from the
+    shared store every AI_TOPIC_IDF_REFRESH_SECONDS.
+    """
+    with _idf_lock:
+        entry = _idf_cache.get(recipient_id)
+        if entry is not None and time.monotonic() - entry.loaded_at < getattr(
+            settings, "AI_TOPIC_IDF_REFRESH_SECONDS", 60
+        ):
+            return entry.idf
+    shared = _load_shared_idf(recipient_id)
+    with _idf_lock:
+        fresh = _IdfEntry(shared)
+        old = _idf_cache.get(recipient_id)
+        if old is not None:
+            # Keep counts this process has not flushed yet.
+            fresh.pending_docs, fresh.pending_df = old.pending_docs, old.pending_df
+            shared.add(old.pending_docs, old.pending_df)
+        _cache_entry(recipient_id, fresh)
+    return shared
+
+
+def observe_message(recipient_id: int, terms: Mapping[str, int]) -> None:
+    """
+    Count one sent message in its stream's IDF statistics. Counts go to the
+    process-local copy at once and to the shared store every
+    AI_TOPIC_IDF_FLUSH_EVERY messages, so a send costs no extra round trip.
+    """
+    get_stream_idf(recipient_id)
+    with _idf_lock:
+        entry = _idf_cache.get(recipient_id)
+        if entry is None:
+            return
+        entry.idf.add(1, dict.fromkeys(terms, 1))
+        entry.pending_docs += 1
+        entry.pending_df.update(terms.keys())
+        if entry.pending_docs < getattr(settings, "AI_TOPIC_IDF_FLUSH_EVERY", 20):
+            return
+        docs, df = entry.pending_docs, entry.pending_df
+        entry.pending_docs, entry.pending_df = 0, Counter()
+    shared = _flush(recipient_id, docs, df)
+    with _idf_lock:
+        entry = _idf_cache.get(recipient_id)
+        if entry is not None:
+            shared.add(entry.pending_docs, entry.pending_df)
+            entry.idf = shared
+            entry.loaded_at = time.monotonic()
+
+
+def fold_into_centroid(centroid: Dict[str, float], terms: Mapping[str, int]) -> Dict[str, float]:
+    """
+    Add one message's term counts to a topic centroid, decaying older
+    messages by AI_TOPIC_CENTROID_DECAY and keeping the
+    AI_TOPIC_CENTROID_TERMS heaviest terms.
+    """
+    decay: float = getattr(settings, "AI_TOPIC_CENTROID_DECAY", 0.9)
+    out = {t: w * decay for t, w in centroid.items() if w * decay >= 0.01}
+    for term, n in terms.items():
+        out[term] = out.get(term, 0.0) + n
+    max_terms: int = getattr(settings, "AI_TOPIC_CENTROID_TERMS", 200)
+    if len(out) > max_terms:
+        out = dict(heapq.nlargest(max_terms, out.items(), key=lambda item: item[1]))
+    return out
+
+
+def _weighted(tf: Mapping[str, float], idf: StreamIdf) -> Dict[str, float]:
+    # Sublinear TF (log1p also suits decayed centroid weights below 1).
+    return {t: math.log1p(n) * idf.idf(t) for t, n in tf.items() if n > 0}
+
+
+def _cosine(a: Mapping[str, float], b: Mapping[str, float]) -> float:
+    if not a or not b:
+        return 0.0
+    if len(a) > len(b):
+        a, b = b, a
+    dot = sum(w * b.get(t, 0.0) for t, w in a.items())
+    if not dot:
+        return 0.0
+    return dot / math.sqrt(sum(w * w for w in a.values()) * sum(w * w for w in b.values()))
+
+
+def drift_score(
+    recipient_id: int, title: str, centroid: Mapping[str, float], batch: Iterable[Mapping[str, int]]
+) -> float:
+    """
+    1 - cosine similarity between the topic (its centroid plus the title's
+    terms, weighted by AI_TOPIC_TITLE_WEIGHT) and the batch of new messages,
+    both TF-IDF weighted with the stream's statistics. 0 is on topic, 1 is
+    nothing in common.
+    """
+    start = time.perf_counter()
+    reference = dict(centroid)
+    title_weight: float = getattr(settings, "AI_TOPIC_TITLE_WEIGHT", 3.0)
+    for term in message_terms(title):
+        reference[term] = reference.get(term, 0.0) + title_weight
+    batch_tf: Counter[str] = Counter()
+    for terms in batch:
+        batch_tf.update(terms)
+
+    idf = get_stream_idf(recipient_id)
+    similarity = _cosine(_weighted(reference, idf), _weighted(batch_tf, idf))
+    ai_metrics.timing("ai.topic_drift.score_ms", (time.perf_counter() - start) * 1000)
+    return 1.0 - similarity
+
+
+def drift_threshold() -> float:
+    """
+    AI_TOPIC_DRIFT_THRESHOLD: drift score at or above which the LLM is
+    asked; calibrate with calibrate_threshold.
+    """
+    return getattr(settings, "AI_TOPIC_DRIFT_THRESHOLD", 0.8)
+
+
+def record_outcome(score: float, drifted: bool) -> None:
+    """
+    Record the drift score that sent a batch to the LLM, by whether the LLM
+    found drift: as metrics, and as a (score, drifted) sample in the shared
+    store, which keeps the latest AI_TOPIC_DRIFT_SAMPLES for
+    calibrate_threshold. Last writer wins, so concurrent outcomes may drop
+    a sample.
+    """
+    ai_metrics.observe(f"ai.topic_drift.score.{'drifted' if drifted else 'kept'}", score)
+    samples = load_samples()
+    samples.append((round(score, 4), drifted))
+    try:
+        _get_store().set(
+            SAMPLES_KEY,
+            json.dumps(samples[-getattr(settings, "AI_TOPIC_DRIFT_SAMPLES", 1000) :]),
+            getattr(settings, "AI_TOPIC_IDF_TTL", 30 * 24 * 3600),
+        )
+    except Exception:
+        logger.warning("could not save drift sample", exc_info=True)
+
+
+def load_samples() -> List[Tuple[float, bool]]:
+    """The (drift score, drifted) samples saved by record_outcome, oldest first."""
+    try:
+        raw = _get_store().get(SAMPLES_KEY)
+    except Exception:
+        logger.warning("topic drift store unavailable", exc_info=True)
+        raw = None
+    return [(score, drifted) for score, drifted in json.loads(raw)] if raw is not None else []
+
+
+def calibrate_threshold(samples: Optional[Iterable[Tuple[float, bool]]] = None) -> float:
+    """
+    The threshold with the best F1 at telling drifted batches from kept
+    ones, given (drift score, drifted) samples; by default those saved by
+    record_outcome. Only batches at or above the current threshold reach
+    the LLM, so the saved samples can only raise it. Falls back to
+    drift_threshold() without both kinds.
+    """
+    ordered = sorted(load_samples() if samples is None else samples, reverse=True)
+    positives = sum(1 for _, drifted in ordered if drifted)
+    if not positives or positives == len(ordered):
+        return drift_threshold()
+    best_f1, best = -1.0, drift_threshold()
+    true_pos = 0
+    for i, (score, drifted) in enumerate(ordered):
+        true_pos += drifted
+        # Only cut between distinct scores.
+        if i + 1 < len(ordered) and ordered[i + 1][0] == score:
+            continue
+        f1 = 2 * true_pos / (i + 1 + positives)
+        if f1 > best_f1:
+            best_f1, best = f1, score
+    return best
+
@@ -0,0 +1,128 @@
+import logging
+import time
+from typing import Any, Dict, Mapping, Optional
+
+from django.conf import settings
+from django.db import transaction
+
+from zerver.lib import ai_metrics
+from zerver.lib.ai import llm_topic_title
+from zerver.lib.ai_deadline import Deadline
+from zerver.lib.ai_topic_drift import observe_message
+from zerver.lib.ai_topic_state import (
+    TopicState,
+    clear_evaluation_pending,
+    drift_likely,
+    get_topic_state,
+    in_cooldown,
+    mark_evaluated,
+    mark_evaluation_pending,
+    record_message,
+    recently_renamed,
+    save_topic_state,
+    store_suggestion,
+    suggestion_texts,
+)
+from zerver.lib.queue import queue_json_publish
+from zerver.models import Message
+
+logger = logging.getLogger(__name__)
+
+PRECOMPUTE_QUEUE = "ai_topic_suggestions"
+
+
+def precompute_enabled() -> bool:
+    return getattr(settings, "AI_TOPIC_PRECOMPUTE", False)
+
+
+def handle_sent_message(message: Message) -> None:
+    """
+    Send-path hook: call from do_send_messages, once the transaction has
+    committed, for each new message. Records the message's features in its
+    topic's state (one shared-cache read and write per stream message) and
+    its terms in the stream's IDF statistics.
+    With AI_TOPIC_PRECOMPUTE, once AI_TOPIC_PRECOMPUTE_EVERY messages
+    arrived since the last evaluation and drift looks likely, it also
+    queues a background suggestion so a later request is answered from
+    state. The job is published only once the state is saved (and any
+    surrounding transaction has committed), so the worker reads the state
+    that triggered it.
+    """
+    if not message.is_stream_message():
+        return
+    topic = message.subject
+    state = get_topic_state(message.recipient_id, topic)
+    features = record_message(state, message.id, message.content)
+    observe_message(message.recipient_id, features.terms)
+    event: Optional[Dict[str, Any]] = None
+    if precompute_enabled() and state.unevaluated >= getattr(settings, "AI_TOPIC_PRECOMPUTE_EVERY", 3):
+        if not drift_likely(state):
+            ai_metrics.incr("ai.topic_precompute.skipped_unlikely")
+            mark_evaluated(state, message.id)
+        elif recently_renamed(state) or in_cooldown(state):
+            # Left unevaluated; a later send picks it up.
+            ai_metrics.incr("ai.topic_precompute.skipped_cooldown")
+        elif mark_evaluation_pending(message.recipient_id, topic):
+            event = {
+                "realm_id": message.realm_id,
+                "recipient_id": message.recipient_id,
+                "topic": topic,
+            }
+    save_topic_state(state)
+    if event is not None:
+        transaction.on_commit(lambda: _publish(event))
+
+
+def _publish(event: Dict[str, Any]) -> None:
+    queue_json_publish(PRECOMPUTE_QUEUE, dict(event, enqueued_at=time.time()))
+    ai_metrics.incr("ai.topic_precompute.queued")
+
+
+def run_precompute_job(event: Mapping[str, Any]) -> None:
+    """
+    Suggest a title from the topic state's newest messages, in the bulk LLM
+    lane, and store it in the state. If the LLM does not answer, nothing is
+    stored and the messages stay unevaluated for a later send to retry.
+    """
+    recipient_id: int = event["recipient_id"]
+    topic: str = event["topic"]
+    try:
+        state = get_topic_state(recipient_id, topic)
+        up_to_id, score = state.newest_id, state.drift_score
+        if not up_to_id or state.suggestion_up_to_id >= up_to_id:
+            return
+        start = time.monotonic()
+        suggestion = llm_topic_title(
+            messages=suggestion_texts(state),
+            current_title=topic,
+            max_tokens=40,
+            deadline=Deadline(getattr(settings, "AI_TOPIC_PRECOMPUTE_SECONDS", 20.0), "topic"),
+            realm_id=event["realm_id"],
+            background=True,
+        )
+        latency_ms = (time.monotonic() - start) * 1000
+        ai_metrics.timing("ai.topic_precompute.run_ms", latency_ms)
+        if suggestion is None:
+            ai_metrics.incr("ai.topic_precompute.no_answer")
+            return
+        store_suggestion(recipient_id, topic, suggestion, up_to_id, latency_ms, score)
+    finally:
+        clear_evaluation_pending(recipient_id, topic)
+
+
+def stored_suggestion(state: TopicState, current_title: str) -> Optional[str]:
+    """
+    The state's last suggestion, if it already covers the topic's newest
+    message and was made for the same title; None on a miss. Hits and
+    misses are counted, and each hit records the LLM time it saved.
+    """
+    if (
+        state.last_suggestion is not None
+        and state.suggestion_up_to_id >= state.newest_id
+        and state.suggestion_for_title.lower() == current_title.lower()
+    ):
+        ai_metrics.incr("ai.topic_precompute.hit")
+        ai_metrics.timing("ai.topic_precompute.saved_ms", state.suggestion_latency_ms)
+        return state.last_suggestion
+    ai_metrics.incr("ai.topic_precompute.miss")
+    return None
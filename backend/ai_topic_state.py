@@ -0,0 +1,312 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+from django.conf import settings
+
+from zerver.lib import ai_metrics
+from zerver.lib.ai_singleflight import SharedStore, build_shared_store
+from zerver.lib.ai_topic_drift import (
+    drift_score,
+    drift_threshold,
+    fold_into_centroid,
+    message_terms,
+    record_outcome,
+)
+from zerver.models import Message
+
+logger = logging.getLogger(__name__)
+
+STATE_KEY_PREFIX = "ai_topic_state:v3:"
+# Per-message text kept in the state; covers TOPIC_MAX_MESSAGE_TOKENS, so
+# suggestions are built from the state without refetching content.
+MAX_SNIPPET_CHARS = 1000
+
+# Below these the new messages say too little to judge drift.
+MIN_MSGS = 2
+MIN_AVG_LEN = 20
+
+
+@dataclass
+class MessageFeatures:
+    message_id: int
+    length: int
+    # message_terms() of the text, for the drift scorer.
+    terms: Dict[str, int]
+    snippet: str
+
+
+@dataclass
+class TopicState:
+    """
+    What the server knows about one (stream, topic) between suggestions:
+    features of the most recent messages, how many arrived since the last
+    evaluation and how far they drift from the title, and the last
+    suggestion with the newest message it covered.
+    """
+
+    recipient_id: int
+    topic: str
+    # Oldest first, at most AI_TOPIC_STATE_RECENT.
+    recent: List[MessageFeatures] = field(default_factory=list)
+    unevaluated: int = 0
+    last_evaluated_id: int = 0
+    # Decayed term counts of the evaluated messages: what the topic is about.
+    centroid: Dict[str, float] = field(default_factory=dict)
+    # Of the unevaluated messages against the centroid; 0 (on topic) to 1.
+    drift_score: float = 0.0
+    last_suggestion: Optional[str] = None
+    suggestion_for_title: str = ""
+    suggestion_up_to_id: int = 0
+    # How long the LLM took for last_suggestion; what a cache hit saves.
+    suggestion_latency_ms: float = 0.0
+    # Wall-clock time of the last LLM evaluation, for the shared cooldown.
+    evaluated_at: float = 0.0
+    # Rename history: when the topic last got its current name, and the
+    # names it had before (oldest first), which are never suggested again.
+    renamed_at: float = 0.0
+    previous_titles: List[str] = field(default_factory=list)
+
+    @property
+    def newest_id(self) -> int:
+        return self.recent[-1].message_id if self.recent else 0
+
+    def unevaluated_features(self) -> List[MessageFeatures]:
+        return self.recent[len(self.recent) - min(self.unevaluated, len(self.recent)) :]
+
+
+_store: Optional[SharedStore] = None
+_store_lock = threading.Lock()
+
+
+def _get_store() -> SharedStore:
+    """
+    AI_TOPIC_STATE_BACKEND: "django" (AI_TOPIC_STATE_CACHE_ALIAS, shared by
+    all app servers and workers) or "local" for tests.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = build_shared_store(
+                    getattr(settings, "AI_TOPIC_STATE_BACKEND", "django"),
+                    getattr(settings, "AI_TOPIC_STATE_CACHE_ALIAS", "default"),
+                    "AI_TOPIC_STATE_BACKEND",
+                )
+    return _store
+
+
+def _state_key(recipient_id: int, topic: str) -> str:
+    # Topics compare case-insensitively in Zulip.
+    topic_hash = hashlib.sha256(topic.lower().encode()).hexdigest()[:32]
+    return f"{STATE_KEY_PREFIX}{recipient_id}:{topic_hash}"
+
+
+def get_topic_state(recipient_id: int, topic: str) -> TopicState:
+    try:
+        raw = _get_store().get(_state_key(recipient_id, topic))
+    except Exception:
+        logger.warning("topic state store unavailable", exc_info=True)
+        raw = None
+    if raw is None:
+        return TopicState(recipient_id=recipient_id, topic=topic)
+    data = json.loads(raw)
+    data["recent"] = [MessageFeatures(**f) for f in data["recent"]]
+    return TopicState(**data)
+
+
+def save_topic_state(state: TopicState) -> None:
+    """
+    Last writer wins: two concurrent sends may drop one message from
+    `recent`, which only delays the next evaluation.
+    """
+    try:
+        _get_store().set(
+            _state_key(state.recipient_id, state.topic),
+            json.dumps(asdict(state)),
+            getattr(settings, "AI_TOPIC_STATE_TTL", 7 * 24 * 3600),
+        )
+    except Exception:
+        logger.warning("could not save topic state", exc_info=True)
+
+
+def _drift_score(state: TopicState) -> float:
+    """
+    TF-IDF drift of the unevaluated messages from the topic (see
+    ai_topic_drift.drift_score); 0 when there are too few, or too short, to
+    tell.
+    """
+    batch = state.unevaluated_features()
+    if len(batch) < MIN_MSGS:
+        return 0.0
+    if sum(f.length for f in batch) / len(batch) < MIN_AVG_LEN:
+        return 0.0
+    return drift_score(state.recipient_id, state.topic, state.centroid, [f.terms for f in batch])
+
+
+def record_message(state: TopicState, message_id: int, content: str) -> MessageFeatures:
+    text = (content or "").strip()
+    features = MessageFeatures(
+        message_id=message_id,
+        length=len(text),
+        terms=message_terms(text[:MAX_SNIPPET_CHARS]),
+        snippet=text[:MAX_SNIPPET_CHARS],
+    )
+    state.recent.append(features)
+    del state.recent[: -getattr(settings, "AI_TOPIC_STATE_RECENT", 20)]
+    state.unevaluated += 1
+    state.drift_score = _drift_score(state)
+    return features
+
+
+def drift_likely(state: TopicState) -> bool:
+    return state.drift_score >= drift_threshold()
+
+
+def mark_evaluated(state: TopicState, up_to_id: int) -> None:
+    """Fold the messages up to `up_to_id` into the centroid and rescore the rest."""
+    for f in state.recent:
+        if state.last_evaluated_id < f.message_id <= up_to_id:
+            state.centroid = fold_into_centroid(state.centroid, f.terms)
+    state.last_evaluated_id = max(state.last_evaluated_id, up_to_id)
+    state.unevaluated = sum(1 for f in state.recent if f.message_id > state.last_evaluated_id)
+    state.drift_score = _drift_score(state)
+
+
+def load_topic_state(recipient_id: int, topic: str) -> TopicState:
+    """
+    The topic's state, seeded from its newest messages when the cache has
+    none (eviction, or a topic last active before the send hook ran). A
+    seeded state counts all of them as unevaluated.
+    """
+    state = get_topic_state(recipient_id, topic)
+    if state.recent:
+        return state
+    rows = list(
+        Message.objects.filter(recipient_id=recipient_id, subject__iexact=topic)
+        .order_by("-id")
+        .values_list("id", "content")[: getattr(settings, "AI_TOPIC_STATE_RECENT", 20)]
+    )
+    for message_id, content in reversed(rows):
+        record_message(state, message_id, content)
+    if rows:
+        save_topic_state(state)
+    return state
+
+
+def store_suggestion(
+    recipient_id: int, topic: str, suggestion: str, up_to_id: int, latency_ms: float, drift_score: float
+) -> TopicState:
+    """
+    Record the LLM's suggestion covering messages up to `up_to_id`, and its
+    verdict as a drift sample for `drift_score`, the score that sent the
+    messages to the LLM. One of the topic's previous names is stored (and
+    served) as "" instead. Re-reads the state first: messages may have
+    arrived while the LLM ran.
+    """
+    record_outcome(drift_score, bool(suggestion) and suggestion.strip().lower() != topic.lower())
+    state = get_topic_state(recipient_id, topic)
+    if suggestion and is_previous_title(state, suggestion):
+        ai_metrics.incr("ai.topic_suggest.previous_title")
+        suggestion = ""
+    state.last_suggestion = suggestion
+    state.suggestion_for_title = topic
+    state.suggestion_up_to_id = up_to_id
+    state.suggestion_latency_ms = latency_ms
+    state.evaluated_at = time.time()
+    mark_evaluated(state, up_to_id)
+    save_topic_state(state)
+    return state
+
+
+def suggestion_texts(state: TopicState) -> List[str]:
+    """The newest AI_TOPIC_SUGGEST_MESSAGES messages, oldest first, for the LLM."""
+    recent = state.recent[-getattr(settings, "AI_TOPIC_SUGGEST_MESSAGES", 10) :]
+    return [f.snippet for f in recent if f.snippet]
+
+
+def in_cooldown(state: TopicState) -> bool:
+    """
+    Whether the topic was evaluated by the LLM within
+    AI_TOPIC_SUGGEST_COOLDOWN_SECONDS, for any participant or device.
+    """
+    return time.time() - state.evaluated_at < getattr(settings, "AI_TOPIC_SUGGEST_COOLDOWN_SECONDS", 10)
+
+
+def recently_renamed(state: TopicState) -> bool:
+    """
+    Someone chose the current name within AI_TOPIC_RENAME_COOLDOWN_SECONDS;
+    suggesting another one now would only be noise.
+    """
+    return time.time() - state.renamed_at < getattr(settings, "AI_TOPIC_RENAME_COOLDOWN_SECONDS", 600)
+
+
+def is_previous_title(state: TopicState, title: str) -> bool:
+    lowered = title.strip().lower()
+    return any(lowered == t.lower() for t in state.previous_titles)
+
+
+def shared_suggestion(state: TopicState, current_title: str) -> str:
+    """The last suggestion made for `current_title`, whatever it covered; "" if none."""
+    if state.last_suggestion and state.suggestion_for_title.lower() == current_title.lower():
+        return state.last_suggestion
+    return ""
+
+
+def handle_topic_renamed(recipient_id: int, old_topic: str, new_topic: str) -> None:
+    """
+    Rename hook: call from do_update_message when a topic is renamed with
+    propagate_mode="change_all". Carries the old topic's messages into the
+    new topic's state as already evaluated (the new name is a human
+    judgement of them), records the old name in the rename history and
+    starts the rename cooldown.
+    """
+    old = get_topic_state(recipient_id, old_topic)
+    state = get_topic_state(recipient_id, new_topic)
+    same_key = _state_key(recipient_id, old_topic) == _state_key(recipient_id, new_topic)
+    by_id = {f.message_id: f for f in state.recent + old.recent}
+    history = [t for t in state.previous_titles + old.previous_titles if t.lower() != new_topic.lower()]
+    if old_topic.lower() != new_topic.lower():
+        history.append(old_topic)
+
+    state = TopicState(recipient_id=recipient_id, topic=new_topic)
+    for message_id in sorted(by_id):
+        record_message(state, message_id, by_id[message_id].snippet)
+    mark_evaluated(state, state.newest_id)
+    state.renamed_at = time.time()
+    state.previous_titles = list(dict.fromkeys(history))[-getattr(settings, "AI_TOPIC_RENAME_HISTORY", 5) :]
+    save_topic_state(state)
+    if not same_key:
+        try:
+            _get_store().delete(_state_key(recipient_id, old_topic))
+        except Exception:
+            logger.warning("topic state store unavailable", exc_info=True)
+
+
+def _pending_key(recipient_id: int, topic: str) -> str:
+    return _state_key(recipient_id, topic).replace(STATE_KEY_PREFIX, STATE_KEY_PREFIX + "pending:", 1)
+
+
+def mark_evaluation_pending(recipient_id: int, topic: str) -> bool:
+    """
+    Claim the topic's next background evaluation; False if one is already
+    queued or running (claims expire after AI_TOPIC_PRECOMPUTE_PENDING_TTL).
+    """
+    try:
+        return _get_store().add(
+            _pending_key(recipient_id, topic), "1", getattr(settings, "AI_TOPIC_PRECOMPUTE_PENDING_TTL", 60)
+        )
+    except Exception:
+        logger.warning("topic state store unavailable", exc_info=True)
+        return False
+
+
+def clear_evaluation_pending(recipient_id: int, topic: str) -> None:
+    try:
+        _get_store().delete(_pending_key(recipient_id, topic))
+    except Exception:
+        logger.warning("topic state store unavailable", exc_info=True)
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import logging
+import threading
+from dataclasses import asdict, dataclass
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+
+from zerver.lib import ai_metrics
+from zerver.lib.ai import roll_topic_summary
+from zerver.lib.ai_deadline import Deadline
+from zerver.lib.ai_prompt import estimate_tokens
+from zerver.lib.ai_singleflight import SharedStore, build_shared_store
+from zerver.models import Message
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_KEY_PREFIX = "ai_topic_summary:"
+
+
+@dataclass
+class TopicSummary:
+    """
+    Rolling summary of one (stream, topic), covering messages with
+    start_message_id <= id <= up_to_message_id.
+    """
+
+    recipient_id: int
+    topic: str
+    start_message_id: int
+    up_to_message_id: int
+    html: str
+    message_count: int
+
+
+def topic_summaries_enabled() -> bool:
+    return getattr(settings, "AI_TOPIC_SUMMARIES", False)
+
+
+_store: Optional[SharedStore] = None
+_store_lock = threading.Lock()
+
+
+def _get_store() -> SharedStore:
+    """
+    AI_TOPIC_SUMMARY_BACKEND: "django" (AI_TOPIC_SUMMARY_CACHE_ALIAS; point it
+    at a DatabaseCache alias for durable summaries) or "local" for tests.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = build_shared_store(
+                    getattr(settings, "AI_TOPIC_SUMMARY_BACKEND", "django"),
+                    getattr(settings, "AI_TOPIC_SUMMARY_CACHE_ALIAS", "default"),
+                    "AI_TOPIC_SUMMARY_BACKEND",
+                )
+    return _store
+
+
+def _summary_ttl() -> int:
+    return getattr(settings, "AI_TOPIC_SUMMARY_TTL", 30 * 24 * 3600)
+
+
+def _summary_key(realm_id: int, recipient_id: int, topic: str) -> str:
+    # Topics are case-insensitive in Zulip; hash to stay within memcached key rules.
+    topic_hash = hashlib.sha1(topic.lower().encode("utf-8")).hexdigest()
+    return f"{SUMMARY_KEY_PREFIX}{realm_id}:{recipient_id}:{topic_hash}"
+
+
+def get_topic_summary(realm_id: int, recipient_id: int, topic: str) -> Optional[TopicSummary]:
+    try:
+        raw = _get_store().get(_summary_key(realm_id, recipient_id, topic))
+    except Exception:
+        logger.exception("topic summary lookup failed")
+        return None
+    if raw is None:
+        return None
+    return TopicSummary(**json.loads(raw))
+
+
+def save_topic_summary(realm_id: int, summary: TopicSummary) -> None:
+    """
+    Store `summary` unless a summary covering more of the topic is already there.
+    """
+    key = _summary_key(realm_id, summary.recipient_id, summary.topic)
+    try:
+        current = get_topic_summary(realm_id, summary.recipient_id, summary.topic)
+        if current is not None and current.up_to_message_id >= summary.up_to_message_id:
+            return
+        _get_store().set(key, json.dumps(asdict(summary)), _summary_ttl())
+    except Exception:
+        logger.exception("topic summary save failed")
+
+
+def fetch_topic_messages(
+    recipient_id: int, topic: str, after_id: int, up_to_id: int, limit: Optional[int] = None
+) -> List[Tuple[int, str]]:
+    """
+    Messages of the topic with after_id < id <= up_to_id, oldest first; at
+    most `limit` of them.
+    """
+    query = (
+        Message.objects.filter(
+            recipient_id=recipient_id, subject__iexact=topic, id__gt=after_id, id__lte=up_to_id
+        )
+        .order_by("id")
+        .values_list("id", "content")
+    )
+    return list(query[:limit] if limit is not None else query)
+
+
+def topic_range_is_contiguous(recipient_id: int, topic: str, first_id: int, last_id: int, count: int) -> bool:
+    """
+    True if the topic has exactly `count` messages in [first_id, last_id],
+    i.e. a user's unread run there is the whole topic for that span.
+    """
+    return (
+        Message.objects.filter(
+            recipient_id=recipient_id, subject__iexact=topic, id__gte=first_id, id__lte=last_id
+        ).count()
+        == count
+    )
+
+
+def roll_messages(
+    label: str,
+    html: str,
+    texts: List[str],
+    realm_id: Optional[int] = None,
+    deadline: Optional[Deadline] = None,
+) -> str:
+    """
+    Fold `texts` into the summary `html`, a token-bounded chunk at a time,
+    charging the LLM calls to `realm_id` within `deadline`.
+    """
+    chunk_tokens: int = getattr(settings, "AI_RECAP_MAP_CHUNK_TOKENS", 3000)
+    chunk: List[str] = []
+    chunk_size = 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if chunk and chunk_size + tokens > chunk_tokens:
+            html = roll_topic_summary(label, html, chunk, realm_id=realm_id, deadline=deadline)
+            chunk, chunk_size = [], 0
+        chunk.append(text)
+        chunk_size += tokens
+    if chunk:
+        html = roll_topic_summary(label, html, chunk, realm_id=realm_id, deadline=deadline)
+    return html
+
+
+def advance_topic_summary(
+    realm_id: int,
+    summary: TopicSummary,
+    label: str,
+    tail: List[Tuple[int, str]],
+    deadline: Optional[Deadline] = None,
+) -> TopicSummary:
+    """
+    Roll `tail` (messages after summary.up_to_message_id) into the summary
+    and save the result, unless `deadline` ran out, in which case parts of it
+    may be fallbacks that must not be shared.
+    """
+    advanced = TopicSummary(
+        recipient_id=summary.recipient_id,
+        topic=summary.topic,
+        start_message_id=summary.start_message_id,
+        up_to_message_id=tail[-1][0] if tail else summary.up_to_message_id,
+        html=roll_messages(label, summary.html, [text or "" for _, text in tail], realm_id, deadline),
+        message_count=summary.message_count + len(tail),
+    )
+    if deadline is not None and deadline.cut_short():
+        ai_metrics.incr("ai.topic_summary.not_saved_deadline")
+        return advanced
+    save_topic_summary(realm_id, advanced)
+    ai_metrics.incr("ai.topic_summary.advanced")
+    ai_metrics.incr("ai.topic_summary.advanced_messages", len(tail))
+    return advanced
@@ -0,0 +1,23 @@
+# zerver/worker/ai_topic_suggestions.py
+import logging
+from typing import Any, Mapping
+
+from typing_extensions import override
+
+from zerver.lib.ai_topic_precompute import PRECOMPUTE_QUEUE, run_precompute_job
+from zerver.worker.base import QueueProcessingWorker, assign_queue
+
+logger = logging.getLogger(__name__)
+
+
+@assign_queue(PRECOMPUTE_QUEUE)
+class AITopicSuggestionWorker(QueueProcessingWorker):
+    """
+    Precomputes topic-title suggestions queued from the send path, in the
+    bulk LLM lane, so a later "improve topic" request is served from the
+    topic state instead of waiting on the LLM.
+    """
+
+    @override
+    def consume(self, event: Mapping[str, Any]) -> None:
+        run_precompute_job(event)
@@ -1,17 +1,34 @@
-from django.http import HttpRequest, HttpResponse
+from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
 from zerver.lib.response import json_success
 from zerver.lib.exceptions import JsonableError
 from zerver.models import Message
-from typing import List
+from typing import Any, Dict, Iterator, List
 from zerver.models import UserProfile
-from zerver.decorator import human_users_only 
-from zerver.lib.ai import generate_message_recap
+from zerver.decorator import human_users_only
+from zerver.lib.ai import agenerate_message_recap, generate_message_recap, stream_message_recap
+from zerver.lib.ai_auth import async_view_user
+from zerver.lib.ai_deadline import Deadline, DeadlineExceeded
+from zerver.lib.ai_recap import (
+    RECAP_SINGLE_PASS_MAX,
+    generate_map_reduce_recap,
+    max_recap_messages,
+    use_grouped_recap,
+)
+from zerver.lib.ai_recap_jobs import (
+    background_recaps_enabled,
+    enqueue_recap_job,
+    fetch_ordered_messages,
+    message_refs,
+)
+from asgiref.sync import sync_to_async
 
 import logging
 import json
 
-@human_users_only
-def message_recap(request: HttpRequest, user: UserProfile) -> HttpResponse:
+logger = logging.getLogger(__name__)
+
+
+def _parse_message_ids(request: HttpRequest, max_ids: int = RECAP_SINGLE_PASS_MAX) -> List[int]:
     # First, try to get message_ids from form-encoded POST
     raw_ids = request.POST.getlist("message_ids")
 
@@ -33,35 +50,162 @@ def message_recap(request: HttpRequest, user: UserProfile) -> HttpResponse:
     except ValueError:
         raise JsonableError("message_ids must be integers")
 
-    if len(message_ids) > 200:
-        raise JsonableError("Too many messages requested (max 200)")
+    if len(message_ids) > max_ids:
+        raise JsonableError(f"Too many messages requested (max {max_ids})")
+    return message_ids
+
+
+TIMED_OUT_RECAP_HTML = "<div class='ai-recap'><p>(The recap took too long; please try again.)</p></div>"
+
+
+def _timed_out_response(request: HttpRequest) -> HttpResponse:
+    return json_success(request, {"recap_html": TIMED_OUT_RECAP_HTML, "message_refs": []})
+
+
+def _map_reduce_response(
+    request: HttpRequest, user: UserProfile, message_ids: List[int], deadline: Deadline
+) -> HttpResponse:
+    try:
+        result = generate_map_reduce_recap(user, message_ids, max_tokens=800, deadline=deadline)
+    except DeadlineExceeded:
+        return _timed_out_response(request)
+    except Exception:
+        logger.exception("generate_map_reduce_recap failed")
+        raise JsonableError("Recap generation failed; check server logs")
+    return json_success(request, {"recap_html": result.html, "message_refs": result.message_refs})
+
+
+@human_users_only
+def message_recap(request: HttpRequest, user: UserProfile) -> HttpResponse:
+    deadline = Deadline.for_request(request, "recap")
+    message_ids = _parse_message_ids(request, max_recap_messages())
+    if background_recaps_enabled():
+        # The recap is pushed to the client as an ai_recap event.
+        return json_success(request, {"job_id": enqueue_recap_job(user, message_ids)})
+    if use_grouped_recap(len(message_ids)):
+        return _map_reduce_response(request, user, message_ids, deadline)
 
-    msgs_map = {
-        m.id: m
-        for m in Message.objects.filter(id__in=message_ids).only("id", "content")
-    }
-    ordered_msgs = [msgs_map[mid] for mid in message_ids if mid in msgs_map]
+    try:
+        deadline.check("fetch")
+    except DeadlineExceeded:
+        return _timed_out_response(request)
+    ordered_msgs = fetch_ordered_messages(message_ids)
 
     texts = [m.content or "" for m in ordered_msgs]
     ordered_ids = [m.id for m in ordered_msgs]
 
     try:
-        recap_html = generate_message_recap(texts, ordered_ids, max_tokens=800)
+        recap_html = generate_message_recap(
+            texts, ordered_ids, max_tokens=800, deadline=deadline, realm_id=user.realm_id
+        )
     except Exception:
         logger.exception("generate_message_recap failed")
         raise JsonableError("Recap generation failed; check server logs")
 
-    message_refs = [
-        {
-            "message_id": m.id,
-            "anchor": f"/#narrow/near/{m.id}",
-            "snippet": (m.content or "")[:300].replace("\n", " "),
-        }
-        for m in ordered_msgs
-    ]
-    # Return actual recap_html & refs
-    #return json_success({
-    #    "recap_html": recap_html,
-    #    "message_refs": message_refs,
-    #})
-    return json_success(request, {"recap_html": recap_html, "message_refs": message_refs})
\ No newline at end of file
+    return json_success(request, {"recap_html": recap_html, "message_refs": message_refs(ordered_msgs)})
+
+
+def _sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _grouped_recap_event_stream(user: UserProfile, message_ids: List[int], deadline: Deadline) -> Iterator[str]:
+    # Shared topic summaries are composed server-side; send the result as one chunk.
+    try:
+        result = generate_map_reduce_recap(user, message_ids, max_tokens=800, deadline=deadline)
+    except DeadlineExceeded:
+        yield _sse_event("error", {"msg": "The recap took too long; please try again."})
+        return
+    except Exception:
+        logger.exception("generate_map_reduce_recap failed")
+        yield _sse_event("error", {"msg": "Recap generation failed; check server logs"})
+        return
+    yield _sse_event("refs", {"message_refs": result.message_refs})
+    yield _sse_event("chunk", {"html": result.html})
+    yield _sse_event("done", {})
+
+
+def _recap_event_stream(ordered_msgs: List[Message], deadline: Deadline, realm_id: int) -> Iterator[str]:
+    # References first, so the list is usable while the recap is still generating.
+    yield _sse_event("refs", {"message_refs": message_refs(ordered_msgs)})
+    texts = [m.content or "" for m in ordered_msgs]
+    ordered_ids = [m.id for m in ordered_msgs]
+    try:
+        for block in stream_message_recap(
+            texts, ordered_ids, max_tokens=800, deadline=deadline, realm_id=realm_id
+        ):
+            yield _sse_event("chunk", {"html": block})
+    except Exception:
+        logger.exception("stream_message_recap failed")
+        yield _sse_event("error", {"msg": "Recap generation failed; check server logs"})
+        return
+    yield _sse_event("done", {})
+
+
+@human_users_only
+def message_recap_stream(request: HttpRequest, user: UserProfile) -> HttpResponse:
+    """
+    Server-sent-events variant of message_recap: a `refs` event, then one
+    `chunk` event per sanitized HTML block, then `done`. With
+    AI_RECAP_BACKGROUND, the recap is enqueued instead, and the stream is a
+    single `job` event carrying the job id, then `done`. If the deadline
+    has passed once the messages are fetched, the response is the timed-out
+    recap instead of a stream.
+    """
+    deadline = Deadline.for_request(request, "recap")
+    message_ids = _parse_message_ids(request)
+    if background_recaps_enabled():
+        job_id = enqueue_recap_job(user, message_ids)
+        events: Iterator[str] = iter([_sse_event("job", {"job_id": job_id}), _sse_event("done", {})])
+    elif use_grouped_recap(len(message_ids)):
+        events = _grouped_recap_event_stream(user, message_ids, deadline)
+    else:
+        ordered_msgs = fetch_ordered_messages(message_ids)
+        try:
+            deadline.check("stream")
+        except DeadlineExceeded:
+            return _timed_out_response(request)
+        events = _recap_event_stream(ordered_msgs, deadline, user.realm_id)
+
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Stop nginx from buffering the stream.
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+async def message_recap_async(request: HttpRequest) -> HttpResponse:
+    """
+    Async variant of message_recap for ASGI deployments (settings.AI_ASYNC_VIEWS).
+    The LLM round trip is awaited, so no worker thread is held while it runs.
+    Authenticated like the sync views (see async_view_user), humans only.
+    """
+    deadline = Deadline.for_request(request, "recap")
+    user = await async_view_user(request, humans_only=True)
+
+    message_ids = _parse_message_ids(request, max_recap_messages())
+    if background_recaps_enabled():
+        job_id = await sync_to_async(enqueue_recap_job)(user, message_ids)
+        return json_success(request, {"job_id": job_id})
+    if use_grouped_recap(len(message_ids)):
+        # The grouped recap runs its LLM calls on its own bounded thread pool.
+        return await sync_to_async(_map_reduce_response)(request, user, message_ids, deadline)
+
+    try:
+        deadline.check("fetch")
+    except DeadlineExceeded:
+        return _timed_out_response(request)
+    ordered_msgs = await sync_to_async(fetch_ordered_messages)(message_ids)
+
+    texts = [m.content or "" for m in ordered_msgs]
+    ordered_ids = [m.id for m in ordered_msgs]
+
+    try:
+        recap_html = await agenerate_message_recap(
+            texts, ordered_ids, max_tokens=800, deadline=deadline, realm_id=user.realm_id
+        )
+    except Exception:
+        logger.exception("agenerate_message_recap failed")
+        raise JsonableError("Recap generation failed; check server logs")
+
+    return json_success(request, {"recap_html": recap_html, "message_refs": message_refs(ordered_msgs)})
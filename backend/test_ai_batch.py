@@ -0,0 +1,67 @@
+# zerver/tests/test_ai_batch.py
+import asyncio
+import threading
+import time
+from typing import List
+
+from zerver.lib.ai_batch import MicroBatcher
+from zerver.lib.test_classes import ZulipTestCase
+
+
+class MicroBatcherTest(ZulipTestCase):
+    def test_cancelled_waiter_does_not_block_the_batch(self) -> None:
+        def run_batch(items: List[int]) -> List[str]:
+            time.sleep(0.3)
+            return [f"title {i}" for i in items]
+
+        batcher: MicroBatcher[int, str] = MicroBatcher("test", run_batch, window=0.05, max_size=8, threads=1)
+
+        async def wait_all() -> List[str]:
+            futures = [batcher.submit(i) for i in range(3)]
+
+            async def wait(i: int, timeout: float) -> str:
+                try:
+                    return await asyncio.wait_for(asyncio.wrap_future(futures[i]), timeout)
+                except asyncio.TimeoutError:
+                    return "timed out"
+
+            return await asyncio.gather(wait(0, 0.01), wait(1, 2), wait(2, 2))
+
+        start = time.monotonic()
+        results = asyncio.run(wait_all())
+        self.assertEqual(results, ["timed out", "title 1", "title 2"])
+        self.assertLess(time.monotonic() - start, 1.5)
+
+    def test_items_cancelled_while_queued_are_left_out(self) -> None:
+        calls: List[List[int]] = []
+        release = threading.Event()
+
+        def run_batch(items: List[int]) -> List[int]:
+            calls.append(list(items))
+            release.wait(2)
+            return items
+
+        batcher: MicroBatcher[int, int] = MicroBatcher("test", run_batch, window=0.01, max_size=2, threads=1)
+        first = [batcher.submit(1), batcher.submit(2)]
+        queued = [batcher.submit(3), batcher.submit(4)]
+        self.assertTrue(queued[0].cancel())
+        release.set()
+        self.assertEqual([f.result(timeout=2) for f in first], [1, 2])
+        self.assertEqual(queued[1].result(timeout=2), 4)
+        self.assertEqual(calls, [[1, 2], [4]])
+
+    def test_window_does_not_hold_a_worker(self) -> None:
+        # One worker busy with a slow batch; the next batch still closes on
+        # its own window and runs as soon as the worker is free.
+        def run_batch(items: List[int]) -> List[int]:
+            time.sleep(0.2)
+            return items
+
+        batcher: MicroBatcher[int, int] = MicroBatcher("test", run_batch, window=0.05, max_size=8, threads=1)
+        slow = batcher.submit(1)
+        time.sleep(0.1)
+        start = time.monotonic()
+        second = batcher.submit(2)
+        self.assertEqual(slow.result(timeout=2), 1)
+        self.assertEqual(second.result(timeout=2), 2)
+        self.assertLess(time.monotonic() - start, 0.45)
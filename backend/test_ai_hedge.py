@@ -0,0 +1,68 @@
+# zerver/tests/test_ai_hedge.py
+import time
+from typing import List
+from unittest import mock
+
+from django.test import override_settings
+
+from zerver.lib import ai_hedge
+from zerver.lib.test_classes import ZulipTestCase
+
+
+class RunHedgedTest(ZulipTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        ai_hedge._trackers.clear()
+        ai_hedge._budgets.clear()
+        # Warm the tracker: p95 of 50 ms.
+        tracker = ai_hedge._tracker("topic")
+        for _ in range(30):
+            tracker.record(0.05)
+
+    def metrics(self, incr: mock.MagicMock) -> List[str]:
+        return [call.args[0] for call in incr.call_args_list]
+
+    def test_fast_hedge_answers_first(self) -> None:
+        def primary(timeout: float) -> str:
+            time.sleep(1.0)
+            return "primary"
+
+        with mock.patch("zerver.lib.ai_metrics.incr") as incr:
+            start = time.monotonic()
+            result = ai_hedge.run_hedged("topic", primary, lambda timeout: "hedge", 5.0)
+        self.assertEqual(result, "hedge")
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertIn("ai.hedge.topic.fired", self.metrics(incr))
+        self.assertIn("ai.hedge.topic.hedge_won", self.metrics(incr))
+        self.assertNotIn("ai.hedge.topic.primary_won", self.metrics(incr))
+
+    def test_fast_primary_is_not_hedged(self) -> None:
+        hedged: List[float] = []
+        with mock.patch("zerver.lib.ai_metrics.incr") as incr:
+            result = ai_hedge.run_hedged("topic", lambda timeout: "primary", hedged.append, 5.0)
+        self.assertEqual(result, "primary")
+        self.assertEqual(hedged, [])
+        self.assertNotIn("ai.hedge.topic.fired", self.metrics(incr))
+
+    def test_failed_primary_falls_back_to_hedge(self) -> None:
+        def primary(timeout: float) -> str:
+            time.sleep(0.2)
+            raise RuntimeError("provider error")
+
+        def hedge(timeout: float) -> str:
+            time.sleep(0.3)
+            return "hedge"
+
+        with mock.patch("zerver.lib.ai_metrics.incr") as incr:
+            self.assertEqual(ai_hedge.run_hedged("topic", primary, hedge, 5.0), "hedge")
+        self.assertIn("ai.hedge.topic.hedge_won", self.metrics(incr))
+
+    @override_settings(AI_HEDGE_THREADS=0)
+    def test_full_pool_runs_inline_unhedged(self) -> None:
+        def primary(timeout: float) -> str:
+            time.sleep(0.2)
+            return "primary"
+
+        with mock.patch("zerver.lib.ai_metrics.incr") as incr:
+            self.assertEqual(ai_hedge.run_hedged("topic", primary, lambda timeout: "hedge", 5.0), "primary")
+        self.assertNotIn("ai.hedge.topic.fired", self.metrics(incr))
@@ -0,0 +1,70 @@
+# zerver/tests/test_ai_recap.py
+from typing import List, Optional
+from unittest import mock
+
+from django.test import override_settings
+
+from zerver.lib.ai_deadline import Deadline
+from zerver.lib.ai_recap import generate_map_reduce_recap
+from zerver.lib.ai_topic_summary import TopicSummary, get_topic_summary, save_topic_summary
+from zerver.lib.test_classes import ZulipTestCase
+from zerver.models import UserProfile
+
+
+def _summarize(label: str, messages: List[str], *args: object) -> str:
+    return "<p>own: {}</p>".format(" ".join(messages))
+
+
+def _reduce(
+    sections: List[str], max_tokens: int = 800, deadline: Optional[Deadline] = None, *args: object
+) -> str:
+    return "".join(sections)
+
+
+@override_settings(AI_TOPIC_SUMMARIES=True, AI_DELTA_RECAPS=False)
+@mock.patch("zerver.lib.ai_recap.reduce_recap_sections", side_effect=_reduce)
+@mock.patch("zerver.lib.ai_recap.summarize_recap_chunk", side_effect=_summarize)
+class SharedTopicSummaryAccessTest(ZulipTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.hamlet = self.example_user("hamlet")
+        self.cordelia = self.example_user("cordelia")
+        self.stream = self.make_stream("recap secrets", invite_only=True, history_public_to_subscribers=True)
+        for user in (self.hamlet, self.cordelia):
+            self.subscribe(user, self.stream.name)
+        self.message_ids = [
+            self.send_stream_message(
+                self.hamlet, self.stream.name, f"launch plan part {i}", topic_name="launch"
+            )
+            for i in range(3)
+        ]
+        save_topic_summary(
+            self.hamlet.realm_id,
+            TopicSummary(
+                recipient_id=self.stream.recipient_id,
+                topic="launch",
+                start_message_id=self.message_ids[0],
+                up_to_message_id=self.message_ids[-1],
+                html="<p>shared launch summary</p>",
+                message_count=len(self.message_ids),
+            ),
+        )
+
+    def recap(self, user: UserProfile) -> str:
+        return generate_map_reduce_recap(user, self.message_ids).html
+
+    def test_subscriber_reuses_shared_summary(self, summarize: mock.Mock, reduce: mock.Mock) -> None:
+        self.assertIn("shared launch summary", self.recap(self.cordelia))
+        summarize.assert_not_called()
+
+    def test_unsubscribed_user_does_not_get_shared_summary(
+        self, summarize: mock.Mock, reduce: mock.Mock
+    ) -> None:
+        self.unsubscribe(self.cordelia, self.stream.name)
+        html = self.recap(self.cordelia)
+        self.assertNotIn("shared launch summary", html)
+        self.assertIn("own: launch plan part 0", html)
+        # Nor is the unsubscribed user's recap seeded as the shared summary.
+        summary = get_topic_summary(self.hamlet.realm_id, self.stream.recipient_id, "launch")
+        assert summary is not None
+        self.assertEqual(summary.html, "<p>shared launch summary</p>")
@@ -0,0 +1,46 @@
+# zerver/tests/test_ai_topic_precompute.py
+from typing import Any, Dict, List
+from unittest import mock
+
+from django.test import override_settings
+
+from zerver.lib.ai_topic_precompute import PRECOMPUTE_QUEUE, handle_sent_message
+from zerver.lib.ai_topic_state import clear_evaluation_pending, get_topic_state
+from zerver.lib.test_classes import ZulipTestCase
+from zerver.models import Message
+
+
+@override_settings(AI_TOPIC_PRECOMPUTE=True, AI_TOPIC_PRECOMPUTE_EVERY=1)
+@mock.patch("zerver.lib.ai_topic_precompute.drift_likely", return_value=True)
+class HandleSentMessageTest(ZulipTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        hamlet = self.example_user("hamlet")
+        self.subscribe(hamlet, "Verona")
+        message_id = self.send_stream_message(
+            hamlet, "Verona", "the launch moved to friday", topic_name="launch"
+        )
+        self.message = Message.objects.get(id=message_id)
+        clear_evaluation_pending(self.message.recipient_id, "launch")
+        self.addCleanup(clear_evaluation_pending, self.message.recipient_id, "launch")
+
+    def test_state_is_saved_before_the_job_is_published(self, drift_likely: mock.Mock) -> None:
+        newest_at_publish: List[int] = []
+
+        def publish(queue_name: str, event: Dict[str, Any]) -> None:
+            self.assertEqual(queue_name, PRECOMPUTE_QUEUE)
+            newest_at_publish.append(get_topic_state(event["recipient_id"], event["topic"]).newest_id)
+
+        with mock.patch("zerver.lib.ai_topic_precompute.queue_json_publish", side_effect=publish):
+            with self.captureOnCommitCallbacks(execute=True):
+                handle_sent_message(self.message)
+        self.assertEqual(newest_at_publish, [self.message.id])
+
+    def test_job_is_not_published_before_commit(self, drift_likely: mock.Mock) -> None:
+        with mock.patch("zerver.lib.ai_topic_precompute.queue_json_publish") as publish:
+            with self.captureOnCommitCallbacks(execute=False) as callbacks:
+                handle_sent_message(self.message)
+            publish.assert_not_called()
+            self.assertEqual(len(callbacks), 1)
+            callbacks[0]()
+            publish.assert_called_once()
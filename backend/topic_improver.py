@@ -2,16 +2,37 @@
 from __future__ import annotations
 
 import logging
-from typing import List, Optional
+import time
+from typing import Optional, Tuple
 
+from asgiref.sync import sync_to_async
 from django.http import HttpRequest, HttpResponse
 from django.views.decorators.http import require_POST
 
 from zerver.lib.exceptions import JsonableError
 from zerver.lib.response import json_success
-from zerver.models import Message, UserProfile
-import re
-from zerver.lib.ai import suggest_topic_title
+from zerver.lib.streams import access_stream_by_id
+from zerver.models import UserProfile
+from zerver.lib import ai_metrics
+from zerver.lib.ai import allm_topic_title, llm_topic_title, topic_fallback_title
+from zerver.lib.ai_auth import async_view_user
+from zerver.lib.ai_deadline import Deadline, DeadlineExceeded
+from zerver.lib.ai_topic_precompute import stored_suggestion
+from zerver.lib.ai_topic_state import (
+    MIN_MSGS,
+    TopicState,
+    clear_evaluation_pending,
+    drift_likely,
+    in_cooldown,
+    load_topic_state,
+    mark_evaluated,
+    mark_evaluation_pending,
+    recently_renamed,
+    save_topic_state,
+    shared_suggestion,
+    store_suggestion,
+    suggestion_texts,
+)
 logger = logging.getLogger(__name__)
 from django.conf import settings
 logger.info("LLM_API_KEY present? %s", bool(getattr(settings, "LLM_API_KEY", None)))
@@ -28,84 +49,86 @@ def _parse_int(value: Optional[str], field: str) -> Optional[int]:
         raise JsonableError(f"{field} is not an integer")
 
 
-def _parse_int_list_from_post(request: HttpRequest, key: str) -> List[int]:
-    raw_list = request.POST.getlist(f"{key}[]")
-    if not raw_list:
-        raw_list = request.POST.getlist(key)
-
-    out: List[int] = []
-    for item in raw_list:
-        if item == "":
-            continue
-        try:
-            out.append(int(item))
-        except (TypeError, ValueError):
-            raise JsonableError(f"{key} contains non-integer value")
-    return out
-
-@require_POST
-def suggest_topic_title_backend(request: HttpRequest, user_profile: UserProfile) -> HttpResponse:
-    current_title = request.POST.get("current_title", "") or ""
-    message_id = _parse_int(request.POST.get("message_id"), "message_id")
-    message_ids = _parse_int_list_from_post(request, "message_ids")
+def _parse_topic_request(request: HttpRequest) -> Tuple[str, int, str]:
+    stream_id = _parse_int(request.POST.get("stream_id"), "stream_id")
+    topic = (request.POST.get("topic") or "").strip()
+    current_title = request.POST.get("current_title") or topic
 
     logger.info(
-        "topic_improver: received message_id=%s message_ids=%s current_title=%r POST_keys=%s",
-        message_id,
-        message_ids[-5:] if message_ids else [],
+        "topic_improver: received stream_id=%s topic=%r current_title=%r",
+        stream_id,
+        topic,
         current_title,
-        sorted(request.POST.keys()),
     )
 
-    if message_id is None and not message_ids:
-        raise JsonableError("message_id or message_ids is required")
-
-    # 1) anchor_id is used later for the "rename whole topic" PATCH (/json/messages/{id})
-    anchor_id = message_id if message_id is not None else message_ids[-1]
-
-    # 2) Core behavior: prioritize message_ids (current batch only), do not fetch extra history.
-    texts: list[str] = []
-    if message_ids:
-        if len(message_ids) > 50:
-            raise JsonableError("Too many messages requested (max 50)")
-
-        msgs = list(Message.objects.filter(id__in=message_ids).only("id", "content"))
-        msg_map = {m.id: (m.content or "").strip() for m in msgs}
-        # Preserve frontend order.
-        texts = [msg_map[mid] for mid in message_ids if mid in msg_map and msg_map[mid]]
-    else:
-        # Fallback: only message_id was provided.
-        try:
-            anchor = Message.objects.only("id", "content", "subject").get(id=anchor_id)
-        except Message.DoesNotExist:
-            raise JsonableError("anchor message not found")
-        texts = [(anchor.content or "").strip()] if (anchor.content or "").strip() else []
-
-    # ---- heuristics (restore) ----
-    MIN_MSGS = 2
-    MIN_AVG_LEN = 20
-    TITLE_MATCH_RATIO = 0.6
-
-    if len(texts) < MIN_MSGS:
-        return json_success(request, {"suggested_title": "", "anchor_id": anchor_id})
-
-    avg_len = sum(len(t) for t in texts) / len(texts)
-    if avg_len < MIN_AVG_LEN:
-        return json_success(request, {"suggested_title": "", "anchor_id": anchor_id})
-
-    title_words = set(re.findall(r"\w{3,}", current_title.lower()))
-    if title_words:
-        matches = sum(1 for t in texts if any(w in t.lower() for w in title_words))
-        if matches / len(texts) > TITLE_MATCH_RATIO:
-            return json_success(request, {"suggested_title": "", "anchor_id": anchor_id})
-
-    # 3) call LLM
+    if stream_id is None or not topic:
+        raise JsonableError("stream_id and topic are required")
+    return current_title, stream_id, topic
+
+
+def _load_state(user_profile: UserProfile, stream_id: int, topic: str) -> TopicState:
+    stream, _ = access_stream_by_id(user_profile, stream_id)
+    return load_topic_state(stream.recipient_id, topic)
+
+
+def _settle_no_drift(state: TopicState) -> None:
+    """
+    Drift unlikely: once there were enough messages to judge, count them as
+    evaluated so the next request looks only at newer ones.
+    """
+    if state.unevaluated >= MIN_MSGS:
+        mark_evaluated(state, state.newest_id)
+        save_topic_state(state)
+
+
+def _answer_without_llm(state: TopicState, current_title: str) -> Optional[str]:
+    """
+    The answer when this request must not run the LLM, or None after
+    claiming the topic's evaluation (release it with _record_result). The
+    cooldown and debounce are per topic, shared by every participant and
+    device: a stored suggestion covering the newest message is served as
+    is; nothing is suggested right after a rename or without likely drift;
+    during the cooldown, or while another request's evaluation runs, the
+    last shared suggestion is served instead of recomputing.
+    """
+    stored = stored_suggestion(state, current_title)
+    if stored is not None:
+        return stored
+    if recently_renamed(state):
+        ai_metrics.incr("ai.topic_suggest.rename_cooldown")
+        return ""
+    if not drift_likely(state):
+        _settle_no_drift(state)
+        return ""
+    if in_cooldown(state):
+        ai_metrics.incr("ai.topic_suggest.cooldown")
+        return shared_suggestion(state, current_title)
+    if not mark_evaluation_pending(state.recipient_id, state.topic):
+        ai_metrics.incr("ai.topic_suggest.debounced")
+        return shared_suggestion(state, current_title)
+    return None
+
+
+def _record_result(state: TopicState, suggested: Optional[str], fallback: str, start: float) -> str:
+    """
+    Share the LLM's suggestion and release the topic's evaluation claim.
+    When the LLM did not answer (None), only this requester gets the
+    heuristic `fallback`; it is not stored for anyone else.
+    """
     try:
-        suggested = suggest_topic_title(messages=texts, current_title=current_title, max_tokens=40)
-    except Exception:
-        logger.exception("suggest_topic_title failed")
-        suggested = ""
-
+        if suggested is None:
+            ai_metrics.incr("ai.topic_suggest.no_answer")
+            return fallback
+        latency_ms = (time.monotonic() - start) * 1000
+        stored = store_suggestion(
+            state.recipient_id, state.topic, suggested, state.newest_id, latency_ms, state.drift_score
+        )
+        return stored.last_suggestion or ""
+    finally:
+        clear_evaluation_pending(state.recipient_id, state.topic)
+
+
+def _suggestion_response(request: HttpRequest, suggested: str, anchor_id: Optional[int]) -> HttpResponse:
     return json_success(
         request,
         {
@@ -113,3 +136,85 @@ def suggest_topic_title_backend(request: HttpRequest, user_profile: UserProfile)
             "anchor_id": anchor_id,  # Required by frontend to rename the whole topic.
         },
     )
+
+
+@require_POST
+def suggest_topic_title_backend(request: HttpRequest, user_profile: UserProfile) -> HttpResponse:
+    """
+    Suggest a title for (stream_id, topic) from the server-side topic state;
+    anchor_id in the response is the topic's newest message, for the rename.
+    """
+    deadline = Deadline.for_request(request, "topic")
+    current_title, stream_id, topic = _parse_topic_request(request)
+    state = _load_state(user_profile, stream_id, topic)
+    anchor_id = state.newest_id or None
+    if anchor_id is None:
+        return _suggestion_response(request, "", anchor_id)
+
+    answer = _answer_without_llm(state, current_title)
+    if answer is not None:
+        return _suggestion_response(request, answer, anchor_id)
+
+    # call LLM
+    start = time.monotonic()
+    suggested: Optional[str] = None
+    fallback = ""
+    try:
+        deadline.check("fetch")
+        texts = suggestion_texts(state)
+        fallback = topic_fallback_title(texts, current_title) if texts else ""
+        suggested = llm_topic_title(
+            messages=texts,
+            current_title=current_title,
+            max_tokens=40,
+            deadline=deadline,
+            realm_id=user_profile.realm_id,
+        )
+    except DeadlineExceeded:
+        # No suggestion is better than a late one.
+        pass
+    except Exception:
+        logger.exception("llm_topic_title failed")
+    return _suggestion_response(request, _record_result(state, suggested, fallback, start), anchor_id)
+
+
+@require_POST
+async def suggest_topic_title_async_backend(request: HttpRequest) -> HttpResponse:
+    """
+    Async variant for ASGI deployments (settings.AI_ASYNC_VIEWS); awaits the LLM
+    call instead of holding a worker thread. Authenticated like the sync
+    view (see async_view_user).
+    """
+    deadline = Deadline.for_request(request, "topic")
+    user_profile = await async_view_user(request)
+
+    current_title, stream_id, topic = _parse_topic_request(request)
+    state = await sync_to_async(_load_state)(user_profile, stream_id, topic)
+    anchor_id = state.newest_id or None
+    if anchor_id is None:
+        return _suggestion_response(request, "", anchor_id)
+
+    answer = await sync_to_async(_answer_without_llm)(state, current_title)
+    if answer is not None:
+        return _suggestion_response(request, answer, anchor_id)
+
+    start = time.monotonic()
+    suggested: Optional[str] = None
+    fallback = ""
+    try:
+        deadline.check("fetch")
+        texts = suggestion_texts(state)
+        fallback = topic_fallback_title(texts, current_title) if texts else ""
+        suggested = await allm_topic_title(
+            messages=texts,
+            current_title=current_title,
+            max_tokens=40,
+            deadline=deadline,
+            realm_id=user_profile.realm_id,
+        )
+    except DeadlineExceeded:
+        pass
+    except Exception:
+        logger.exception("allm_topic_title failed")
+    answer = await sync_to_async(_record_result)(state, suggested, fallback, start)
+    return _suggestion_response(request, answer, anchor_id)
@@ -1,14 +1,28 @@
+from django.conf import settings
 from django.urls import path
 
 from zerver.lib.rest import rest_dispatch
-from zerver.views.message_recap import message_recap
-from zerver.views.topic_improver import suggest_topic_title_backend
+from zerver.views.message_recap import message_recap, message_recap_async, message_recap_stream
+from zerver.views.topic_improver import (
+    suggest_topic_title_async_backend,
+    suggest_topic_title_backend,
+)
 
-urlpatterns = [
-    path("json/ai/message_recap", message_recap, name="message_recap"),
-    path(
-        "json/ai/suggest_topic_title",
-        rest_dispatch,
-        {"POST": suggest_topic_title_backend},
-    ),
-]
\ No newline at end of file
+# Async views only pay off under ASGI; under WSGI every request would spin up
+# its own event loop (and HTTP client), so they are opt-in.
+if getattr(settings, "AI_ASYNC_VIEWS", False):
+    urlpatterns = [
+        path("json/ai/message_recap", message_recap_async, name="message_recap"),
+        path("json/ai/message_recap/stream", message_recap_stream, name="message_recap_stream"),
+        path("json/ai/suggest_topic_title", suggest_topic_title_async_backend),
+    ]
+else:
+    urlpatterns = [
+        path("json/ai/message_recap", message_recap, name="message_recap"),
+        path("json/ai/message_recap/stream", message_recap_stream, name="message_recap_stream"),
+        path(
+            "json/ai/suggest_topic_title",
+            rest_dispatch,
+            {"POST": suggest_topic_title_backend},
+        ),
+    ]
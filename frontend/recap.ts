@@ -1,3 +1,5 @@
+import _ from "lodash";
+
 import * as channel from "./channel.ts";
 import * as dialog_widget from "./dialog_widget.ts";
 import * as unread from "./unread.ts";
@@ -15,6 +17,32 @@ import * as unread from "./unread.ts";
 const RECAP_BTN_ID = "recap-inbox-btn";
 const RECAP_PANEL_ID = "recap-main-view";
 
+// Stream the recap (server-sent events) so sections render as they are generated.
+const USE_STREAMING = true;
+// The streaming endpoint is single-pass; larger sets go to the map-reduce recap.
+const STREAM_MAX_IDS = 200;
+// Matches the server's AI_RECAP_MAX_MESSAGES default.
+const MAX_RECAP_IDS = 5000;
+// How long we wait for the (non-streaming) recap; the server plans its work to fit.
+const RECAP_TIMEOUT_MS = 30_000;
+// With AI_RECAP_BACKGROUND the server answers with a job id and pushes the
+// recap as an ai_recap event; give up waiting for it after this long.
+const RECAP_JOB_TIMEOUT_MS = 5 * 60_000;
+
+type RecapRef = {message_id: number; anchor: string; snippet: string};
+
+export type RecapEvent = {
+    type: "ai_recap";
+    job_id: string;
+    recap_html?: string;
+    message_refs?: RecapRef[];
+    error?: string;
+};
+
+// Jobs this tab asked for, with their give-up timers; other tabs of the same
+// user receive the event too and ignore it.
+const pending_recap_jobs = new Map<string, number>();
+
 function unlock_page_scroll(): void {
     document.querySelector(".modal__overlay")?.remove();
     document.querySelector(".micromodal.modal--open")?.remove();
@@ -110,8 +138,12 @@ window.addEventListener("load", setup_inbox_only_behavior);
 
 export function show_unread_recap(): void {
     // unread.get_all_msg_ids() returns unread message ids across the realm.
-    // Keep the request bounded.
-    const ids = unread.get_all_msg_ids().slice(0, 200);
+    // Keep the request bounded; the server summarizes large sets with map-reduce.
+    const all_ids = unread.get_all_msg_ids();
+    if (all_ids.length > MAX_RECAP_IDS) {
+        console.warn(`recap: ${all_ids.length} unread messages, summarizing the first ${MAX_RECAP_IDS}`);
+    }
+    const ids = all_ids.slice(0, MAX_RECAP_IDS);
 
     if (ids.length === 0) {
         dialog_widget.launch({
@@ -131,44 +163,193 @@ export function show_unread_recap(): void {
     close_on_submit: true,
     });
 
+    if (USE_STREAMING && ids.length <= STREAM_MAX_IDS) {
+        stream_unread_recap(ids);
+        return;
+    }
+
     channel.post({
         url: "/json/ai/message_recap",
         data: {message_ids: ids},
         traditional: true,
+        timeout: RECAP_TIMEOUT_MS,
+        headers: {"X-AI-Timeout-Ms": String(RECAP_TIMEOUT_MS)},
         success(data: any) {
             console.log("recap: raw response data:", data);
+            if (data?.job_id) {
+                wait_for_recap_job(data.job_id as string);
+                return;
+            }
             const recap_html: string = data?.recap_html ?? "<p>(no recap)</p>";
-            const refs = (data?.message_refs ?? []) as Array<{
-                message_id: number;
-                anchor: string;
-                snippet: string;
-            }>;
+            const refs = (data?.message_refs ?? []) as RecapRef[];
             document.querySelector(".modal__overlay")?.remove();
             document.querySelector(".micromodal.modal--open")?.remove();
             render_recap_panel(recap_html, refs);
         },
         error(xhr) {
+            show_recap_error(xhr);
+        },
+    });
+}
+
+function wait_for_recap_job(job_id: string): void {
+    const timer = window.setTimeout(() => {
+        pending_recap_jobs.delete(job_id);
+        show_recap_failure("The recap took too long; please try again.");
+    }, RECAP_JOB_TIMEOUT_MS);
+    pending_recap_jobs.set(job_id, timer);
+}
+
+function show_recap_failure(msg: string): void {
+    document.querySelector(".modal__overlay")?.remove();
+    document.querySelector(".micromodal.modal--open")?.remove();
+    dialog_widget.launch({
+        html_heading: "Unread recap",
+        html_body: `<p>${_.escape(msg)}</p>`,
+        html_submit_button: "Close",
+        close_on_submit: true,
+    });
+}
+
+// Called from server_events_dispatch for events of type "ai_recap".
+export function dispatch_recap_event(event: RecapEvent): void {
+    const timer = pending_recap_jobs.get(event.job_id);
+    if (timer === undefined) {
+        return;
+    }
+    window.clearTimeout(timer);
+    pending_recap_jobs.delete(event.job_id);
+    if (event.error) {
+        show_recap_failure(event.error);
+        return;
+    }
+    document.querySelector(".modal__overlay")?.remove();
+    document.querySelector(".micromodal.modal--open")?.remove();
+    render_recap_panel(event.recap_html ?? "<p>(no recap)</p>", event.message_refs ?? []);
+}
+
+function show_recap_error(xhr: JQuery.jqXHR): void {
+    // Print detailed failure info to console for debugging
+    // channel.xhr_error_message exists, but we can still show status code.
+    console.error("recap request failed:", {
+        status: xhr.status,
+        responseText: xhr.responseText,
+    });
+
+    dialog_widget.launch({
+      html_heading: "Unread recap",
+      html_body: `<div id="unread-recap-loading"><p>Generating recap...</p></div>`,
+      html_submit_button: "Close",
+      close_on_submit: true,
+    });
+}
 
-            // Print detailed failure info to console for debugging
-            // channel.xhr_error_message exists, but we can still show status code.
-            console.error("recap request failed:", {
-                status: xhr.status,
-                responseText: xhr.responseText,
-            });
-
-            dialog_widget.launch({
-              html_heading: "Unread recap",
-              html_body: `<div id="unread-recap-loading"><p>Generating recap...</p></div>`,
-              html_submit_button: "Close",
-              close_on_submit: true,
-            });
+/* --------------------------- Streaming --------------------------- */
+
+// Server-sent events arrive as "event: <name>\ndata: <json>\n\n".
+function parse_sse_block(block: string): {event: string; data: any} | null {
+    let event = "message";
+    let data = "";
+    for (const line of block.split("\n")) {
+        if (line.startsWith("event:")) {
+            event = line.slice("event:".length).trim();
+        } else if (line.startsWith("data:")) {
+            data += line.slice("data:".length).trim();
+        }
+    }
+    if (!data) {
+        return null;
+    }
+    try {
+        return {event, data: JSON.parse(data)};
+    } catch {
+        return null;
+    }
+}
+
+function stream_unread_recap(ids: number[]): void {
+    let consumed = 0;
+    let recap_target: HTMLElement | null = null;
+
+    const handle_event = (event: string, data: any): void => {
+        if (event === "job") {
+            // Background recaps: the result arrives as an ai_recap event.
+            wait_for_recap_job(data.job_id as string);
+            return;
+        }
+        if (event === "refs") {
+            // References come first; show the panel right away.
+            document.querySelector(".modal__overlay")?.remove();
+            document.querySelector(".micromodal.modal--open")?.remove();
+            recap_target = render_recap_panel(
+                `<p class="recap-streaming">Generating recap…</p>`,
+                (data?.message_refs ?? []) as RecapRef[],
+            );
+            return;
+        }
+        if (!recap_target) {
+            if (event === "error") {
+                dialog_widget.launch({
+                    html_heading: "Unread recap",
+                    html_body: "<p>Recap generation failed.</p>",
+                    html_submit_button: "Close",
+                    close_on_submit: true,
+                });
+            }
+            return;
+        }
+        if (event === "chunk") {
+            append_recap_section(recap_target, data?.html ?? "");
+        } else if (event === "done" || event === "error") {
+            recap_target.querySelector(".recap-streaming")?.remove();
+            if (event === "error") {
+                append_recap_section(recap_target, "<p>(recap failed)</p>");
+            }
+        }
+    };
+
+    const drain = (text: string): void => {
+        // Only complete events (terminated by a blank line) are consumed.
+        let end = text.indexOf("\n\n", consumed);
+        while (end !== -1) {
+            const parsed = parse_sse_block(text.slice(consumed, end));
+            consumed = end + 2;
+            if (parsed) {
+                handle_event(parsed.event, parsed.data);
+            }
+            end = text.indexOf("\n\n", consumed);
+        }
+    };
+
+    channel.post({
+        url: "/json/ai/message_recap/stream",
+        data: {message_ids: ids},
+        traditional: true,
+        dataType: "text",
+        xhrFields: {
+            onprogress(e: ProgressEvent) {
+                drain((e.target as XMLHttpRequest).responseText);
+            },
+        },
+        success(text: string) {
+            drain(text);
+        },
+        error(xhr) {
+            show_recap_error(xhr);
         },
     });
 }
 
+function append_recap_section(target: HTMLElement, html: string): void {
+    target.querySelector(".recap-streaming")?.remove();
+    // Assume server-side sanitized
+    target.insertAdjacentHTML("beforeend", html);
+}
+
 /* --------------------------- Panel rendering --------------------------- */
 
-function render_recap_panel(recap_html: string, refs: Array<{message_id: number; anchor: string; snippet: string}>): void {
+// Returns the recap container so streamed sections can be appended to it.
+function render_recap_panel(recap_html: string, refs: RecapRef[]): HTMLElement {
     // Remove existing panel if present
     document.getElementById(RECAP_PANEL_ID)?.remove();
 
@@ -249,7 +430,7 @@ function render_recap_panel(recap_html: string, refs: Array<{message_id: number;
     if (inboxList && inboxList.parentElement) {
         inboxList.parentElement.insertBefore(panel, inboxList.nextSibling);
         panel.scrollIntoView({behavior: "smooth", block: "start"});
-        return;
+        return recapWrapper;
     }
 
     // If inboxList is not available, fall back to appending to inboxMain.
@@ -257,12 +438,13 @@ function render_recap_panel(recap_html: string, refs: Array<{message_id: number;
     if (inboxMain) {
         inboxMain.appendChild(panel);
         panel.scrollIntoView({behavior: "smooth", block: "start"});
-        return;
+        return recapWrapper;
     }
 
     // Final fallback.
     document.body.appendChild(panel);
     panel.scrollIntoView({behavior: "smooth"});
+    return recapWrapper;
 /*
     // Insert into center content area.
     // In Zulip, the center column is typically inside #home (or .app-main).
@@ -4,8 +4,9 @@
 // No dialog_widget / micromodal assumptions.
 //
 // Behavior:
-// - Batch outgoing stream messages in groups of MIN_MSGS.
-// - After each batch, call backend /json/ai/suggest_topic_title with message_ids + current_title.
+// - Count outgoing stream messages in groups of MIN_MSGS.
+// - After each group, call backend /json/ai/suggest_topic_title with stream_id + topic; the server
+//   keeps the topic's recent messages and drift state, so no message ids are sent.
 // - If suggested_title returned, show a bottom-right floating panel with Apply/Dismiss.
 // - Apply: rename the entire topic via PATCH /json/messages/{anchor_id} with propagate_mode=change_all.
 // - Dismiss: hide; keep listening and start a new batch.
@@ -15,6 +16,7 @@
 // Note: This module is invoked from transmit.ts after a message send succeeds.
 //
 import * as channel from "./channel.ts";
+import * as compose_state from "./compose_state.ts";
 import _ from "lodash";
 
 // ----------------------------
@@ -22,7 +24,8 @@ import _ from "lodash";
 // ----------------------------
 const MIN_MSGS = 3; 
 const COOLDOWN_MS = 10_000;
-const MAX_IDS_SENT = 50;
+// How long we wait for a suggestion; sent to the server so it can give up in time.
+const SUGGEST_TIMEOUT_MS = 8000;
 
 // Keyword overlap heuristics to suppress requests (client-side)
 // If last suggestion is "close enough" to current topic, don't even request.
@@ -301,6 +304,7 @@ function hide_floating_ui(_reason: "dismiss" | "apply" | "close"): void {
 // ----------------------------
 type TopicSuggestionResponse = {
     suggested_title?: string;
+    anchor_id?: number | null;
     msg?: string;
     result?: string;
 };
@@ -348,8 +352,7 @@ export function maybe_request_topic_suggestion(message_ids: number[]): void {
         return;
     }
 
-    // Use non-overlapping batches: take the last MIN_MSGS, then clear immediately.
-    const ids_for_server = batch_ids.slice(-MIN_MSGS).slice(-MAX_IDS_SENT);
+    // Non-overlapping groups: the server decides which messages to evaluate.
     batch_ids = [];
 
     if (in_flight) {
@@ -362,8 +365,8 @@ export function maybe_request_topic_suggestion(message_ids: number[]): void {
         return;
     }
 
-    const anchor_id = ids_for_server.at(-1);
-    if (anchor_id === undefined) {
+    const stream_id = compose_state.stream_id();
+    if (stream_id === undefined) {
         return;
     }
 
@@ -373,19 +376,21 @@ export function maybe_request_topic_suggestion(message_ids: number[]): void {
     channel.post({
         url: "/json/ai/suggest_topic_title",
         data: {
-            message_ids: ids_for_server,
-            current_title: current_topic,
+            stream_id,
+            topic: current_topic,
         },
-        traditional: true,
+        timeout: SUGGEST_TIMEOUT_MS,
+        headers: {"X-AI-Timeout-Ms": String(SUGGEST_TIMEOUT_MS)},
 
         success(raw: unknown) {
             in_flight = false;
             const data = raw as TopicSuggestionResponse;
             const suggested_title = (data.suggested_title ?? "").trim();
+            const anchor_id = data.anchor_id;
 
             debug_log("[topic_improver] response", data);
 
-            if (!suggested_title) {
+            if (!suggested_title || !anchor_id) {
                 return;
             }
 